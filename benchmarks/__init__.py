@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+#       __init__.py - The Nested benchmarks
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""The Nested benchmarks.
+
+Each module is a script, run it from anywhere:
+
+  pipeline.py      the txt2tags/export pipeline stages, with regression checks
+  import_time.py   the txt2tags import and start up, cold
+  rtf_export.py    the RTF export of a long Spanish document
+  unicode_path.py  the UTF-8 str and the unicode export.convert() paths
+  document.py      synthetic Nested documents, of any size
+
+The timing and the path set up they share are in common.py.
+"""
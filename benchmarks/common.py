@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#       common.py - The timing and set up shared by the benchmarks
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""The timing and set up shared by the benchmarks.
+
+Importing it puts the nested dir first on the path, so the benchmarks
+import the txt2tags and export modules of this tree, not installed ones.
+"""
+
+import json
+import os
+import sys
+import time
+
+NESTED = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'nested')
+if NESTED not in sys.path:
+    sys.path.insert(0, NESTED)
+
+
+def best_of(func, repeat):
+    "Returns the smallest of the repeat values returned by func"
+    return min([func() for i in range(repeat)])
+
+
+def best_time(func, repeat):
+    "Returns the best of repeat runs of func, in seconds"
+    def run():
+        start = time.time()
+        func()
+        return time.time() - start
+    return best_of(run, repeat)
+
+
+def save_json(data, output=None):
+    "Saves data as JSON to the output file, prints it with no output"
+    data = json.dumps(data, indent=2, sort_keys=True)
+    if output:
+        f = open(output, 'w')
+        f.write(data + '\n')
+        f.close()
+    else:
+        print data
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#       document.py - Synthetic Nested documents for the benchmarks
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""Synthetic Nested documents, of any size, for the benchmarks.
+
+Each section has paragraphs with beautifiers, links and footnotes, a
+list, a table, a code block and a math block, like the documents made
+with Nested. The text is generated, so the lines don't repeat and the
+caches don't make a big document look cheaper than it is.
+
+The code and math blocks use the Nested marks, converted by the export
+custom_preproc. check_document() makes sure all the sections render
+outside them.
+
+Usage: python benchmarks/document.py [-s SECTIONS] [-p PARAGRAPHS] > doc.t2t
+       python benchmarks/document.py --check [-s SECTIONS] [-p PARAGRAPHS]
+"""
+
+import re
+import sys
+from optparse import OptionParser
+
+import common  # the nested dir on the path
+import export
+
+HEADER = [
+    'Synthetic Benchmark Document',
+    'The Nested benchmarks',
+    'Version 1.0',
+    '',
+    '%!target: xhtmls',
+    "%!postproc(xhtmls): 'FNMARK' '°°_'",
+    "%!postproc(xhtmls): 'FNTEXT' '_°°'",
+    '%!options(tex): --enum-title --toc',
+    '',
+]
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit nullam '
+         'iaculis molestie etiam aliquam hendrerit felis vulputate tortor '
+         'rhoncus class aptent taciti sociosqu litora torquent conubia '
+         'nostra inceptos himenaeos quisque pretium turpis augue').split()
+
+MARKS = ('**%s**', '//%s//', '__%s__', '--%s--', '``%s``', '%s')
+
+
+def get_words(n, count):
+    "Returns count words of text, different for each n"
+    words = []
+    for i in range(count):
+        word = WORDS[(n * 7 + i * 3) % len(WORDS)]
+        words.append(MARKS[(n + i) % len(MARKS)] % word)
+    words.append('n%d' % n)
+    return ' '.join(words)
+
+
+def get_paragraph(n):
+    "Returns the lines of a paragraph with a link and a footnote"
+    return [
+        get_words(n, 12) + ' [link %d http://example.com/page%d.html]' % (n, n),
+        get_words(n + 1, 10) + ' www.example%d.org and mail%d@example.com' % (n, n),
+        get_words(n + 2, 11) + '°°_ ' + get_words(n + 3, 4) + '.',
+        '',
+        '_°° ' + get_words(n + 4, 6) + '.',
+        '',
+    ]
+
+
+def get_section(n, paragraphs):
+    "Returns the lines of the section number n"
+    lines = ['= %s %d =[section%d]' % (WORDS[n % len(WORDS)].title(), n, n), '']
+    for i in range(paragraphs):
+        lines.extend(get_paragraph(n * 100 + i))
+
+    # List, with a sublist
+    for i in range(4):
+        lines.append('- ' + get_words(n + i, 6))
+    lines.append('  + ' + get_words(n + 5, 5))
+    lines.append('  + ' + get_words(n + 6, 5))
+    lines.extend(['', ''])
+
+    # Table
+    lines.append('|| Item | Value | Notes |')
+    for i in range(5):
+        lines.append('| %s | %d | %s |' % (WORDS[(n + i) % len(WORDS)],
+                                          n * 10 + i, get_words(n + i, 3)))
+    lines.append('')
+
+    # Code
+    lines.append('{{{ python')
+    lines.append('def section_%d(x):' % n)
+    lines.append('    return [i * %d for i in range(x)]  # **not bold**' % n)
+    lines.append(export.code_close)
+    lines.append('')
+
+    # Math
+    lines.append(export.math_open)
+    lines.append(r'\begin{align}')
+    lines.append(r'x_{%d} & = \frac{-b \pm \sqrt{b^2 - 4ac}}{2a} \\' % n)
+    lines.append(r'y_{%d} & = \sum_{i=0}^{%d} i^2' % (n, n))
+    lines.append(r'\end{align}')
+    lines.append(export.math_close)
+    lines.append('')
+    return lines
+
+
+def get_document(sections=20, paragraphs=5):
+    "Returns the marked text of a document with the given size"
+    lines = HEADER[:]
+    for n in range(1, sections + 1):
+        lines.extend(get_section(n, paragraphs))
+    return '\n'.join(lines)
+
+
+def check_document(sections=3, paragraphs=1):
+    """Returns the problems of the xhtmls document, an empty list if none
+
+    Each section must have its title, list and table outside the <pre>
+    blocks, and its code and math blocks converted by custom_preproc.
+    """
+    lines = []
+    for n in range(1, sections + 1):
+        lines.extend(get_section(n, paragraphs))
+    html = export.convert('\n'.join(lines), 'xhtmls')
+    pres = re.findall(r'<pre.*?</pre>', html, re.S)
+    outside = re.sub(r'<pre.*?</pre>', '', html, flags=re.S)
+
+    problems = []
+    for n in range(1, sections + 1):
+        if 'id="section%d"' % n not in outside:
+            problems.append('section %d: the title is not outside <pre>' % n)
+        code = 'def section_%d(x):' % n
+        if not [pre for pre in pres
+                if pre.startswith('<pre class="brush: python;') and
+                code in pre]:
+            problems.append('section %d: the code block is not converted' % n)
+        if 'x_{%d}' % n not in ''.join(
+                re.findall(r'<p class="math">.*?</p>', html, re.S)):
+            problems.append('section %d: the math block is not converted' % n)
+    for tag in ('<ul', '<table'):
+        if outside.count(tag) < sections:
+            problems.append('%s: %d outside <pre>, not %d' % (
+                tag, outside.count(tag), sections))
+    if '**not bold**' not in html:
+        problems.append('the code blocks are formatted')
+    return problems
+
+
+def main():
+    parser = OptionParser(usage='%prog [-s SECTIONS] [-p PARAGRAPHS] '
+                                '[--check]')
+    parser.add_option('-s', '--sections', type='int', default=20,
+                      help='sections in the document [%default]')
+    parser.add_option('-p', '--paragraphs', type='int', default=5,
+                      help='paragraphs in each section [%default]')
+    parser.add_option('-c', '--check', action='store_true',
+                      help='check that the sections render as expected')
+    options, args = parser.parse_args()
+    if options.check:
+        problems = check_document(options.sections, options.paragraphs)
+        for problem in problems:
+            print problem
+        sys.exit(bool(problems))
+    print get_document(options.sections, options.paragraphs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#       import_time.py - Benchmark of the txt2tags start up
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""Benchmark of the txt2tags import and start up, cold.
+
+Each run is a new Python process, so nothing is imported or cached yet:
+
+  python           the interpreter start up alone (python -c pass)
+  import.txt2tags  the import txt2tags statement
+  import.export    the import export statement, as Nested does
+  nested.first     import export and the first xhtmls conversion of a small
+                   document, as the first Nested preview
+  cli.version      the whole txt2tags.py --version command
+  cli.convert      the whole txt2tags.py -t xhtmls command on a small document
+  compile          compiling txt2tags.py, what each cli start up costs (a
+                   script is always compiled) and each import when the .pyc
+                   can't be saved
+
+The .pyc files are saved first, as an installed Nested has them. The
+best time of each stage is saved as JSON, in the pipeline.py format, so
+it can be compared with: python benchmarks/pipeline.py compare OLD NEW
+
+Usage: python benchmarks/import_time.py [-r REPEAT] [-o FILE]
+"""
+
+import os
+import py_compile
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from common import NESTED, best_of, save_json
+
+DOCUMENT = '\n'.join([
+    'Start up benchmark',
+    '',
+    '',
+    '= Section =',
+    '',
+    'Some **bold** and //italic// text, a link www.example.com.',
+    '',
+    '- item',
+    '- item',
+    '',
+    '| a | b |',
+    '',
+])
+
+# Each one prints the seconds it took
+SNIPPETS = {
+    'import.txt2tags': 'import txt2tags',
+    'import.export': 'import export',
+    'nested.first': 'import export\n'
+                    'export.convert(%r, "xhtmls")' % DOCUMENT,
+    'compile': 'compile(open("txt2tags.py").read(), "txt2tags.py", "exec")',
+}
+TIMER = 'import time\nstart = time.time()\n%s\nprint time.time() - start\n'
+
+
+def run_python(args):
+    "Runs python with args on the nested dir, returns (seconds, output)"
+    start = time.time()
+    process = subprocess.Popen([sys.executable] + args, cwd=NESTED,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    elapsed = time.time() - start
+    if process.returncode:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(args), errors))
+    return elapsed, output
+
+
+def run(options):
+    "Times all the stages, returns the JSON results"
+    for name in ('txt2tags.py', 'export.py'):
+        py_compile.compile(os.path.join(NESTED, name), doraise=True)
+
+    fd, document = tempfile.mkstemp('.t2t')
+    os.write(fd, DOCUMENT)
+    os.close(fd)
+    commands = {
+        'python': ['-c', 'pass'],
+        'cli.version': ['txt2tags.py', '--version'],
+        'cli.convert': ['txt2tags.py', '-t', 'xhtmls', '-o', '-', document],
+    }
+
+    results = {}
+    try:
+        for stage, args in commands.items():
+            results[stage] = best_of(lambda: run_python(args)[0],
+                                     options.repeat)
+        for stage, code in SNIPPETS.items():
+            args = ['-c', TIMER % code]
+            results[stage] = best_of(
+                lambda: float(run_python(args)[1].split()[-1]),
+                options.repeat)
+    finally:
+        os.remove(document)
+    return {
+        'python': sys.version.split()[0],
+        'repeat': options.repeat,
+        'results': {'startup': results},
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [-r REPEAT] [-o FILE]')
+    parser.add_option('-r', '--repeat', type='int', default=10,
+                      help='runs of each benchmark, the best is kept '
+                           '[%default]')
+    parser.add_option('-o', '--output',
+                      help='save the JSON results to OUTPUT')
+    options, args = parser.parse_args()
+
+    data = run(options)
+    for stage, seconds in sorted(data['results']['startup'].items()):
+        sys.stderr.write('%-16s %.4fs\n' % (stage, seconds))
+    save_json(data, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#       pipeline.py - Benchmark of the txt2tags/export pipeline
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""Benchmark of the txt2tags/export pipeline, with regression checks.
+
+The bundled examples (Paper, Code, Math, Presentation) and a synthetic
+document (see document.py) are timed on these stages:
+
+  parse            source split, config parsing and the line parse stage
+                   of the body (the same for all the targets)
+  render.TARGET    the body, TOC and headers conversion, lines parsed
+  postproc.TARGET  the PostProc filters and the document finishing
+  publish.TARGET   the whole export.convert() call, as Nested publishes,
+                   with nothing parsed yet
+
+The targets are the ones Nested publishes to: xhtmls, tex and txt. The
+best time of each stage is saved as JSON, and compare flags the stages
+that got slower than on a saved baseline.
+
+Usage: python benchmarks/pipeline.py run [-s SECTIONS] [-r REPEAT] [-o FILE]
+       python benchmarks/pipeline.py compare BASELINE [CURRENT] [-t PERCENT]
+"""
+
+import copy
+import json
+import os
+import sys
+from optparse import OptionParser
+
+from common import NESTED, best_time, save_json
+import txt2tags
+import export
+import document
+
+EXAMPLES = ('Paper', 'Code', 'Math', 'Presentation')
+TARGETS = ('xhtmls', 'tex', 'txt')
+
+
+def parse_source(lines):
+    "Returns (header, body, config per target), like Nested opening a file"
+    source = txt2tags.SourceDocument(contents=lines[:])
+    header, conf, body = source.split()
+    raw = source.get_raw_config()
+    configs = {}
+    for target in TARGETS:
+        configs[target] = txt2tags.ConfigMaster(
+            raw + [['all', 'target', target]]).parse()
+    return header, body, configs
+
+
+def parse_body(lines):
+    "Runs the target independent line parse stage on the body lines"
+    regex = txt2tags.getCachedRegexes()
+    cache = {}
+    for line in lines:
+        line = txt2tags.maskEscapeChar(line)
+        txt2tags.parseLine(line, regex, cache)
+        txt2tags.parseInline(line, regex, cache)
+
+
+def get_config(target, header, options):
+    "Returns the sane config export.convert() would use"
+    config = export._get_config(target)
+    for i in range(3):
+        config['header%d' % (i + 1)] = header[i]
+    config['target'] = target
+    options = copy.deepcopy(options)
+    if options.get('preproc'):
+        options['preproc'].extend(config['preproc'])
+    if options.get('postproc'):
+        options['postproc'].extend(config['postproc'])
+    config.update(options)
+    return txt2tags.ConfigMaster().sanity(config)
+
+
+def render(lines, target, header, options):
+    "Returns the (tagged document, config) of the body lines"
+    config = get_config(target, header, options)
+    converter = txt2tags.Converter(config)
+    body, marked_toc = converter.convert(lines)
+    toc = converter.toc_formatter(converter.toc_tagger(marked_toc))
+    body = converter.toc_inside_body(body, toc)
+    if not converter.autotoc:
+        toc = []
+    config['fullBody'] = toc + body
+    return converter.do_header(header), config
+
+
+def time_document(txt, repeat):
+    "Returns the {stage: best time} of the document"
+    lines = txt.split('\n')
+    header, body, configs = parse_source(lines)
+    results = {}
+
+    def parse():
+        parse_body(parse_source(lines)[1])
+    results['parse'] = best_time(parse, repeat)
+
+    for target in TARGETS:
+        options = configs[target]
+        marked = export.custom_preproc(body[:], target)
+
+        # Parse it once, so render times just the rendering
+        render(marked, target, header, options)
+
+        def render_it():
+            render(marked, target, header, options)
+        results['render.' + target] = best_time(render_it, repeat)
+
+        outlist, config = render(marked, target, header, options)
+
+        def postproc():
+            txt2tags.finish_him(outlist[:], config)
+        results['postproc.' + target] = best_time(postproc, repeat)
+
+        def publish():
+            txt2tags.PARSE_CACHE.clear()
+            export.convert('\n'.join(body), target, header,
+                           copy.deepcopy(options))
+        results['publish.' + target] = best_time(publish, repeat)
+    return results
+
+
+def run(options):
+    "Times all the documents, returns the JSON results"
+    documents = []
+    for name in EXAMPLES:
+        path = os.path.join(NESTED, 'examples', name, name + '.t2t')
+        txt = open(path).read().decode('utf-8')
+        documents.append((name, os.path.dirname(path), txt))
+    problems = document.check_document()
+    if problems:
+        sys.exit('The synthetic document is malformed:\n' +
+                 '\n'.join(problems))
+    synthetic = document.get_document(options.sections, options.paragraphs)
+    documents.append(('synthetic', os.getcwd(), synthetic.decode('utf-8')))
+
+    results = {}
+    cwd = os.getcwd()
+    for name, path, txt in documents:
+        os.chdir(path)      # the images are relative to the document
+        try:
+            results[name] = time_document(txt, options.repeat)
+        finally:
+            os.chdir(cwd)
+        sys.stderr.write('%s: %.3fs\n' % (name, sum(results[name].values())))
+    return {
+        'python': sys.version.split()[0],
+        'repeat': options.repeat,
+        'sections': options.sections,
+        'paragraphs': options.paragraphs,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold, minimum):
+    """Prints the stages of both results, returns the number of slowdowns
+
+    A stage is a slowdown when it's threshold percent slower than on the
+    baseline, and also at least minimum seconds slower (timer noise).
+    """
+    slowdowns = 0
+    fmt = '%-14s %-17s %9s %9s %8s'
+    print fmt % ('document', 'stage', 'baseline', 'current', 'change')
+    for name in sorted(baseline['results']):
+        old = baseline['results'][name]
+        new = current['results'].get(name, {})
+        for stage in sorted(old):
+            if stage not in new:
+                continue
+            change = (new[stage] - old[stage]) / (old[stage] or 1e-9) * 100
+            flag = ''
+            if change > threshold and new[stage] - old[stage] > minimum:
+                flag = '  SLOWER'
+                slowdowns += 1
+            print fmt % (name, stage, '%.4f' % old[stage],
+                         '%.4f' % new[stage], '%+.1f%%' % change) + flag
+    return slowdowns
+
+
+def main():
+    parser = OptionParser(usage='%prog run [options]\n'
+                                '       %prog compare BASELINE [CURRENT] '
+                                '[options]')
+    parser.add_option('-s', '--sections', type='int', default=20,
+                      help='sections of the synthetic document [%default]')
+    parser.add_option('-p', '--paragraphs', type='int', default=5,
+                      help='paragraphs in each section [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs of each benchmark, the best is kept '
+                           '[%default]')
+    parser.add_option('-o', '--output',
+                      help='save the JSON results to OUTPUT (run)')
+    parser.add_option('-t', '--threshold', type='float', default=10.0,
+                      help='percent slower to flag a stage [%default]')
+    parser.add_option('-m', '--minimum', type='float', default=0.002,
+                      help='seconds slower to flag a stage [%default]')
+    options, args = parser.parse_args()
+
+    if args[:1] == ['run'] and len(args) == 1:
+        save_json(run(options), options.output)
+    elif args[:1] == ['compare'] and len(args) in (2, 3):
+        baseline = json.load(open(args[1]))
+        if len(args) == 3:
+            current = json.load(open(args[2]))
+        else:
+            current = run(options)
+        slowdowns = compare(baseline, current, options.threshold,
+                            options.minimum)
+        if slowdowns:
+            print '%d stages got slower' % slowdowns
+            sys.exit(1)
+    else:
+        parser.error('use run or compare')
+
+
+if __name__ == '__main__':
+    main()
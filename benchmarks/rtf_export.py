@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#       rtf_export.py - Benchmark of the RTF export
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""Benchmark of the RTF export of a long Spanish document.
+
+Times the RTF special chars escaping alone (every body line goes through
+it) and the whole export.convert() call, with the UTF-8 encoding set so
+the non ascii chars are turned to RTF escapes.
+
+Usage: python benchmarks/rtf_export.py [-p PARAGRAPHS] [-r REPEAT]
+"""
+
+from optparse import OptionParser
+
+from common import best_time
+import txt2tags
+import export
+
+PARAGRAPH = [
+    u'El año pasado la región recibió más de ¼ de la inversión pública, '
+    u'según el «Informe Anual» de la compañía.',
+    u'Además, la señora Muñoz explicó que el índice de crecimiento —el '
+    u'más alto en décadas— superó las expectativas: 12,5 % (≈ 3 M€).',
+    u'**Conclusión:** las cifras ¡sorprendieron! a todos los niños y '
+    u'niñas de la sesión “Ciencia para todos” en Logroño.',
+    u'',
+]
+
+
+def get_document(paragraphs):
+    "Returns the marked text of a document with the given paragraphs"
+    lines = [u'= Informe de la región =', u'']
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            lines.append(u'== Sección %d: Año económico ==' % (i / 50 + 1))
+            lines.append(u'')
+        lines.extend(PARAGRAPH)
+    return u'\n'.join(lines).encode('utf-8')
+
+
+def main():
+    parser = OptionParser(usage='%prog [-p PARAGRAPHS] [-r REPEAT]')
+    parser.add_option('-p', '--paragraphs', type='int', default=2000,
+                      help='document size, in paragraphs [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs of each benchmark, the best is shown '
+                           '[%default]')
+    options, args = parser.parse_args()
+
+    txt = get_document(options.paragraphs)
+    lines = txt.split('\n')
+
+    config = export._get_config('rtf')
+    config['target'] = 'rtf'
+    config['encoding'] = 'utf-8'
+    config = txt2tags.ConfigMaster().sanity(config)
+    converter = txt2tags.Converter(config)
+
+    def escape():
+        for line in lines:
+            converter.do_escape(line)
+
+    def convert():
+        export.convert(txt, 'rtf', options={'encoding': 'utf-8'})
+
+    print '%d lines, %d bytes' % (len(lines), len(txt))
+    print 'escape : %.3fs' % best_time(escape, options.repeat)
+    print 'convert: %.3fs' % best_time(convert, options.repeat)
+
+
+if __name__ == '__main__':
+    main()
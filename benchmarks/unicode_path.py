@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#       unicode_path.py - Benchmark of the str and unicode conversions
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+
+"""Benchmark of the UTF-8 str and the unicode export.convert() paths.
+
+The bundled Markup.es.t2t (Spanish, non ascii) is published to a file on
+each target, with the UTF-8 encoding set, from the UTF-8 text as the editor
+buffer gives it:
+
+  str      the UTF-8 text is converted as is, the str result is written
+  unicode  the text is decoded once, converted in unicode and the result
+           is encoded once as it's written (the unicode mode)
+
+Both must write the same bytes, the targets where one of them fails are
+reported. The document can be repeated to make it bigger.
+
+Usage: python benchmarks/unicode_path.py [-n TIMES] [-r REPEAT]
+"""
+
+import copy
+import os
+import tempfile
+from optparse import OptionParser
+
+from common import NESTED, best_time
+import txt2tags
+import export
+
+DOCUMENT = os.path.join(NESTED, 'examples', 'Markup', 'Markup.es.t2t')
+TARGETS = ('xhtmls', 'tex', 'txt', 'html', 'rtf', 'aat', 'mgp')
+
+
+def get_document(times):
+    "Returns the (header, body, raw config) of the document, body repeated"
+    source = txt2tags.SourceDocument(DOCUMENT)
+    header, conf, body = source.split()
+    return header, body * times, source.get_raw_config()
+
+
+def publish_str(body, target, header, options, path):
+    "Converts the UTF-8 text and writes the result, returns the error"
+    result = export.convert('\n'.join(body), target, header,
+                            copy.deepcopy(options))
+    f = open(path, 'wb')
+    f.write(result)
+    f.close()
+    return result.startswith('Sorry!')
+
+
+def publish_unicode(body, target, header, options, path):
+    "Converts the text in the unicode mode, writes it, returns the error"
+    result = export.convert('\n'.join(body).decode('utf-8'), target, header,
+                            copy.deepcopy(options))
+    f = open(path, 'wb')
+    f.write(result.encode('utf-8'))
+    f.close()
+    return result.startswith('Sorry!')
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n TIMES] [-r REPEAT]')
+    parser.add_option('-n', '--times', type='int', default=1,
+                      help='times the document body is repeated [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=20,
+                      help='runs of each benchmark, the best is shown '
+                           '[%default]')
+    options, args = parser.parse_args()
+
+    header, body, raw = get_document(options.times)
+    os.chdir(os.path.dirname(DOCUMENT))   # the images are relative to it
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    print '%d lines, %d bytes' % (len(body), sum(map(len, body)))
+    print '%-8s %9s %9s %8s' % ('target', 'str', 'unicode', 'change')
+    try:
+        for target in TARGETS:
+            conf = txt2tags.ConfigMaster(raw + [['all', 'target', target]])
+            opts = conf.parse()
+            opts['encoding'] = 'UTF-8'
+            outputs = []
+            for publish in (publish_str, publish_unicode):
+                failed = publish(body, target, header, opts, path)
+                outputs.append(not failed and open(path, 'rb').read())
+            if not all(outputs):
+                print '%-8s %s path failed' % (
+                    target, outputs[0] and 'unicode' or 'str')
+                continue
+            if outputs[0] != outputs[1]:
+                print '%-8s different output' % target
+                continue
+            old = best_time(lambda: publish_str(body, target, header, opts,
+                                                path), options.repeat)
+            new = best_time(lambda: publish_unicode(body, target, header,
+                                                    opts, path),
+                            options.repeat)
+            print '%-8s %8.2fms %8.2fms %+7.1f%%' % (
+                target, old * 1000, new * 1000, (new - old) / old * 100)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
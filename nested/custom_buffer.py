@@ -29,7 +29,7 @@ class Txt2tagsSyntax(object):
     """Txt2tags syntax highlight class."""
     def __init__(self):
 
-        self.bank = txt2tags.getRegexes()
+        self.bank = txt2tags.getCachedRegexes()
 
         # Styles
         self.styles = {
@@ -63,128 +63,151 @@ supported_languages = { 'as3'        : '',
                         'xhtml'      : 'html'
                       }
 
+# Code and math blocks marks, see custom_preproc()
+code_open  = re.compile('{{{ (?P<code>'+ '|'.join(supported_languages.keys()) + ')')
+code_close = '}}}'
+math_open  = '<<<'
+math_close = '>>>'
+
+# HTML replacement, see escape_html()
+safe_for_html = [['&', '&amp;' ],
+                 ['<', '&lt;'  ],
+                 ['>', '&gt;'  ],
+                 ['"', '&quot;']]
+html_entities = dict(safe_for_html)
+html_unsafe = re.compile('[' + ''.join([re.escape(char)
+                                        for char, entity in safe_for_html]) + ']')
+
+def _get_lstset(code):
+    """Get the listings lines that set the language of a code block"""
+    code_splited = code.split(',')
+    if len(code_splited) == 1:
+        return ['\\lstset{language=' + code + '}']
+    elif len(code_splited) == 2:
+        return ['\\lstset{language=[' + code_splited[0] + ']' + code_splited[1] + '}']
+    return []
+
+# The listings lines of each language
+lstset_lines = dict([(language, _get_lstset(code))
+                     for language, code in supported_languages.items()])
+
+class TransliterationTable(dict):
+    """Memoized {char code: transliterated text} table, for unicode.translate()"""
+    def __missing__(self, code):
+        nkfd_form = unicodedata.normalize('NFKD', unichr(code))
+        text = u''.join([c for c in nkfd_form if not unicodedata.combining(c)])
+        self[code] = text
+        return text
+
+transliteration = TransliterationTable()
+# On narrow Python builds the astral chars are surrogate pairs, they can't be
+# transliterated one code at a time
+surrogates = re.compile(u'[\ud800-\udfff]')
+
 def transliterate_string(string):
     """Transliterate given string"""
-    nkfd_form = unicodedata.normalize('NFKD', unicode(string))
-    normalized = u''.join([c for c in nkfd_form if not unicodedata.combining(c)])
-    return normalized
-
-def custom_preproc(lines, target):
-    """All this functions sucks :S"""
-    
-    # Regexes
-    code_open  = re.compile('{{{ (?P<code>'+ '|'.join(supported_languages.keys()) + ')')
-    code_close = re.compile('}}}')
-    math_open  = re.compile('<<<')
-    math_close = re.compile('>>>')
-
+    string = unicode(string)
+    try:
+        string.encode('ascii')
+        return string
+    except UnicodeError:
+        pass
+    if surrogates.search(string):
+        nkfd_form = unicodedata.normalize('NFKD', string)
+        return u''.join([c for c in nkfd_form if not unicodedata.combining(c)])
+    return string.translate(transliteration)
+
+def escape_html(line):
+    """Replace the unsafe HTML chars of the line, in a single pass"""
+    return html_unsafe.sub(lambda m: html_entities[m.group()], line)
+
+def iter_custom_preproc(lines, target):
+    """Yield the lines with the Nested code and math blocks converted.
+
+    The lines are read just once, as they're yielded. Only xhtmls (code
+    and math blocks) and tex (code blocks) change them.
+    """
     if target == 'xhtmls':
-
-        # HTML replacement
-        safe_for_html = [['&', '&amp;' ],
-                         ['<', '&lt;'  ],
-                         ['>', '&gt;'  ],
-                         ['"', '&quot;']]
-
-        code_preproc = []
-        inside_code_block = False
-        for line in lines:
-            # Looking for the beginning of the block
-            if not inside_code_block:
-                found = code_open.match(line)
-                if found:
-                    inside_code_block = True
-                    code = found.groupdict()['code']
-                    code_preproc.append('\'\'\'')
-                    code_preproc.append('<pre class="brush: {0}; class-name: code;">'.format(code))
-                else:
-                    # Normal line
-                    code_preproc.append(line)
-            # In a code block
+        return _iter_xhtmls_blocks(lines)
+    elif target == 'tex':
+        return _iter_tex_blocks(lines)
+    return iter(lines)
+
+def _iter_xhtmls_blocks(lines):
+    inside_code_block = False
+    inside_math_block = False
+    for line in lines:
+        # Normal line
+        if not (inside_code_block or inside_math_block) and \
+           line[:3] != '{{{' and line[:3] != math_open:
+            yield line
+            continue
+
+        # Code blocks first
+        if not inside_code_block:
+            found = code_open.match(line)
+            if found:
+                inside_code_block = True
+                code = found.groupdict()['code']
+                code_lines = ['\'\'\'', '<pre class="brush: {0}; class-name: code;">'.format(code)]
             else:
-                # Looking for the end of the block
-                found = code_close.match(line)
-                if found:
-                    inside_code_block = False
-                    code_preproc.append('</pre>')
-                    code_preproc.append('\'\'\'')
-                else:
-                    # Code line, replace unsafe elements
-                    for replacement in safe_for_html:
-                        line = line.replace(replacement[0], replacement[1])
-                    code_preproc.append(line)
-
-        
-        math_preproc = []
-        inside_math_block = False
-        for line in code_preproc:
-            # Looking for the beginning of the block
+                code_lines = [line]
+        elif line.startswith(code_close):
+            inside_code_block = False
+            code_lines = ['</pre>', '\'\'\'']
+        else:
+            # Code line, replace unsafe elements
+            code_lines = [escape_html(line)]
+
+        # Then math blocks, on the code blocks output
+        for line in code_lines:
             if not inside_math_block:
-                found = math_open.match(line)
-                if found:
+                if line.startswith(math_open):
                     inside_math_block = True
-                    math_preproc.append('\'\'\'')
-                    math_preproc.append('<p class="math">')
+                    yield '\'\'\''
+                    yield '<p class="math">'
                 else:
-                    # Normal line
-                    math_preproc.append(line)
-            # In a math block
+                    yield line
+            elif line.startswith(math_close):
+                inside_math_block = False
+                yield '</p>'
+                yield '\'\'\''
             else:
-                # Looking for the end of the block
-                found = math_close.match(line)
-                if found:
-                    inside_math_block = False
-                    math_preproc.append('</p>')
-                    math_preproc.append('\'\'\'')
-                else:
-                    # Math line, replace unsafe elements
-                    for replacement in safe_for_html:
-                        line = line.replace(replacement[0], replacement[1])
-                    math_preproc.append(line)
-
-            lines = math_preproc
-
-    elif target == 'tex':
-
-        code_preproc = []
-        inside_code_block = False
-        for line in lines:
-            # Looking for the beginning of the block
-            if not inside_code_block:
-                found = code_open.match(line)
-                if found:
-                    inside_code_block = True
-                    code = found.groupdict()['code']
-                    code = supported_languages[code]
-                    
-                    code_preproc.append('\'\'\'')
-
-                    code_splited = code.split(',')
-                    if len(code_splited) == 1:
-                        code_preproc.append('\\lstset{language=' + code + '}')
-                    elif len(code_splited) == 2:
-                        code_preproc.append('\\lstset{language=[' + code_splited[0] + ']' + code_splited[1] + '}')
-                    
-                    code_preproc.append('\\begin{lstlisting}')
-                else:
-                    # Normal line
-                    code_preproc.append(line)
-            # In a code block
+                # Math line, replace unsafe elements
+                yield escape_html(line)
+
+def _iter_tex_blocks(lines):
+    inside_code_block = False
+    for line in lines:
+        if not inside_code_block:
+            found = line[:3] == '{{{' and code_open.match(line)
+            if found:
+                inside_code_block = True
+                code = found.groupdict()['code']
+                yield '\'\'\''
+                for lstset in lstset_lines[code]:
+                    yield lstset
+                yield '\\begin{lstlisting}'
             else:
-                # Looking for the end of the block
-                found = code_close.match(line)
-                if found:
-                    inside_code_block = False
-                    code_preproc.append('\\end{lstlisting}')
-                    code_preproc.append('\'\'\'')
-                else:
-                    # Code line
-                    line = transliterate_string(line) # listings LaTeX package doesn't support non-ascii characters, sad :(
-                    code_preproc.append(line)
+                # Normal line
+                yield line
+        elif line.startswith(code_close):
+            inside_code_block = False
+            yield '\\end{lstlisting}'
+            yield '\'\'\''
+        else:
+            # Code line, listings LaTeX package doesn't support non-ascii
+            # characters, sad :(
+            yield transliterate_string(line)
 
-        lines = code_preproc
+def custom_preproc(lines, target):
+    """Convert the Nested code and math blocks, return the lines list.
 
-    return lines
+    See iter_custom_preproc().
+    """
+    if target not in ('xhtmls', 'tex'):
+        return lines
+    return list(iter_custom_preproc(lines, target))
 
 
 def _get_config(type):
@@ -210,97 +233,80 @@ def _get_config(type):
         config['css-inside'] = 0
         config['css-sugar'] = 1
         
-        # Remove target comments
-        config['preproc'].append(['%xhtmls% ', ''])
-        config['preproc'].append(['%html% ', '']) # Alias
-        
-        # Allow line breaks, r'\\\\' are 2 \ for regexes
-        #config['preproc'].append([r'\\\\', '\'\'<br />\'\'']) # F*ck, these are used in Latex :S
-        config['preproc'].append([r'@@', '\'\'<br />\'\'']) # F*ck, @@ is used in diffs :S
+        # Target comments, @@ line breaks (\\ are used in Latex), semantic
+        # tags for the visual ones, ^^sup^^ and ,,sub,, and the images size
+        # and path are the Nested rules, see txt2tags.NestedMaster
+        config['nested-rules'] = 1
 
-        # Math and code blocks are commented because txt2tags doesn't support
-        # newlines in preproc, see:
+        # Math and code blocks are not rules because txt2tags doesn't
+        # support newlines in preproc, see:
         # http://code.google.com/p/txt2tags/issues/detail?id=25
         # For now, custom_preproc() is used
-        ## Support math block
-        #config['preproc'].append(['<<<', '\'\'\'\n<pre class="math">'])
-        #config['preproc'].append(['>>>', '</pre>\n\'\'\''])
-
-        ## Support code block
-        #config['preproc'].append(['{{{ (' + '|'.join(supported_languages.keys()) + ')', '\'\'\'\n<pre class="brush: \\1; class-name: code;">'])
-        #config['preproc'].append(['}}}', '</pre>\n\'\'\''])
-        
-        # Semantic tags, in case user use visual tags
-        config['postproc'].append([r'(?i)(</?)b>', r'\1strong>'])
-        config['postproc'].append([r'(?i)(</?)i>', r'\1em>'])
-        config['postproc'].append([r'(?i)(</?)u>', r'\1ins>'])
-        config['postproc'].append([r'(?i)(</?)s>', r'\1del>'])
-
-        # Allow subscript superscript
-        config['postproc'].append([r'\^\^(.*?)\^\^', r'<sup>\1</sup>'])
-        config['postproc'].append([r',,(.*?),,', r'<sub>\1</sub>'])
-
-        # Apply image resizing and correct path
-        config['postproc'].append([r'<img (.*?) src="(\d+)-', r'<img \1 width="\2" src="'])
-        config['postproc'].append([r'<img (.*?) src="', r'<img \1 src="media/images/'])
 
     elif type == 'tex':
         # Default values
         config['encoding'] = 'utf8'
         config['toc'] = 0
 
-        # Support math block
-        config['preproc'].append(['<<<', '\'\'\''])
-        config['preproc'].append(['>>>', '\'\'\''])
-        
-        # Remove target comments
-        config['preproc'].append(['%tex% ', ''])
-        config['preproc'].append(['%latex% ', '']) # Alias
-        config['preproc'].append(['%pdf% ', '']) # Alias
-
-        # Allow line breaks, r'\\\\' are 2 \ for regexes
-        #config['preproc'].append([r'\$\\backslash\$\$\\backslash\$', r'\'\'\\\\\'\''])  # F*ck, these are used in Latex :S
-        config['preproc'].append([r'@@', r"''\\newline{}''"]) # F*ck, @@ is used in diffs :S
-
-        ## Support code block
-        #config['preproc'].append(['{{{ (' + '|'.join(supported_languages.keys()) + ')', '\'\'\'\n\\begin{verbatim}'])
-        #config['preproc'].append(['}}}', '\\end{verbatim}\n\'\'\'\n'])
-
-        # Allow subscript superscript
-        config['postproc'].append([r'\\\^{}\\\^{}(.*?)\\\^{}\\\^{}', r'\\superscript{\1}'])
-        config['postproc'].append([r',,(.*?),,', r'\\subscript{\1}'])
-
-        # Apply image resizing
-        config['postproc'].append([r'includegraphics\{(\d+)-', r'includegraphics[width=\1px]{'])
-        config['postproc'].append([r'includegraphics(.*?)\{', r'noindent\includegraphics\1{media/images/'])
+        # Math blocks, target comments, @@ line breaks, ^^sup^^ and ,,sub,,
+        # and the images size and path, see txt2tags.NestedMaster. Code
+        # blocks are done by custom_preproc()
+        config['nested-rules'] = 1
 
     elif type == 'txt':
         # Default values
         config['toc'] = 0
         
-        # Remove target comments
-        config['preproc'].append(['%txt% ', ''])
-        config['preproc'].append(['%text% ', '']) # Alias
-        
-        # Allow line breaks, r'\\\\' are 2 \ for regexes
-        #config['preproc'].append([r'\\\\', '\n']) # F*ck, these are used in Latex :S
-        config['preproc'].append([r'@@', '\n']) # F*ck, @@ is used in diffs :S
-        
-        # Allow subscript superscript
-        config['postproc'].append([r'\^\^(.*?)\^\^', r'\1'])
-        config['postproc'].append([r',,(.*?),,', r'\1'])
+        # Target comments, @@ line breaks and ^^sup^^ and ,,sub,, marks
+        # removal, see txt2tags.NestedMaster
+        config['nested-rules'] = 1
 
     return config
 
 
-def convert(txt, target, headers=None, options=None):
-    """Perform the conversion of a given txt2tags ttext to a specific target."""
+# Tagged output of the body chunks of previous conversions, see convert()
+block_cache = txt2tags.MemoMaster()
+
+def convert(txt, target, headers=None, options=None, incremental=False,
+            outfile=None, stats=None, jobs=0, cache=False):
+    """Perform the conversion of a given txt2tags ttext to a specific target.
+
+    If incremental is True, only the body chunks that changed since the
+    previous conversions are converted again, the others reuse their
+    cached output (see txt2tags.MemoMaster). The result is the same.
+
+    If outfile (a file object) is given, the result is written to it as
+    it's converted, without keeping the whole document in memory, and an
+    empty string is returned. On errors the message is returned.
+
+    If stats (a txt2tags.StatsMaster) is given, the time and calls of each
+    stage and the lines and bytes converted are recorded on it, see
+    stats.get(). The custom_preproc and finish stages are added here.
+
+    If jobs is 2 or more, the inline tagging of the plain text lines of
+    big documents is done in that many processes, the block parse is
+    still serial (see txt2tags.Converter.prerender). The result is the
+    same.
+
+    If cache is True, the parsed lines of the body are saved on disk, so
+    converting it again, even after Nested is restarted, skips the line
+    parsing (see txt2tags.ParseCacheMaster). The result is the same.
+
+    If txt is unicode, all the conversion is done in unicode (the str
+    headers are decoded from UTF-8) and the result is unicode. It's
+    encoded just once, to the document encoding (UTF-8 by default), when
+    it's written to outfile.
+    """
     
     # Here is the marked body text, it must be a list.
+    unicode_mode = isinstance(txt, unicode)
     txt = txt.split('\n')
 
     # Perform custom preproc
-    txt = custom_preproc(txt, target)
+    if stats:
+        txt = stats.call('custom_preproc', custom_preproc, txt, target)
+    else:
+        txt = custom_preproc(txt, target)
 
     # Base configuration
     config = _get_config(target)
@@ -308,6 +314,8 @@ def convert(txt, target, headers=None, options=None):
     # Set the three header fields
     if headers is None:
         headers = ['', '', '']
+    if unicode_mode:
+        headers = [txt2tags.as_unicode(header) for header in headers]
     config['header1'] = headers[0]
     config['header2'] = headers[1]
     config['header3'] = headers[2]
@@ -319,6 +327,8 @@ def convert(txt, target, headers=None, options=None):
         if options.get('postproc'):
             options['postproc'].extend(config['postproc'])
         config.update(options)
+    if cache:
+        config['cache'] = 1
 
     # Check sanity of the configuration
     config = txt2tags.ConfigMaster().sanity(config)
@@ -326,24 +336,61 @@ def convert(txt, target, headers=None, options=None):
     # Let's do the conversion
     try:
         # Convert
-        target_body, marked_toc = txt2tags.convert(txt, config)
+        converter = txt2tags.Converter(config, stats)
+        if jobs > 1 and stats:
+            stats.call('prerender', converter.prerender, txt, jobs)
+        elif jobs > 1:
+            converter.prerender(txt, jobs)
+        memo = None
+        if incremental:
+            memo = block_cache
+        # Stream it
+        if outfile is not None and txt2tags.can_stream(config):
+            outlist = converter.iter_document(txt, headers, memo=memo,
+                                              footer=False)
+            images = {}
+            embedded = txt2tags.getEmbedded(config)
+            encoding = txt2tags.get_output_encoding(config)
+            finished = txt2tags.iter_finish(outlist, config, stats)
+            for i, line in enumerate(finished):
+                if i:
+                    outfile.write('\n')
+                encoded = txt2tags.iter_encoded([line], encoding)
+                outfile.writelines(txt2tags.iter_embedded(encoded, embedded,
+                                                          images))
+                if stats:
+                    stats.count('output_lines', 1)
+                    stats.count('output_bytes', len(line) + bool(i))
+            return ''
+        target_body, marked_toc = converter.convert(txt, memo=memo)
         # Footer
-        #target_foot = txt2tags.doFooter(config)
+        #target_foot = converter.do_footer()
         #target_foot.pop() # Unneded because we use txt2tags as a module
         target_foot = []
         # Table of content
-        tagged_toc = txt2tags.toc_tagger(marked_toc, config)
-        target_toc = txt2tags.toc_formatter(tagged_toc, config)
-        target_body = txt2tags.toc_inside_body(target_body, target_toc, config)
-        if not txt2tags.AUTOTOC and not config['toc-only']:
+        tagged_toc = converter.toc_tagger(marked_toc)
+        target_toc = converter.toc_formatter(tagged_toc)
+        target_body = converter.toc_inside_body(target_body, target_toc)
+        if not converter.autotoc and not config['toc-only']:
             target_toc = []
         # Full body
         config['fullBody'] = target_toc + target_body + target_foot
         # Headers
-        outlist = txt2tags.doHeader(headers, config)
+        outlist = converter.do_header(headers)
         # End document
-        finished  = txt2tags.finish_him(outlist, config)
+        if stats:
+            finished = stats.call('finish', txt2tags.finish_him, outlist,
+                                  config, stats)
+        else:
+            finished = txt2tags.finish_him(outlist, config)
         result = '\n'.join(finished)
+        if stats:
+            stats.count('output_lines', len(finished))
+            stats.count('output_bytes', len(result))
+        if outfile is not None:
+            encoding = txt2tags.get_output_encoding(config)
+            outfile.writelines(txt2tags.iter_encoded([result], encoding))
+            result = ''
 
     # Txt2tags error, show the messsage to the user
     except txt2tags.error, msg:
@@ -811,7 +811,7 @@ pywebkitgtk for Windows: http://code.google.com/p/pywebkitgtk/\
             html = '<html></html>'
             if content:
                 try:
-                    html = export.convert(content, 'xhtmls')
+                    html = export.convert(content, 'xhtmls', incremental=True)
                 except:
                     html = _('<html>Unable to preview. Please check the syntax.</html>')
             self.preview.load_html_string(html, 'file:///')
@@ -1512,6 +1512,17 @@ pywebkitgtk for Windows: http://code.google.com/p/pywebkitgtk/\
         return pixbuf
 
 
+    def is_image(self, path):
+        """Checks the image headers, without reading the whole image"""
+
+        # The headers are cached, and shared with the exports
+        try:
+            info = txt2tags.cached_read(path, txt2tags.probeImage)
+        except Exception:
+            return False
+        return info[0] is not None
+
+
     def process_images(self, images):
         """
         Process images: create thumbnail and send them to the GUI.
@@ -1552,7 +1563,8 @@ pywebkitgtk for Windows: http://code.google.com/p/pywebkitgtk/\
         for filename in files_in_images:
             name, ext = os.path.splitext(filename)
             filename = os.path.join(images_folder, filename)
-            if os.path.isfile(filename) and ext in supported_images:
+            if os.path.isfile(filename) and ext in supported_images \
+               and self.is_image(filename):
                 images.append([filename, name + ext])
         # Load files
         if images:
@@ -1574,7 +1586,7 @@ pywebkitgtk for Windows: http://code.google.com/p/pywebkitgtk/\
             # Load image
             name, ext = os.path.splitext(to_load)
             path = os.path.join(images_folder, to_load)
-            if not os.path.exists(path):
+            if not os.path.exists(path) or not self.is_image(path):
                 logger.error(_('Unable to load image {0}.').format(to_load))
                 return None
             thumbnail = self.thumbnail_image(path)
@@ -3208,7 +3220,10 @@ pywebkitgtk for Windows: http://code.google.com/p/pywebkitgtk/\
             body = processed_sections
 
         # Magic :D :D
-        content = export.convert(''.join(body), target, header, config)
+        # The parse is saved on disk just here, not on each preview: the
+        # previews of an edited document share the in-memory cache
+        content = export.convert(''.join(body), target, header, config,
+                                 incremental=True, cache=True)
 
         if content:
 
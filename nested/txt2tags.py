@@ -23,6 +23,8 @@
 #        - Added hyperfootnotes=false to the tex header so footnotes actually work.
 #        - Added \usepackage[bottom]{footmisc} to the tex header so footnotes work a little better.
 #        - Changed the \maketitle section so it can be modded later.
+#        - Conversion state moved from module globals into a reentrant Converter
+#           object, the old module functions are kept as thin wrappers.
 #####
 #
 ########################################################################
@@ -117,12 +119,18 @@ import sys
 import time  # %%date, %%mtime
 import getopt
 import textwrap
-import csv
+import itertools
 import string
 import struct
+import marshal    # spooling of streamed lines, --cache files
+import sre_parse  # literal triggers of the filters
+import threading  # one active Converter per thread
 import unicodedata
 # import urllib  # read remote files (URLs) -- postponed, see issue 96
 # import email  # %%mtime for remote files -- postponed, see issue 96
+# Imported on first use, most runs don't need them and they're slow to
+# import: csv (%!csv), hashlib (--cache), multiprocessing (--jobs),
+# tempfile (output spooling, --jobs) and Tkinter (--gui)
 
 
 # Program information
@@ -180,6 +188,7 @@ FLAGS = {
     'web': 0,
     'fix-path': 0,
     'embed-images': 0,
+    'cache': 0,
     }
 OPTIONS = {
     'target': '',
@@ -195,6 +204,7 @@ OPTIONS = {
     'width': 0,
     'height': 0,
     'chars': '',
+    'jobs': 0,
     'show-config-value': '',
     'template': '',
     'dirname': '',  # internal use only
@@ -311,7 +321,6 @@ DEBUG = 0     # do not edit here, please use --debug
 VERBOSE = 0   # do not edit here, please use -v, -vv or -vvv
 QUIET = 0     # do not edit here, please use --quiet
 GUI = 0       # do not edit here, please use --gui
-AUTOTOC = 1   # do not edit here, please use --no-toc or %%toc
 
 DFT_TEXT_WIDTH   = 72  # do not edit here, please use --width
 DFT_SLIDE_WIDTH  = 80  # do not edit here, please use --width
@@ -321,9 +330,6 @@ DFT_SLIDE_HEIGHT = 25  # do not edit here, please use --height
 AA_KEYS = 'corner border side bar1 bar2 level2 level3 level4 level5 bullet hhead vhead'.split()
 AA_VALUES = '+-|-==-^"-=$'  # do not edit here, please use --chars
 AA = dict(zip(AA_KEYS, AA_VALUES))
-AA_COUNT = 0
-AA_TITLE = ''
-AA_MARKS = []
 AA_QA = """       ________
    /#**TXT2TAGS**#\\
  /#####/      \####CC\\
@@ -350,12 +356,6 @@ RST = dict(zip(RST_KEYS, RST_VALUES))
 
 RC_RAW = []
 CMDLINE_RAW = []
-CONF = {}
-BLOCK = None
-TITLE = None
-regex = {}
-TAGS = {}
-rules = {}
 
 # Gui globals
 askopenfilename = None
@@ -364,7 +364,6 @@ showwarning = None
 showerror = None
 
 lang = 'english'
-TARGET = ''
 
 STDIN = STDOUT = '-'
 MODULEIN = MODULEOUT = '-module-'
@@ -376,6 +375,23 @@ LINEBREAK = {'default': '\n', 'win': '\r\n', 'mac': '\r'}
 # Platform specific settings
 LB = LINEBREAK.get(sys.platform[:3]) or LINEBREAK['default']
 
+# Streaming: tagged lines held in memory before handing them over
+STREAM_BUFFER = 1000
+
+# Inline tagging in parallel processes (see Converter.prerender): bodies
+# with less than PRERENDER_MIN_LINES lines are tagged serially, the others
+# are sent to the processes in batches of PRERENDER_BATCH lines
+PRERENDER_MIN_LINES = 5000
+PRERENDER_BATCH = 1000
+
+# Embedded images: their data is read in chunks at writing time, and the
+# images up to EMBED_CACHE_SIZE bytes are encoded only once per document.
+# The marks have a random nonce of the conversion and the index of the
+# image path on the Converter, so no text can forge one (see getEmbedded)
+EMBED_MARK = 'vvvEMBED'
+EMBED_BUFFER = 65536
+EMBED_CACHE_SIZE = 262144
+
 VERSIONSTR = _("%s version %s <%s>") % (my_name, my_version, my_url)
 
 
@@ -414,6 +430,8 @@ def Usage():
         fmt2 % ('-C', '--config-file=F', _("read configuration from file F")),
         fmt1 % (''  , '--fix-path'     , _("fix resources path (image, links, CSS) when needed")),
         fmt1 % (''  , '--gui'          , _("invoke Graphical Tk Interface")),
+        fmt1 % (''  , '--jobs=N'       , _("convert N input files at a time, in parallel processes")),
+        fmt1 % (''  , '--cache'        , _("save the parsed lines on ~/.nested/cache for faster reconversions")),
         fmt2 % ('-q', '--quiet'        , _("quiet mode, suppress all output (except errors)")),
         fmt2 % ('-v', '--verbose'      , _("print informative messages during conversion")),
         fmt2 % ('-h', '--help'         , _("print this help information and exit")),
@@ -937,7 +955,7 @@ r"""{\rtf1\ansi\ansicpg1252\deff0
 ##############################################################################
 
 
-def getTags(config):
+def getTags(config, rules=None):
     "Returns all the known tags for the specified target"
 
     keys = """
@@ -2272,6 +2290,7 @@ def getTags(config):
         tags[key] = maskEscapeChar(target_tags[key])  # populate
 
     # Map strong line to pagebreak
+    rules = rules or getRules(config)
     if rules['mapbar2pagebreak'] and tags['pageBreak']:
         tags['bar2'] = tags['pageBreak']
 
@@ -2995,6 +3014,11 @@ def getRegexes():
         re.compile(r'""([^\s](|.*?[^\s])"*)""'),
     'tagged':
         re.compile(r"''([^\s](|.*?[^\s])'*)''"),
+    # the three above, joined to find the leftmost of them in one search
+    'protected':
+        re.compile(r"''(?P<tagged>[^\s](|.*?[^\s])'*)''|"
+                   r'""(?P<raw>[^\s](|.*?[^\s])"*)""|'
+                   r'``(?P<mono>[^\s](|.*?[^\s])`*)``'),
     'fontBold':
         re.compile(r'\*\*([^\s](|.*?[^\s])\**)\*\*'),
     'fontItalic':
@@ -3011,6 +3035,8 @@ def getRegexes():
         re.compile(r'^( *)(:) (.*)$'),
     'listclose':
         re.compile(r'^( *)([-+:])\s*$'),
+    'listitem':
+        re.compile(r'^( *)([-+:]) '),
     'bar':
         re.compile(r'^(\s*)([_=-]{20,})\s*$'),
     'table':
@@ -3101,7 +3127,7 @@ def getRegexes():
     bank['email'] = re.compile(patt_email, re.I)
 
     # email | url
-    bank['link'] = re.compile(r'%s|%s' % (retxt_url, patt_email), re.I)
+    bank['link'] = LinkMaster(urlskel, r'%s|%s' % (retxt_url, patt_email))
 
     # \[ label | imagetag    url | email | filename \]
     bank['linkmark'] = re.compile(
@@ -3117,6 +3143,550 @@ def getRegexes():
     return bank
 ### END OF regex nightmares
 
+
+# The beautifiers, in the order they're applied, and their marks
+BEAUTIFIERS = (('bold', '**'), ('italic', '//'), ('underline', '__'),
+               ('strike', '--'))
+
+
+def may_have_link(line):
+    "Cheap test to skip the link regexes on lines that can't have links"
+    if '[' in line or '@' in line or '://' in line:
+        return True
+    line = line.lower()
+    return 'www' in line or 'ftp.' in line
+
+
+# The parsing is split in two stages. The parse stage finds out what each
+# line is (the block marks it matches) and the protected structures in it
+# (tagged, raw and verbatim marks, macros, the TOC and the links), masking
+# them. Nothing there depends on the target, so each line is parsed only
+# once and the results are shared by all the converters: converting the
+# same text to several targets costs one parse. The render stage is the
+# Converter: it opens and closes the target blocks following the parsed
+# line kinds, and MaskMaster.mask() fills the target banks from the
+# parsed spans (escaping, relative paths).
+
+PARSE_CACHE = {}
+PARSE_CACHE_SIZE = 200000
+
+# The block marks tested on the lines outside comment/tagged/raw/verb
+LINE_KINDS = ('blockCommentOpen', 'blockTaggedOpen', '1lineTagged',
+              'blockRawOpen', '1lineRaw', 'blockVerbOpen', '1lineVerb',
+              'blankline', 'special', 'comment', 'bar', 'title', 'numtitle',
+              'toc', 'quote', 'list', 'numlist', 'deflist', 'table')
+NO_KINDS = frozenset()
+
+# The LINE_KINDS that may match a line, by the first char after its indent
+# spaces. The block marks only match at the line start, so the indented
+# lines try just the ones allowing spaces before them. Most lines start
+# with a letter and try none.
+INDENTED_KINDS = {
+    '': ('blankline',),
+    '-': ('list', 'bar'), '+': ('numlist', 'numtitle'), ':': ('deflist',),
+    '|': ('table',), '=': ('title', 'bar'), '_': ('bar',), '%': ('toc',),
+}
+# The other \s chars, on whitespace-only lines and bars
+INDENTED_KINDS.update(dict.fromkeys('\t\n\r\f\v', ('blankline', 'bar')))
+FIRST_KINDS = INDENTED_KINDS.copy()
+FIRST_KINDS.update({
+    '%': ('blockCommentOpen', 'special', 'comment', 'toc'),
+    "'": ('blockTaggedOpen', '1lineTagged'),
+    '"': ('blockRawOpen', '1lineRaw'),
+    '`': ('blockVerbOpen', '1lineVerb'),
+    '\t': ('quote', 'blankline', 'bar'),
+})
+
+LINKMASK = 'vvvLINKvvv'
+MONOMASK = 'vvvMONOvvv'
+MACROMASK = 'vvvMACROvvv'
+RAWMASK = 'vvvRAWvvv'
+TAGGEDMASK = 'vvvTAGGEDvvv'
+TOCMASK = 'vvvTOCvvv'
+
+
+def cache_parse(cache, key, parsed):
+    if len(cache) >= PARSE_CACHE_SIZE:
+        cache.clear()
+    cache[key] = parsed
+
+
+def parseLine(line, regex, cache=PARSE_CACHE):
+    "Returns the set of LINE_KINDS matching the line, parsed only once"
+    key = ('line', line)
+    kinds = cache.get(key)
+    if kinds is None:
+        if line[:1] == ' ':
+            candidates = INDENTED_KINDS.get(line.lstrip(' ')[:1])
+        else:
+            candidates = FIRST_KINDS.get(line[:1])
+        kinds = NO_KINDS
+        if candidates:
+            kinds = frozenset([kind for kind in candidates
+                               if regex[kind].search(line)])
+        cache_parse(cache, key, kinds)
+    return kinds
+
+
+def parseInline(line, regex, cache=PARSE_CACHE):
+    """Returns the (masked line, spans) of the line, parsed only once
+
+    The spans are the (kind, data) of the masked structures, in the order
+    they were found. The kinds are tagged, raw, mono, macro and toc, with
+    the marked text as data, and link, with (label, link, named) as data.
+    """
+    # 'a' == u'a', but the spans must keep the type of the line
+    key = ('inline', isinstance(line, unicode), line)
+    parsed = cache.get(key)
+    if parsed is None:
+        parsed = parse_inline(line, regex)
+        cache_parse(cache, key, parsed)
+    return parsed
+
+
+# With --cache, the parsed lines of each document body are also saved to
+# disk, so converting it again (even to another target) skips the parse
+# stage. The file name has the hash of the body contents and the cache
+# version, to be raised whenever the parse results change. Each edit of
+# a document makes a new file, so the least recently used ones are removed
+# when all of them take more than PARSE_CACHE_DIR_SIZE bytes, and the ones
+# not used in PARSE_CACHE_AGE seconds.
+
+PARSE_CACHE_DIR = os.path.join('~', '.nested', 'cache')
+PARSE_CACHE_VERSION = 1
+PARSE_CACHE_DIR_SIZE = 32 * 1024 * 1024
+PARSE_CACHE_AGE = 30 * 24 * 60 * 60
+
+
+def getParseCacheFile(lines, cache_dir=PARSE_CACHE_DIR):
+    "Returns the path of the on-disk parse cache of the body lines"
+    import hashlib
+    digest = hashlib.sha1()
+    for line in lines:
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        digest.update(line)
+        digest.update('\n')
+    name = 'parse-%d-%s' % (PARSE_CACHE_VERSION, digest.hexdigest())
+    return os.path.join(os.path.expanduser(cache_dir), name)
+
+
+def loadParseCache(path):
+    "Returns the parse cache saved at path, or an empty one"
+    try:
+        f = open(path, 'rb')
+        try:
+            cache = marshal.load(f)
+        finally:
+            f.close()
+    except IOError:
+        return {}
+    except (EOFError, ValueError, TypeError):
+        Debug('Ignoring the broken parse cache: %s' % path, 1)
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    try:
+        os.utime(path, None)  # recently used, see pruneParseCache()
+    except OSError:
+        pass
+    Debug('Loaded %d parsed lines from: %s' % (len(cache), path), 1)
+    return cache
+
+
+def saveParseCache(path, cache):
+    "Saves the parse cache to path. It's just a cache, errors are ignored"
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump(cache, f)
+        finally:
+            f.close()
+        if os.path.exists(path):  # no replacing rename on Windows
+            os.remove(path)
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        Debug('Unable to save the parse cache: %s' % e, 1)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    pruneParseCache(cache_dir)
+
+
+def pruneParseCache(cache_dir, size=PARSE_CACHE_DIR_SIZE, age=PARSE_CACHE_AGE):
+    "Removes the old and the least recently used parse cache files"
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    files = []
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        if name.startswith('parse-'):
+            files.append((info.st_mtime, info.st_size, path))
+    files.sort(reverse=True)
+    oldest = time.time() - age
+    total = 0
+    for mtime, filesize, path in files:
+        total += filesize
+        if (total <= size or total == filesize) and mtime >= oldest:
+            continue  # the newest one is always kept
+        if path.endswith('.tmp') and mtime >= oldest:
+            continue  # still being saved
+        try:
+            os.remove(path)
+            Debug('Removed the old parse cache: %s' % path, 1)
+        except OSError:
+            pass
+
+
+class ParseCacheMaster(dict):
+    """
+    The parsed lines of a document body, saved on disk (--cache)
+
+    It's loaded from the file of the body. The lines missing on it are
+    looked up in the shared cache (see parseLine()) and the new ones go to
+    both, so the file of an edited body gets the lines of its old version.
+    """
+    def __init__(self, path, shared=PARSE_CACHE):
+        dict.__init__(self, loadParseCache(path))
+        self.path = path
+        self.shared = shared
+        self.changed = False
+
+    def get(self, key, default=None):
+        parsed = dict.get(self, key)
+        if parsed is None:
+            parsed = self.shared.get(key)
+            if parsed is None:
+                return default
+            dict.__setitem__(self, key, parsed)
+            self.changed = True
+        return parsed
+
+    def __setitem__(self, key, parsed):
+        dict.__setitem__(self, key, parsed)
+        self.changed = True
+        cache_parse(self.shared, key, parsed)
+
+    def save(self):
+        "Saves the parsed lines, if any were added"
+        if self.changed:
+            saveParseCache(self.path, dict(self))
+            self.changed = False
+
+
+def parse_inline(line, regex):
+    "The parse stage of parseInline(), with no cache"
+    spans = []
+
+    # The verbatim, raw and tagged inline marks are mutually exclusive.
+    # This means that one can't appear inside the other.
+    # If found, the inner marks must be ignored.
+    # Example: ``foo ""bar"" ''baz''``
+    # In HTML: <code>foo ""bar"" ''baz''</code>
+    #
+    # The trick here is to protect the mark who appears first on the line.
+    # The 'protected' regex joins the three marks, so the leftmost one
+    # wins. The masks have no mark chars, so after a match we just go
+    # on scanning from its end: one left-to-right pass on the line.
+    #
+    if "''" in line or '""' in line or '``' in line:
+        masks = {'tagged': TAGGEDMASK, 'raw': RAWMASK, 'mono': MONOMASK}
+        parts = []
+        pos = 0
+        for m in regex['protected'].finditer(line):
+            kind = m.lastgroup
+            spans.append((kind, m.group(kind)))
+            parts.append(line[pos:m.start()])
+            parts.append(masks[kind])
+            pos = m.end()
+        if parts:
+            parts.append(line[pos:])
+            line = ''.join(parts)
+
+    # Protect macros
+    if '%%' in line:
+        parts = []
+        pos = 0
+        for m in regex['macros'].finditer(line):
+            spans.append(('macro', m.group()))
+            parts.append(line[pos:m.start()])
+            parts.append(MACROMASK)
+            pos = m.end()
+        if parts:
+            parts.append(line[pos:])
+            line = ''.join(parts)
+
+        # Protect TOC location
+        if regex['toc'].search(line):
+            line = regex['toc'].sub(TOCMASK, line)
+            spans.append(('toc', ''))
+
+    # Protect URLs and emails
+    if may_have_link(line):
+        line = parse_links(line, regex, spans)
+    return line, tuple(spans)
+
+
+def first_link(match_link, match_named):
+    "Returns the leftmost link match, the plain one if both start together"
+    if match_link and match_named:
+        # Both types found, which is the first?
+        if match_named.start() < match_link.start():
+            return match_named
+        return match_link
+    # Just one type found, we're fine
+    return match_link or match_named
+
+
+def link_back(line, start):
+    """
+    Returns where a link made with the mask at start may begin
+
+    The mask letters may complete a new link that begins before it,
+    as in www.[label url] or me.[label url]@mail.com. Plain links have
+    no spaces, so they begin after the last space. Named links have
+    at most one ']' (the image label) before the mask, so they begin
+    after the ']' before it, or after the last space if there's none
+    (a longer label is taken back from the parts, see label_end()).
+    It's always right after a space, as the later masks can't join the
+    words across it.
+    """
+    back = start
+    close = line.rfind(']', 0, start)
+    if close >= 0:
+        back = line.rfind(']', 0, close) + 1
+    return line.rfind(' ', 0, back) + 1
+
+
+def label_end(head, line, pos):
+    """
+    Returns the end of a label begun before head, as a named link
+
+    A label can't have a ']', so it ends at the next one, and its link is
+    the word there. Just that word is returned, after a dummy label.
+    """
+    close = line.find(']', pos)
+    if close < 0:
+        return ''
+    space = line.rfind(' ', pos, close)
+    if space >= 0:
+        word = line[space + 1:close]
+    else:
+        word = head[head.rfind(' ') + 1:] + line[pos:close]
+    end = line.find(' ', close)
+    if end < 0:
+        end = len(line)
+    return '[label ' + word + line[close:end]
+
+
+def parse_links(line, regex, spans):
+    """
+    Masks the URLs and emails, the leftmost (plain or named) first
+
+    The links are searched in the line as is, so their matches keep
+    good until the search goes past them, and the masked line is
+    joined from its parts at the end. The links made with the mask
+    letters end before the next space, or before the space after the
+    next ']' for a mask in a label (the URL may have a ']'), so just
+    the masked text from where they may begin (see link_back()) to
+    there is searched again, with the char before it for the word
+    boundaries. A label open in the parts is taken back when the mask
+    may end it, as in [label www.me.com #me@mail.com].
+    """
+    link_re = regex['link']
+    named_re = regex['linkmark']
+    parts = ['']     # the masked line, done
+    head = ''        # the masked text after the parts, ends with a mask
+    pos = 0          # the line from here is not masked yet
+    plain_pos = 0    # the plain links just after the mask are in head
+    opened = None    # the part and index of the '[' not closed in them
+    spanned = False  # the last mask may end a label begun in the parts
+    match_link = match_named = None
+    link_pos = named_pos = -1  # where the matches were searched from
+    while True:
+
+        # A label done with the last mask? Its '[' is in the parts
+        if spanned and opened and ']' not in head and \
+                named_re.match(label_end(head, line, pos)):
+            i, start = opened
+            start = parts[i].rfind(' ', 0, start) + 1
+            head = parts[i][start:] + ''.join(parts[i + 1:]) + head
+            parts[i:] = [parts[i][:start]]
+            opened = None
+
+        # A link with the last mask?
+        if head:
+            space = line.find(' ', pos)
+            if space < 0:
+                space = len(line)
+            if head.rfind('[') > head.rfind(']'):  # a label with the mask?
+                close = line.find(' ', line.find(']', pos) + 1)
+                if close < 0:
+                    close = len(line)
+                space = max(space, close)
+            window = parts[-1][-1:] + head + line[pos:space]
+            skip = len(window) - len(head) - (space - pos)
+            plain = link_re.search(window, skip)
+            m = first_link(plain, named_re.search(window, skip))
+            if m and m.start() <= skip + len(head):
+                add_link_span(m, m is plain, spans)
+                spanned = ']' in m.group() or \
+                    line.find(']', pos, space) >= 0
+                end = m.end() - skip
+                rest = head[end:]
+                if end >= len(head):
+                    pos += end - len(head)
+                    rest = ''
+                head = window[skip:m.start()] + LINKMASK + rest
+                plain_pos = pos + 1
+                continue
+
+        # Try to match plain or named links
+        if link_pos < 0 or (match_link and match_link.start() < plain_pos):
+            match_link = link_re.search(line, plain_pos)
+            link_pos = plain_pos
+        if named_pos < 0 or (match_named and match_named.start() < pos):
+            match_named = named_re.search(line, pos)
+            named_pos = pos
+
+        # Define the current match
+        m = first_link(match_link, match_named)
+        if not m:
+            break
+
+        # Extract link data and apply mask
+        add_link_span(m, m is match_link, spans)
+        head += line[pos:m.start()]
+        space = line.find(' ', m.end())
+        if space < 0:
+            space = len(line)
+        spanned = line.find(']', m.end(), space) >= 0 or ']' in m.group()
+        back = link_back(head, len(head))
+        part = head[:back]
+        close = part.rfind(']')
+        start = part.find('[', close + 1)
+        if close >= 0:
+            opened = None
+        if start >= 0 and not opened:
+            opened = (len(parts), start)
+        parts.append(part)
+        head = head[back:] + LINKMASK
+        pos = m.end()
+        plain_pos = pos + 1
+    parts.append(head)
+    parts.append(line[pos:])
+    return ''.join(parts)
+
+
+def add_link_span(m, plain, spans):
+    "Saves the link data of the match to the spans"
+    if plain:
+        spans.append(('link', ('', m.group(), False)))
+    else:
+        label = m.group('label').rstrip()
+        spans.append(('link', (label, m.group('link'), True)))
+
+
+##############################################################################
+
+# Building the rules, tags and regexes tables is expensive (a huge dict
+# per target and dozens of re.compile calls), so they're built once per
+# target setup and reused. The key is the target plus all the config
+# keys that change the tables. If you change HEADER_TEMPLATE or any of
+# the tables at runtime, call clearTargetCache().
+
+TARGET_CACHE_KEYS = ['target', 'css-sugar', 'slides', 'web', 'width',
+                     'chars', 'embed-images']
+TARGET_CACHE = {}
+TARGET_CACHE_LOCK = threading.Lock()
+
+
+def getTargetCacheKey(config):
+    key = [config.get(k) for k in TARGET_CACHE_KEYS]
+    # getTags() also reads these globals
+    key.append(HTML_LOWER)
+    key.append(tuple(sorted(AA.items())))
+    return tuple(key)
+
+
+def getCachedRegexes():
+    "Returns a copy of the shared regexes bank, built only once"
+    bank = TARGET_CACHE.get('regexes')
+    if bank is None:
+        bank = getRegexes()
+        TARGET_CACHE_LOCK.acquire()
+        try:
+            bank = TARGET_CACHE.setdefault('regexes', bank)
+        finally:
+            TARGET_CACHE_LOCK.release()
+    return bank.copy()
+
+
+def getTargetSetup(config):
+    "Returns cached (rules, tags, regexes) copies for the config target"
+    key = ('setup',) + getTargetCacheKey(config)
+    setup = TARGET_CACHE.get(key)
+    if setup is None:
+        rules = getRules(config)
+        tags = getTags(config, rules)
+        TARGET_CACHE_LOCK.acquire()
+        try:
+            setup = TARGET_CACHE.setdefault(key, (rules, tags))
+        finally:
+            TARGET_CACHE_LOCK.release()
+    rules, tags = setup
+    # Copies, so a caller changing its tables won't spoil the cache
+    return rules.copy(), tags.copy(), getCachedRegexes()
+
+
+def getHeaderTemplate(config, tags):
+    "Returns the default header template lines, cached per target"
+    target = config['target']
+    css = target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-sugar')
+    key = ('template', target, bool(css), tags['EOD'])
+    template = TARGET_CACHE.get(key)
+    if template is None:
+        if css:
+            template = HEADER_TEMPLATE[target + 'css'].split('\n')
+        else:
+            template = HEADER_TEMPLATE[target].split('\n')
+
+        template.append('%(BODY)s')
+
+        if tags['EOD']:
+            template.append(tags['EOD'].replace('%', '%%'))  # escape % chars
+        TARGET_CACHE[key] = template
+    return template[:]
+
+
+def getEscaper(target, rules):
+    "Returns the shared EscapeMaster for the target"
+    key = ('escaper', target, rules['escapexmlchars'])
+    escaper = TARGET_CACHE.get(key)
+    if escaper is None:
+        escaper = TARGET_CACHE.setdefault(key, EscapeMaster(target, rules))
+    return escaper
+
+
+def clearTargetCache():
+    "Forgets the cached rules, tags, regexes, templates, escapers and lines"
+    TARGET_CACHE_LOCK.acquire()
+    try:
+        TARGET_CACHE.clear()
+        PARSE_CACHE.clear()
+    finally:
+        TARGET_CACHE_LOCK.release()
+
 ################# functions for the ASCII Art backend ########################
 
 
@@ -3126,7 +3696,7 @@ def aa_line(char, width):
 
 def aa_under(txt, char, width, over):
     ret = []
-    txt = txt.decode('utf-8')
+    txt = as_unicode(txt)
     if over:
         ret.append(aa_line(char, aa_len_cjk(txt)))
     for line in textwrap.wrap(txt, width):
@@ -3137,7 +3707,7 @@ def aa_under(txt, char, width, over):
 def aa_box(txt, chars, width, centred=True):
     wrap_txt = []
     for line in txt:
-        wrap_txt.extend(el for el in textwrap.wrap(line.decode('utf-8'), width - 4))
+        wrap_txt.extend(el for el in textwrap.wrap(as_unicode(line), width - 4))
     len_cjk = max([aa_len_cjk(line) for line in wrap_txt])
     line_box = aa_center(chars['corner'] + chars['border'] * (len_cjk + 2) + chars['corner'], width)
     line_txt = []
@@ -3164,7 +3734,7 @@ def aa_header(header_data, chars, width, n, end):
 def aa_slide(title, char, width):
     res = [aa_line(char, width)]
     res.append('')
-    res.append(aa_center(title.decode('utf-8'), width)[:width])
+    res.append(aa_center(as_unicode(title), width)[:width])
     res.append('')
     res.append(aa_line(char, width))
     return res
@@ -3179,7 +3749,7 @@ def aa_table(table, chars, width, border, h_header, v_header, align, spread):
                 except:
                     row['cells'][i] = 'Error'
             else:
-                row['cells'][i] = row['cells'][i].decode('utf-8') 
+                row['cells'][i] = as_unicode(row['cells'][i])
     data = [[row['cells'], row['cellspan']] for row in table]
     n = max([len(line[0]) for line in data])
     data2 = []
@@ -3188,22 +3758,18 @@ def aa_table(table, chars, width, border, h_header, v_header, align, spread):
             data2.append([n * [''], n * [1]])
         else:
             data2.append([line[0] + (n - sum(line[1])) * [''], line[1] + (n - sum(line[1])) * [1]])
-    data3 = []
+    # Column widths, in a single pass: each cell is measured once, the
+    # spanned cells don't count
+    length = n * [0]
+    sizes = []
     for line in data2:
-        if  max(line[1]) == 1:
-            data3.append(line[0])
-        else:
-            newline = []
-            for i, el in enumerate(line[0]):
-                if line[1][i] == 1:
-                    newline.append(el)
-                else:
-                    newline.extend(line[1][i] * [''])
-            data3.append(newline)
-    tab = []
-    for i in range(n):
-        tab.append([line[i] for line in data3])
-    length = [max([aa_len_cjk(el) for el in line]) for line in tab]
+        size = map(aa_len_cjk, line[0])
+        sizes.append(size)
+        col = 0
+        for i, span in enumerate(line[1]):
+            if span == 1 and col < n and size[i] > length[col]:
+                length[col] = size[i]
+            col += span
     if spread:
         if n > 26:
             Error(_("aas target doesn't support table with more than 26 columns."))        
@@ -3212,6 +3778,7 @@ def aa_table(table, chars, width, border, h_header, v_header, align, spread):
         data2 = [[[str(i)] + line[0], [1] + line[1]] for i, line in enumerate(data2)]
         data2[0][0][0] = ''
         length, n = [max([len(line[0][0]) for line in data2])] + length, n + 1
+        sizes = [map(aa_len_cjk, line[0]) for line in data2]
     bord, side, corner, vhead = chars['border'], chars['side'], chars['corner'], chars['vhead']
     if border:
         hhead = chars['hhead']
@@ -3230,7 +3797,7 @@ def aa_table(table, chars, width, border, h_header, v_header, align, spread):
             if i == 0 or border:
                 ret.append(res)
         for j, el in enumerate(line[0]):
-            aff = aff + " " + el + (sum(length[j:(j + line[1][j])]) + line[1][j] * 3 - aa_len_cjk(el) - 2) * " " + side
+            aff = aff + " " + el + (sum(length[j:(j + line[1][j])]) + line[1][j] * 3 - sizes[i][j] - 2) * " " + side
             if j == 0 and v_header:
                 aff = aff[:-1] + vhead
         ret.append(aff)
@@ -3246,13 +3813,53 @@ def aa_image(image):
     art_table = '#$!;:,. '
     art_image = []
     for line in image:
-        art_line = ''
-        for pixel in line:
-            art_line = art_line + art_table[pixel/32]
+        art_line = ''.join([art_table[pixel / 32] for pixel in line])
         art_image.append(art_line)
     return art_image
 
 
+def aa_png_pixels(decomp, width, colour_type):
+    """Returns the rows of luma values of the decompressed PNG data
+
+    Uses NumPy when available, it's a lot faster for big images.
+    """
+    n_byte = n_byte_alpha = (colour_type % 4 + 1)
+    if colour_type in [4, 6]:
+        n_byte_alpha = n_byte + 1
+    end_line = n_byte_alpha * width + 1
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    # Each scanline is a filter type byte and the pixels
+    if numpy and decomp and len(decomp) % end_line == 0:
+        rows = numpy.frombuffer(decomp, numpy.uint8).reshape(-1, end_line)
+        pixels = rows[:, 1:].reshape(len(rows), width, n_byte_alpha)
+        if n_byte == 1:
+            return pixels[:, :, 0].tolist()
+        R, G, B = [pixels[:, :, i].astype(numpy.float64) for i in range(3)]
+        # ITU-R 601-2 luma transform
+        L = 0.299 * R + 0.587 * G + 0.114 * B
+        return L.astype(numpy.int32).tolist()
+
+    image = []
+    unpack = struct.Struct('!BBB').unpack
+    for start in xrange(0, len(decomp), end_line):
+        line = decomp[start + 1:start + end_line]
+        if n_byte == 1:
+            line_img = map(ord, line[::n_byte_alpha])
+        else:
+            line_img = []
+            for i in xrange(0, len(line), n_byte_alpha):
+                R, G, B = unpack(line[i:i + n_byte])
+                # ITU-R 601-2 luma transform
+                line_img.append(int(0.299 * R + 0.587 * G + 0.114 * B))
+        image.append(line_img)
+    return image
+
+
 def aa_webwrap(txt, width):
     txt = re.split('(<a href=.*?>)|(</a>)|(<img src=.*?>)', txt)
     line, length, ret = '', 0, []
@@ -3392,34 +3999,66 @@ def Readfile(file_path, remove_linebreaks=0, ignore_error=0):
                 Error(_("Cannot read file:") + ' ' + file_path)
 
     if remove_linebreaks:
-        data = map(lambda x: re.sub('[\n\r]+$', '', x), data)
+        data = [line.rstrip('\n\r') for line in data]
 
     Message(_("File read (%d lines): %s") % (len(data), file_path), 2)
     return data
 
 
-def Savefile(file_path, contents):
+def Openfile(file_path):
+    """
+    Returns the lines of the file as an iterable, read as they are used
+
+    A local file is returned open, so a big one is never held in memory
+    all at once. STDIN and URLs are read by Readfile().
+    """
+    if file_path == STDIN or PathMaster().is_url(file_path):
+        return Readfile(file_path)
+    try:
+        return open(file_path)
+    except:
+        Error(_("Cannot read file:") + ' ' + file_path)
+
+
+def as_unicode(txt):
+    "Returns the text as unicode, a str is decoded from UTF-8"
+    if isinstance(txt, unicode):
+        return txt
+    return txt.decode('utf-8')
+
+
+def get_output_encoding(config):
+    "Returns the encoding of the unicode output lines, see iter_encoded()"
+    if config['target'] == 'mgp':
+        return 'latin1'
+    return config['encoding'] or 'utf-8'
+
+
+def iter_encoded(lines, encoding, target=''):
+    """
+    Yields the output lines, the unicode ones encoded
+
+    The unicode lines (unicode input, or the aat target) are encoded
+    just once, here as they're written, the str lines are left as is.
+    But for mgp, MagicPoint is latin1 only, so the UTF-8 str lines are
+    decoded and encoded too.
+    """
+    for line in lines:
+        if target == 'mgp':
+            line = as_unicode(line)
+        if isinstance(line, unicode):
+            line = line.encode(encoding, 'replace')
+        yield line
+
+
+def Savefile(file_path, contents, target='', encoding='utf-8'):
     try:
         f = open(file_path, 'wb')
     except:
         Error(_("Cannot open file for writing:") + ' ' + file_path)
-    if type(contents) == type([]):
-        doit = f.writelines
-    else:
-        doit = f.write
-    cont = []
-    if CONF['target'] in ('aat', 'rst'):
-        for line in contents:
-            if not isinstance(line, str):
-                cont.append(line.encode('utf-8'))
-            else:
-                cont.append(line)
-    elif CONF['target'] == 'mgp':
-        for line in contents:
-            cont.append(line.decode('utf-8').encode('latin1', 'replace'))
-    else:
-        cont = contents
-    doit(cont)
+    if not hasattr(contents, '__iter__'):  # a single string
+        contents = [contents]
+    f.writelines(iter_encoded(contents, encoding, target))
     f.close()
 
 
@@ -3825,7 +4464,7 @@ class SourceDocument:
         if not buf[1].strip():                    # no header
             ref[0] = 0
             ref[1] = 2
-        rgx = getRegexes()
+        rgx = getCachedRegexes()
         on_comment_block = 0
         for i in xrange(ref[1], len(buf)):         # find body init:
             # Handle comment blocks inside config area
@@ -3936,7 +4575,7 @@ class ConfigMaster:
         self.defaults     = self._get_defaults()
         self.off          = self._get_off()
         self.incremental  = ['verbose']
-        self.numeric      = ['toc-level', 'split', 'width', 'height']
+        self.numeric      = ['toc-level', 'split', 'width', 'height', 'jobs']
         self.multi        = ['infile', 'preproc', 'postproc', 'postvoodoo', 'options', 'style', 'stylepath']
 
     def _get_defaults(self):
@@ -4272,7 +4911,7 @@ class ConfigLines:
         if not filename:
             return []
         errormsg = _("Invalid CONFIG line on %s") + "\n%03d:%s"
-        lines = Readfile(filename, remove_linebreaks=1)
+        lines = cached_read(filename, Readfile, 1)  # remove linebreaks
         # Sanity: try to find invalid config lines
         for i in xrange(len(lines)):
             line = lines[i].rstrip()
@@ -4414,16 +5053,309 @@ class ConfigLines:
 
 ##############################################################################
 
+class EscapeMaster:
+    """Target-specific special chars escaping
+
+    Each target's escapes are joined in a single regex, so a line is
+    escaped in one pass, with the replacements picked by the group that
+    matched. Build it with getEscaper(), it is shared by all the
+    conversions to the same target.
+    """
+    def __init__(self, target, rules):
+        self.target = target
+        escapes = {}  # special: escaped, anywhere on the line
+        finals  = {}  # the same, for the last escapes of each line
+        firsts  = {}  # the same, for the first char of the line only
+
+        if rules['escapexmlchars']:
+            escapes['&'] = '&amp;'
+            escapes['<'] = '&lt;'
+            escapes['>'] = '&gt;'
+
+        if target == 'sgml':
+            escapes['\xff'] = '&yuml;'                         # "+y
+            finals['['] = '&lsqb;'
+        elif target == 'pm6':
+            escapes['<'] = r'<\#60>'
+            finals[ESCCHAR + '<'] = r'<\#92><'
+        elif target == 'mgp':
+            firsts['%'] = ' %'                  # leading blank to avoid parse
+        elif target == 'man':
+            firsts['.'] = r'\&.'                               # command ID
+            firsts["'"] = r"\&'"
+            escapes[ESCCHAR] = ESCCHAR + 'e'                   # \e
+            # TODO man: where - really needs to be escaped?
+            finals['-'] = r'\-'
+        elif target == 'lout':
+            # TIP: / is a final escape to avoid //italic//
+            # TIP: these are also converted by lout:  ...  ---  --
+            escapes[ESCCHAR] = '"%s"' % (ESCCHAR * 2)          # "\\"
+            escapes['"'] = '"%s""' % ESCCHAR                   # "\""
+            for char in '|&{}@#^~':
+                escapes[char] = '"%s"' % char                  # "@"
+            finals['/'] = '"/"'
+        elif target == 'tex':
+            # Literal \ turns to $\backslash$
+            escapes[ESCCHAR] = maskEscapeChar(r'$\backslash$')
+            for char in '#$&%{}':
+                escapes[char] = ESCCHAR + char                 # \%
+            for char in '~^':
+                escapes[char] = ESCCHAR + char + '{}'          # \~{}
+            for char in '<|>':
+                escapes[char] = '$%s$' % char                  # $>$
+            # The _ is escaped at the end, but not the image names' ones
+            finals['_'] = r'\_'
+            finals['vvvvTexUndervvvv'] = '_'  # shame!
+        elif target == 'rtf':
+            escapes[ESCCHAR] = ESCCHAR + ESCCHAR
+            escapes['{'] = ESCCHAR + '{'
+            escapes['}'] = ESCCHAR + '}'
+            finals['\t'] = ESCCHAR + 'tab'
+
+        self.firsts = firsts
+        self._escape = self._compile(escapes)
+        self._final = self._compile(finals)
+
+    def _compile(self, table):
+        "Returns a function that replaces all the table keys at once"
+        if not table:
+            return None
+        # Longer keys first, so they win over their own prefixes
+        keys = sorted(table, key=len, reverse=True)
+        regex = re.compile('|'.join(['(%s)' % re.escape(k) for k in keys]))
+        repl = [None] + [table[k] for k in keys]
+        return lambda txt: regex.sub(lambda m: repl[m.lastindex], txt)
+
+    def escape(self, txt):
+        "Target-specific special escapes. Apply *before* insert any tag."
+        if self._escape:
+            txt = self._escape(txt)
+        if self.firsts and txt[:1] in self.firsts:
+            txt = self.firsts[txt[:1]] + txt[1:]
+        return txt
+
+    def final_escape(self, txt):
+        "Last escapes of each line"
+        if self._final:
+            txt = self._final(txt)
+        return txt
+
+
+class LinkMatch:
+    "The match of a LinkMaster search, like a re match without groups"
+    def __init__(self, string, start, end):
+        self.string = string
+        self._start = start
+        self._end   = end
+
+    def group(self, group=0):
+        if group:
+            raise IndexError('no such group')
+        return self.string[self._start:self._end]
+
+    def start(self, group=0):
+        return self._start
+
+    def end(self, group=0):
+        return self._end
+
+    def span(self, group=0):
+        return self._start, self._end
+
+
+class LinkMaster:
+    """
+    Finds the URLs and emails of the link regex, in linear time
+
+    The regex is an alternation of optional groups, and re tries it
+    on every position of the line, backtracking over long words. Here
+    the line is scanned only for the fixed parts of the links ('://',
+    'www', 'ftp.' and '@'), and each of them is checked from there,
+    with runs of the urlskel chars. The matches are the same the regex
+    finds: the leftmost one, the URL when both start at the same char.
+    It has the search() and match() methods of the regex, and its
+    pattern, so it can be used instead of it.
+    """
+    # Keep in sync with urlskel['proto'] and urlskel['guess']
+    protos = ('https', 'http', 'ftp', 'news', 'telnet', 'gopher', 'wais')
+    anchors = re.compile(r'://|www|ftp\.|@', re.I)
+    words = frozenset(string.ascii_letters + string.digits + '_')
+
+    def __init__(self, urlskel, pattern):
+        self.pattern = pattern
+        self.flags   = re.I
+        run = lambda chars: re.compile('[%s]*' % chars).match
+        self.login   = frozenset(self._expand(urlskel['login']))
+        self.login_run  = run(urlskel['login'])
+        self.chars_run  = run(urlskel['chars'])
+        self.form_run   = run(urlskel['form'])
+        self.anchor_run = run(urlskel['anchor'])
+        self.domain_run = run('A-Za-z0-9_-')
+        self.tld_run    = run('A-Za-z')
+
+    def _expand(self, chars):
+        "Returns the chars of a regex char class, as A-Za-z0-9_.-"
+        ret = []
+        i = 0
+        while i < len(chars):
+            if chars[i + 1:i + 2] == '-' and i + 2 < len(chars):
+                ret.extend(map(chr, range(ord(chars[i]), ord(chars[i + 2]) + 1)))
+                i += 3
+            else:
+                ret.append(chars[i])
+                i += 1
+        return ret
+
+    def _is_word(self, txt, i):
+        return 0 <= i < len(txt) and txt[i] in self.words
+
+    def _boundary(self, txt, i):
+        return self._is_word(txt, i - 1) != self._is_word(txt, i)
+
+    def _url_body(self, txt, i):
+        "Returns the end of [chars]+\\b/*(\\?[form]+)?(#[anchor]*)? at i"
+        end = self.chars_run(txt, i).end()
+        while end > i and not self._boundary(txt, end):
+            end -= 1
+        if end == i:
+            return -1
+        while txt[end:end + 1] == '/':
+            end += 1
+        if txt[end:end + 1] == '?':
+            form = self.form_run(txt, end + 1).end()
+            if form > end + 1:
+                end = form
+        if txt[end:end + 1] == '#':
+            end = self.anchor_run(txt, end + 1).end()
+        return end
+
+    def _url(self, txt, start, anchor):
+        "Returns the end of the URL starting at start, or -1"
+        if not self._boundary(txt, start):
+            return -1
+
+        # Guessed: www[23]?. or ftp.
+        low = txt[start:start + 5].lower()
+        if low.startswith('www'):
+            if low[3:4] in ('2', '3') and low[4:5] == '.':
+                return self._url_body(txt, start + 5)
+            if low[3:4] == '.':
+                return self._url_body(txt, start + 4)
+            return -1
+        if low.startswith('ftp.'):
+            return self._url_body(txt, start + 4)
+
+        # Protocol, maybe with login[:password]@
+        body = anchor + 3
+        login = self.login_run(txt, body).end()
+        if login > body:
+            if txt[login:login + 1] == ':':
+                space = txt.find(' ', login)
+                at = txt.find('@', login)
+                if at >= 0 and (space < 0 or at < space):
+                    login = at
+            if txt[login:login + 1] == '@':
+                end = self._url_body(txt, login + 1)
+                if end >= 0:
+                    return end
+        return self._url_body(txt, body)
+
+    def _email(self, txt, at):
+        "Returns the end of the email domain after the @, or -1"
+        # ([A-Za-z0-9_-]+\.)+ then the last dot with [A-Za-z]{2,4}\b
+        dots = []
+        i = at + 1
+        while True:
+            end = self.domain_run(txt, i).end()
+            if end == i or txt[end:end + 1] != '.':
+                break
+            dots.append(end)
+            i = end + 1
+        for dot in reversed(dots):
+            end = self.tld_run(txt, dot + 1).end()
+            if 2 <= end - dot - 1 <= 4 and not self._is_word(txt, end):
+                break
+        else:
+            return -1
+        if txt[end:end + 1] == '?':
+            form = self.form_run(txt, end + 1).end()
+            if form > end + 1:
+                end = form
+        return end
+
+    def _scan(self, txt, pos, anchored):
+        best = reach = None
+        for m in self.anchors.finditer(txt, pos):
+            anchor = m.start()
+            mark = m.group()
+
+            # A link found before can't be beaten by the anchors after it,
+            # but by an email with only login chars from there to its @
+            if best and anchor - 6 > best[0]:
+                if reach < anchor:
+                    break
+                if mark != '@':
+                    continue
+
+            # The start of the link, (start, 0) for URLs, (start, 1) for
+            # emails, so a URL wins an email starting at the same char
+            if mark == '@':
+                # The first word boundary on the login chars before it
+                start = anchor
+                while start > pos and txt[start - 1] in self.login:
+                    start -= 1
+                while start < anchor and not self._boundary(txt, start):
+                    start += 1
+                if start == anchor:
+                    continue
+                key = (start, 1)
+            elif mark == '://':
+                for proto in self.protos:
+                    start = anchor - len(proto)
+                    if start >= pos and txt[start:anchor].lower() == proto:
+                        key = (start, 0)
+                        break
+                else:
+                    continue
+            else:
+                key = (anchor, 0)
+
+            if (best and key > best[:2]) or (anchored and key[0] != pos):
+                continue
+            if key[1]:
+                end = self._email(txt, anchor)
+            else:
+                end = self._url(txt, key[0], anchor)
+            if end >= 0:
+                best = key + (end,)
+                reach = self.login_run(txt, key[0]).end()
+
+        if best:
+            return LinkMatch(txt, best[0], best[2])
+        return None
+
+    def search(self, txt, pos=0):
+        "Returns the leftmost link from pos, as regex.search()"
+        return self._scan(txt, pos, False)
+
+    def match(self, txt, pos=0):
+        "Returns the link starting at pos, as regex.match()"
+        return self._scan(txt, pos, True)
+
+
 class MaskMaster:
     "(Un)Protect important structures from escaping and formatting"
-    def __init__(self):
-        self.linkmask   = 'vvvLINKvvv'
-        self.monomask   = 'vvvMONOvvv'
-        self.macromask  = 'vvvMACROvvv'
-        self.rawmask    = 'vvvRAWvvv'
-        self.taggedmask = 'vvvTAGGEDvvv'
-        self.tocmask    = 'vvvTOCvvv'
-        self.macroman   = MacroMaster()
+    def __init__(self, conv):
+        self.conv       = conv
+        self.tags       = conv.tags
+        self.regex      = conv.regex
+        self.linkmask   = LINKMASK
+        self.monomask   = MONOMASK
+        self.macromask  = MACROMASK
+        self.rawmask    = RAWMASK
+        self.taggedmask = TAGGEDMASK
+        self.tocmask    = TOCMASK
+        self.macroman   = MacroMaster(self.conv)
         self.reset()
 
     def reset(self):
@@ -4434,108 +5366,31 @@ class MaskMaster:
         self.taggedbank = []
 
     def mask(self, line=''):
-        global AUTOTOC
-
-        # The verbatim, raw and tagged inline marks are mutually exclusive.
-        # This means that one can't appear inside the other.
-        # If found, the inner marks must be ignored.
-        # Example: ``foo ""bar"" ''baz''``
-        # In HTML: <code>foo ""bar"" ''baz''</code>
-        #
-        # The trick here is to protect the mark who appears first on the line.
-        # The three regexes are tried and the one with the lowest index wins.
-        # If none is found (else), we get out of the loop.
-        #
-        while True:
-
-            # Try to match the line for the three marks
-            # Note: 'z' > 999999
-            #
-            t = r = v = 'z'
-            try:
-                t = regex['tagged'].search(line).start()
-            except:
-                pass
-            try:
-                r = regex['raw'].search(line).start()
-            except:
-                pass
-            try:
-                v = regex['fontMono'].search(line).start()
-            except:
-                pass
-
-            # Protect tagged text
-            if t >= 0 and t < r and t < v:
-                txt = regex['tagged'].search(line).group(1)
-                self.taggedbank.append(txt)
-                line = regex['tagged'].sub(self.taggedmask, line, 1)
-
-            # Protect raw text
-            elif r >= 0 and r < t and r < v:
-                txt = regex['raw'].search(line).group(1)
-                txt = doEscape(TARGET, txt)
-                self.rawbank.append(txt)
-                line = regex['raw'].sub(self.rawmask, line, 1)
-
-            # Protect verbatim text
-            elif v >= 0 and v < t and v < r:
-                txt = regex['fontMono'].search(line).group(1)
-                txt = doEscape(TARGET, txt)
-                self.monobank.append(txt)
-                line = regex['fontMono'].sub(self.monomask, line, 1)
-            else:
-                break
-
-        # Protect macros
-        while regex['macros'].search(line):
-            txt = regex['macros'].search(line).group()
-            self.macrobank.append(txt)
-            line = regex['macros'].sub(self.macromask, line, 1)
-
-        # Protect TOC location
-        while regex['toc'].search(line):
-            line = regex['toc'].sub(self.tocmask, line)
-            AUTOTOC = 0
-
-        # Protect URLs and emails
-        while regex['linkmark'].search(line) or \
-              regex['link'].search(line):
-
-            # Try to match plain or named links
-            match_link  = regex['link'].search(line)
-            match_named = regex['linkmark'].search(line)
-
-            # Define the current match
-            if match_link and match_named:
-                # Both types found, which is the first?
-                m = match_link
-                if match_named.start() < match_link.start():
-                    m = match_named
+        "Masks the line, saving the protected structures to the banks"
+        line, spans = parseInline(line, self.regex, self.conv.parse_cache)
+        for kind, data in spans:
+            if kind == 'link':
+                label, link, named = data
+                if named:
+                    link = self.conv.fix_relative_path(link)
+                self.linkbank.append((label, link))
+            elif kind == 'macro':
+                self.macrobank.append(data)
+            elif kind == 'tagged':
+                self.taggedbank.append(data)
+            elif kind == 'toc':
+                self.conv.autotoc = 0
+            elif kind == 'raw':
+                self.rawbank.append(self.conv.do_escape(data))
             else:
-                # Just one type found, we're fine
-                m = match_link or match_named
-
-            # Extract link data and apply mask
-            if m == match_link:              # plain link
-                link = m.group()
-                label = ''
-                link_re = regex['link']
-            else:                            # named link
-                link = fix_relative_path(m.group('link'))
-                label = m.group('label').rstrip()
-                link_re = regex['linkmark']
-            line = link_re.sub(self.linkmask, line, 1)
-
-            # Save link data to the link bank
-            self.linkbank.append((label, link))
+                self.monobank.append(self.conv.do_escape(data))
         return line
 
     def undo(self, line):
 
         # url & email
         for label, url in self.linkbank:
-            link = get_tagged_link(label, url)
+            link = self.conv.get_tagged_link(label, url)
             line = line.replace(self.linkmask, link, 1)
 
         # Expand macros
@@ -4545,7 +5400,7 @@ class MaskMaster:
 
         # Expand verb
         for mono in self.monobank:
-            open_, close = TAGS['fontMonoOpen'], TAGS['fontMonoClose']
+            open_, close = self.tags['fontMonoOpen'], self.tags['fontMonoClose']
             line = line.replace(self.monomask, open_ + mono + close, 1)
 
         # Expand raw
@@ -4564,7 +5419,13 @@ class MaskMaster:
 
 class TitleMaster:
     "Title things"
-    def __init__(self):
+    def __init__(self, conv):
+        self.conv   = conv
+        self.config = conv.config
+        self.rules  = conv.rules
+        self.tags   = conv.tags
+        self.regex  = conv.regex
+        self.target = conv.target
         self.count = ['', 0, 0, 0, 0, 0]
         self.toc   = []
         self.level = 0
@@ -4581,7 +5442,7 @@ class TitleMaster:
 
     def _open_close_blocks(self):
         "Open new title blocks, closing the previous (if any)"
-        if not rules['titleblocks']:
+        if not self.rules['titleblocks']:
             return
         tag = ''
         last = self.last_level
@@ -4589,7 +5450,7 @@ class TitleMaster:
 
         # Same level, just close the previous
         if curr == last:
-            tag = TAGS.get('title%dClose' % last)
+            tag = self.tags.get('title%dClose' % last)
             if tag:
                 self.tag_hold.append(tag)
 
@@ -4598,27 +5459,27 @@ class TitleMaster:
             last += 1
 
             # Open the new block of subsections
-            tag = TAGS.get('blockTitle%dOpen' % last)
+            tag = self.tags.get('blockTitle%dOpen' % last)
             if tag:
                 self.tag_hold.append(tag)
 
             # Jump from title1 to title3 or more
             # Fill the gap with an empty section
             if curr - last > 0:
-                tag = TAGS.get('title%dOpen' % last)
-                tag = regex['x'].sub('', tag)      # del \a
+                tag = self.tags.get('title%dOpen' % last)
+                tag = self.regex['x'].sub('', tag)      # del \a
                 if tag:
                     self.tag_hold.append(tag)
 
         # Section <- subsection, less depth
         while curr < last:
             # Close the current opened subsection
-            tag = TAGS.get('title%dClose' % last)
+            tag = self.tags.get('title%dClose' % last)
             if tag:
                 self.tag_hold.append(tag)
 
             # Close the current opened block of subsections
-            tag = TAGS.get('blockTitle%dClose' % last)
+            tag = self.tags.get('blockTitle%dClose' % last)
             if tag:
                 self.tag_hold.append(tag)
 
@@ -4627,7 +5488,7 @@ class TitleMaster:
             # Close the previous section of the same level
             # The subsections were under it
             if curr == last:
-                tag = TAGS.get('title%dClose' % last)
+                tag = self.tags.get('title%dClose' % last)
                 if tag:
                     self.tag_hold.append(tag)
 
@@ -4646,10 +5507,10 @@ class TitleMaster:
         ret = []
         ret.extend(self.tag_hold)
         while self.level:
-            tag = TAGS.get('title%dClose' % self.level)
+            tag = self.tags.get('title%dClose' % self.level)
             if tag:
                 ret.append(tag)
-            tag = TAGS.get('blockTitle%dClose' % self.level)
+            tag = self.tags.get('blockTitle%dClose' % self.level)
             if tag:
                 ret.append(tag)
             self.level -= 1
@@ -4670,19 +5531,19 @@ class TitleMaster:
         else:
             Error("Unknown Title ID '%s'" % id_)
         # Extract line info
-        match = regex[kind].search(line)
+        match = self.regex[kind].search(line)
         level = len(match.group('id'))
         txt   = match.group('txt').strip()
         label = match.group('label')
         # Parse info & save
-        if CONF['enum-title']:
+        if self.config['enum-title']:
             kind = 'numtitle'  # force
-        if rules['titleblocks']:
-            self.tag = TAGS.get('%s%dOpen' % (kind, level)) or \
-                       TAGS.get('title%dOpen' % level)
+        if self.rules['titleblocks']:
+            self.tag = self.tags.get('%s%dOpen' % (kind, level)) or \
+                       self.tags.get('title%dOpen' % level)
         else:
-            self.tag = TAGS.get(kind + str(level)) or \
-                       TAGS.get('title' + str(level))
+            self.tag = self.tags.get(kind + str(level)) or \
+                       self.tags.get('title' + str(level))
         self.last_level = self.level
         self.kind  = kind
         self.level = level
@@ -4692,7 +5553,7 @@ class TitleMaster:
     def _set_count_id(self):
         "Compose and save the title count identifier (if needed)."
         count_id = ''
-        if self.kind == 'numtitle' and not rules['autonumbertitle']:
+        if self.kind == 'numtitle' and not self.rules['autonumbertitle']:
             # Manually increase title count
             self.count[self.level] += 1
             # Reset sublevels count (if any)
@@ -4719,15 +5580,15 @@ class TitleMaster:
         "Return anchor if user defined a label, or TOC is on."
         ret = ''
         label = self.label
-        if CONF['toc'] and self.level <= CONF['toc-level']:
+        if self.config['toc'] and self.level <= self.config['toc-level']:
             # This count is needed bcos self.toc stores all
             # titles, regardless of the 'toc-level' setting,
             # so we can't use self.toc length to number anchors
             self.anchor_count += 1
             # Autonumber label (if needed)
             label = label or '%s%s' % (self.anchor_prefix, self.anchor_count)
-        if label and TAGS['anchor']:
-            ret = regex['x'].sub(label, TAGS['anchor'])
+        if label and self.tags['anchor']:
+            ret = self.regex['x'].sub(label, self.tags['anchor'])
         return ret
 
     def _get_full_title_text(self):
@@ -4737,21 +5598,20 @@ class TitleMaster:
         if self.count_id:
             ret = '%s %s' % (self.count_id, ret)
         # Escape specials
-        ret = doEscape(TARGET, ret)
+        ret = self.conv.do_escape(ret)
         # Same targets needs final escapes on title lines
         # It's here because there is a 'continue' after title
-        if rules['finalescapetitle']:
-            ret = doFinalEscape(TARGET, ret)
+        if self.rules['finalescapetitle']:
+            ret = self.conv.do_final_escape(ret)
         return ret
 
     def get(self):
         "Returns the tagged title as a list."
-        global AA_TITLE
         ret = []
 
         # Maybe some anchoring before?
         anchor = self._get_tagged_anchor()
-        self.tag = regex['_anchor'].sub(anchor, self.tag)
+        self.tag = self.regex['_anchor'].sub(anchor, self.tag)
 
         ### Compose & escape title text (TOC uses unescaped)
         full_title = self._get_full_title_text()
@@ -4760,49 +5620,50 @@ class TitleMaster:
         ret.extend(self.tag_hold)
         self.tag_hold = []
 
-        tagged = regex['x'].sub(full_title, self.tag)
+        tagged = self.regex['x'].sub(full_title, self.tag)
 
         # Adds "underline" on TXT target
-        if TARGET == 'txt':
-            if BLOCK.count > 1:
+        if self.target == 'txt':
+            if self.conv.block.count > 1:
                 ret.append('')  # blank line before
             ret.append(tagged)
             # Get the right letter count for UTF
-            if CONF['encoding'].lower() == 'utf-8':
-                i = len(full_title.decode('utf-8'))
+            if isinstance(full_title, unicode) or \
+               self.config['encoding'].lower() == 'utf-8':
+                i = len(as_unicode(full_title))
             else:
                 i = len(full_title)
-            ret.append(regex['x'].sub('=' * i, self.tag))
-        elif TARGET == 'aat' and self.level == 1:
-            if CONF['slides'] :
-                AA_TITLE = tagged
+            ret.append(self.regex['x'].sub('=' * i, self.tag))
+        elif self.target == 'aat' and self.level == 1:
+            if self.config['slides'] :
+                self.conv.aa_title = tagged
             else :
-                if BLOCK.count > 1:
+                if self.conv.block.count > 1:
                     ret.append('')  # blank line before
-                box = aa_box([tagged], AA, CONF['width'])
-                if CONF['web'] and CONF['toc']:
+                box = aa_box([tagged], AA, self.config['width'])
+                if self.config['web'] and self.config['toc']:
                     ret.extend([anchor] + box + ['</a>'])
                 else:
                     ret.extend(box)
-        elif TARGET == 'aat':
+        elif self.target == 'aat':
             level = 'level' + str(self.level)
-            if BLOCK.count > 1:
+            if self.conv.block.count > 1:
                 ret.append('')  # blank line before
-            if CONF['slides']:
-                under = aa_under(tagged, AA[level], CONF['width'] - 2, False)
+            if self.config['slides']:
+                under = aa_under(tagged, AA[level], self.config['width'] - 2, False)
             else:
-                under = aa_under(tagged, AA[level], CONF['width'], False)
-            if CONF['web'] and CONF['toc']:
+                under = aa_under(tagged, AA[level], self.config['width'], False)
+            if self.config['web'] and self.config['toc']:
                 ret.extend([anchor] + under + ['</a>']) 
             else:
                 ret.extend(under)
-        elif TARGET == 'rst' and self.level == 1:
-            if BLOCK.count > 1:
+        elif self.target == 'rst' and self.level == 1:
+            if self.conv.block.count > 1:
                 ret.append('')  # blank line before
             ret.extend(aa_under(tagged, RST['level1'], 10000, True))
-        elif TARGET == 'rst':
+        elif self.target == 'rst':
             level = 'level' + str(self.level)
-            if BLOCK.count > 1:
+            if self.conv.block.count > 1:
                 ret.append('')  # blank line before
             ret.extend(aa_under(tagged, RST[level], 10000, False))
         else:
@@ -4822,8 +5683,8 @@ class TitleMaster:
             toc_count += 1
 
             # TOC will have crosslinks to anchors
-            if TAGS['anchor']:
-                if CONF['enum-title'] and level == 1:
+            if self.tags['anchor']:
+                if self.config['enum-title'] and level == 1:
                     # 1. [Foo #anchor] is more readable than [1. Foo #anchor] in level 1.
                     # This is a stoled idea from Windows .CHM help files.
                     tocitem = '%s+ [""%s"" #%s]' % (indent, txt, label)
@@ -4832,7 +5693,7 @@ class TitleMaster:
 
             # TOC will be plain text (no links)
             else:
-                if TARGET in ['txt', 'man', 'aat']:
+                if self.target in ['txt', 'man', 'aat']:
                     # For these, the list is not necessary, just dump the text
                     tocitem = '%s""%s""' % (indent, id_txt)
                 else:
@@ -4865,10 +5726,15 @@ class TitleMaster:
 
 #TODO check all this table mess
 # It uses parse_row properties for table lines
-# BLOCK.table() replaces the cells by the parsed content
+# self.conv.block.table() replaces the cells by the parsed content
 #
 class TableMaster:
-    def __init__(self, line=''):
+    def __init__(self, conv, line=''):
+        self.conv      = conv
+        self.rules     = conv.rules
+        self.tags      = conv.tags
+        self.regex     = conv.regex
+        self.target    = conv.target
         self.rows      = []
         self.border    = 0
         self.align     = 'Left'
@@ -4876,14 +5742,17 @@ class TableMaster:
         self.colalign  = []
         self.cellspan  = []
         if line:
-            prop = self.parse_row(line)
-            self.border    = prop['border']
-            self.title     = prop['title']
-            self.align     = prop['align']
-            self.cellalign = prop['cellalign']
-            self.cellspan  = prop['cellspan']
-            self.n_cols    = str(sum(self.cellspan))
-            self.colalign  = self._get_col_align()
+            self.set_prop(self.parse_row(line))
+
+    def set_prop(self, prop):
+        "Sets the table properties from its first (parsed) row"
+        self.border    = prop['border']
+        self.title     = prop['title']
+        self.align     = prop['align']
+        self.cellalign = prop['cellalign']
+        self.cellspan  = prop['cellspan']
+        self.n_cols    = str(sum(self.cellspan))
+        self.colalign  = self._get_col_align()
 
     def _get_col_align(self):
         colalign = []
@@ -4894,23 +5763,23 @@ class TableMaster:
         return colalign
 
     def _get_full_tag(self, topen):
-        # topen     = TAGS['tableOpen']
-        tborder   = TAGS['_tableBorder']
-        talign    = TAGS['_tableAlign' + self.align]
-        calignsep = TAGS['tableColAlignSep']
+        # topen     = self.tags['tableOpen']
+        tborder   = self.tags['_tableBorder']
+        talign    = self.tags['_tableAlign' + self.align]
+        calignsep = self.tags['tableColAlignSep']
         calign    = ''
 
         # The first line defines if table has border or not
         if not self.border:
             tborder = ''
         # Set the columns alignment
-        if rules['tablecellaligntype'] == 'column':
-            calign = map(lambda x: TAGS['_tableColAlign%s' % x], self.colalign)
+        if self.rules['tablecellaligntype'] == 'column':
+            calign = map(lambda x: self.tags['_tableColAlign%s' % x], self.colalign)
             calign = calignsep.join(calign)
         # Align full table, set border and Column align (if any)
-        topen = regex['_tableAlign'].sub(talign , topen)
-        topen = regex['_tableBorder'].sub(tborder, topen)
-        topen = regex['_tableColAlign'].sub(calign , topen)
+        topen = self.regex['_tableAlign'].sub(talign , topen)
+        topen = self.regex['_tableBorder'].sub(tborder, topen)
+        topen = self.regex['_tableColAlign'].sub(calign , topen)
         # Tex table spec, border or not: {|l|c|r|} , {lcr}
         if calignsep and not self.border:
             # Remove cell align separator
@@ -4941,13 +5810,13 @@ class TableMaster:
 
     def _tag_cells(self, rowdata):
         cells = rowdata['cells']
-        open_ = TAGS['tableCellOpen']
-        close = TAGS['tableCellClose']
-        sep = TAGS['tableCellSep']
-        head = TAGS['tableCellHead']
-        calign = map(lambda x: TAGS['_tableCellAlign' + x], rowdata['cellalign'])
-        caligntag = map(lambda x: TAGS['tableCellAlign' + x], rowdata['cellalign'])
-        calignsep = TAGS['tableColAlignSep']
+        open_ = self.tags['tableCellOpen']
+        close = self.tags['tableCellClose']
+        sep = self.tags['tableCellSep']
+        head = self.tags['tableCellHead']
+        calign = map(lambda x: self.tags['_tableCellAlign' + x], rowdata['cellalign'])
+        caligntag = map(lambda x: self.tags['tableCellAlign' + x], rowdata['cellalign'])
+        calignsep = self.tags['tableColAlignSep']
         ncolumns = len(self.colalign)
 
         # Populate the span and multicol open tags
@@ -4956,7 +5825,7 @@ class TableMaster:
         colindex = 0
 
         thisspan = 0
-        spanmultiplier = rules['cellspanmultiplier'] or 1
+        spanmultiplier = self.rules['cellspanmultiplier'] or 1
 
         cellhead = []
         cellbody = []
@@ -4967,7 +5836,7 @@ class TableMaster:
             align = rowdata['cellalign'][cellindex]
 
             # hack to get cell size/span into rtf, in twips
-            if rules['cellspancumulative']:
+            if self.rules['cellspancumulative']:
                 thisspan += span
             else:
                 thisspan = span
@@ -4975,21 +5844,21 @@ class TableMaster:
 
             if span > 1:
 
-                if TAGS['_tableCellColSpanChar']:
+                if self.tags['_tableCellColSpanChar']:
                     # spanchar * n
-                    cspan.append(TAGS['_tableCellColSpanChar'] * (span - 1))
+                    cspan.append(self.tags['_tableCellColSpanChar'] * (span - 1))
                     # Note: using -1 for moin, where spanchar == cell delimiter
                 else:
                     # \a replaced by n
-                    cspan.append(regex['x'].sub(str(span), TAGS['_tableCellColSpan']))
+                    cspan.append(self.regex['x'].sub(str(span), self.tags['_tableCellColSpan']))
 
-                mcopen = regex['x'].sub(str(span), TAGS['_tableCellMulticolOpen'])
+                mcopen = self.regex['x'].sub(str(span), self.tags['_tableCellMulticolOpen'])
                 multicol.append(mcopen)
             else:
                 cspan.append('')
 
                 if colindex < ncolumns and align != self.colalign[colindex]:
-                    mcopen = regex['x'].sub('1', TAGS['_tableCellMulticolOpen'])
+                    mcopen = self.regex['x'].sub('1', self.tags['_tableCellMulticolOpen'])
                     multicol.append(mcopen)
                 else:
                     multicol.append('')
@@ -5002,20 +5871,20 @@ class TableMaster:
         # Maybe is it a title row?
         if rowdata['title']:
             # Defaults to normal cell tag if not found
-            open_ = TAGS['tableTitleCellOpen']  or open_
-            close = TAGS['tableTitleCellClose'] or close
-            sep   = TAGS['tableTitleCellSep']   or sep
-            head  = TAGS['tableTitleCellHead']  or head
+            open_ = self.tags['tableTitleCellOpen']  or open_
+            close = self.tags['tableTitleCellClose'] or close
+            sep   = self.tags['tableTitleCellSep']   or sep
+            head  = self.tags['tableTitleCellHead']  or head
 
         # Should we break the line on *each* table cell?
-        if rules['breaktablecell']:
+        if self.rules['breaktablecell']:
             close = close + '\n'
 
         # Cells pre processing
-        if rules['tablecellstrip']:
+        if self.rules['tablecellstrip']:
             cells = map(lambda x: x.strip(), cells)
-        if rowdata['title'] and rules['tabletitlerowinbold']:
-            cells = map(lambda x: enclose_me('fontBold', x), cells)
+        if rowdata['title'] and self.rules['tabletitlerowinbold']:
+            cells = map(lambda x: self.conv.enclose_me('fontBold', x), cells)
 
         # Add cell BEGIN/END tags
         for cell in cells:
@@ -5036,46 +5905,46 @@ class TableMaster:
                 this_mcopen = multicol.pop(0)
 
             # Insert cell align into open tag (if cell is alignable)
-            if rules['tablecellaligntype'] == 'cell':
-                copen = regex['_tableCellAlign'].sub(this_align, copen)
-                cclose = regex['_tableCellAlign'].sub(this_align, cclose)
-                chead = regex['_tableCellAlign'].sub(this_align, chead)
+            if self.rules['tablecellaligntype'] == 'cell':
+                copen = self.regex['_tableCellAlign'].sub(this_align, copen)
+                cclose = self.regex['_tableCellAlign'].sub(this_align, cclose)
+                chead = self.regex['_tableCellAlign'].sub(this_align, chead)
 
                 # Insert cell data into cellAlign tags
                 if this_cell:
-                    cell = regex['x'].sub(cell, this_cell)
+                    cell = self.regex['x'].sub(cell, this_cell)
 
             # Insert cell span into open tag (if cell is spannable)
-            if rules['tablecellspannable']:
-                copen = regex['_tableCellColSpan'].sub(this_span, copen)
-                cclose = regex['_tableCellColSpan'].sub(this_span, cclose)
-                chead = regex['_tableCellColSpan'].sub(this_span, chead)
+            if self.rules['tablecellspannable']:
+                copen = self.regex['_tableCellColSpan'].sub(this_span, copen)
+                cclose = self.regex['_tableCellColSpan'].sub(this_span, cclose)
+                chead = self.regex['_tableCellColSpan'].sub(this_span, chead)
 
             # Use multicol tags instead (if multicol supported, and if
             # cell has a span or is aligned differently to column)
-            if rules['tablecellmulticol']:
+            if self.rules['tablecellmulticol']:
                 if this_mcopen:
-                    copen = regex['_tableColAlign'].sub(this_align, this_mcopen)
-                    cclose = TAGS['_tableCellMulticolClose']
+                    copen = self.regex['_tableColAlign'].sub(this_align, this_mcopen)
+                    cclose = self.tags['_tableCellMulticolClose']
 
             # RTF target requires the border in each cell
             border = ''
             if self.border:
-                border = TAGS['_tableCellBorder']
-            copen = regex['_tableBorder'].sub(border, copen)
-            cclose = regex['_tableBorder'].sub(border, cclose)
-            chead = regex['_tableBorder'].sub(border, chead)
+                border = self.tags['_tableCellBorder']
+            copen = self.regex['_tableBorder'].sub(border, copen)
+            cclose = self.regex['_tableBorder'].sub(border, cclose)
+            chead = self.regex['_tableBorder'].sub(border, chead)
 
             # Attribute delimiter, added when align/span attributes were used
             # Example: Wikipedia table cell, without and with attributes:
             # | cell contents
             # | align="right" colspan="2" | cell contents
             #
-            if regex['_tableAttrDelimiter'].search(copen):
+            if self.regex['_tableAttrDelimiter'].search(copen):
                 if this_align or this_span:
-                    copen = regex['_tableAttrDelimiter'].sub(TAGS['_tableAttrDelimiter'], copen)
+                    copen = self.regex['_tableAttrDelimiter'].sub(self.tags['_tableAttrDelimiter'], copen)
                 else:
-                    copen = regex['_tableAttrDelimiter'].sub('', copen)  # remove marker
+                    copen = self.regex['_tableAttrDelimiter'].sub('', copen)  # remove marker
 
             if chead:
                 cellhead.append(chead)
@@ -5108,7 +5977,7 @@ class TableMaster:
         else:
             line = line + ' | '
         # Delete table mark
-        line = regex['table'].sub('', line)
+        line = self.regex['table'].sub('', line)
         # Detect colspan  | foo | bar baz |||
         line = re.sub(' (\|+)\| ', '\a\\1 | ', line)
         # Split cells (the last is fake)
@@ -5120,26 +5989,46 @@ class TableMaster:
         # Find cells align
         ret['cellalign'] = self._get_cell_align(ret['cells'])
         # Hooray!
-        Debug('Table Prop: %s' % ret, 7)
+        if DEBUG:
+            Debug('Table Prop: %s' % ret, 7)
         return ret
 
+    def parse_cells(self, cells, title=0):
+        """
+        Returns parse_row('| %s |' % ' | '.join(cells)), without the string
+
+        Used for the %!csv rows, that are already split in cells. Only the
+        cells with a '|' (span marks or a ' | ' inside) and the empty rows
+        need the table line parsing.
+        """
+        if not cells or [cell for cell in cells if '|' in cell]:
+            line = '| %s |' % ' | '.join(cells)
+            if title:
+                line = '|' + line
+            return self.parse_row(line)
+        return {
+            'border': 1, 'title': title, 'align': 'Left',
+            'cells': cells, 'cellalign': self._get_cell_align(cells),
+            'cellspan': [1] * len(cells)
+        }
+
     def dump(self):
-        open_ = self._get_full_tag(TAGS['tableOpen'])
+        open_ = self._get_full_tag(self.tags['tableOpen'])
         rows  = self.rows
-        close = self._get_full_tag(TAGS['tableClose'])
+        close = self._get_full_tag(self.tags['tableClose'])
 
-        rowopen     = self._get_full_tag(TAGS['tableRowOpen'])
-        rowclose    = self._get_full_tag(TAGS['tableRowClose'])
-        rowsep      = self._get_full_tag(TAGS['tableRowSep'])
-        titrowopen  = self._get_full_tag(TAGS['tableTitleRowOpen'])  or rowopen
-        titrowclose = self._get_full_tag(TAGS['tableTitleRowClose']) or rowclose
+        rowopen     = self._get_full_tag(self.tags['tableRowOpen'])
+        rowclose    = self._get_full_tag(self.tags['tableRowClose'])
+        rowsep      = self._get_full_tag(self.tags['tableRowSep'])
+        titrowopen  = self._get_full_tag(self.tags['tableTitleRowOpen'])  or rowopen
+        titrowclose = self._get_full_tag(self.tags['tableTitleRowClose']) or rowclose
 
-        if rules['breaktablelineopen']:
+        if self.rules['breaktablelineopen']:
             rowopen = rowopen + '\n'
             titrowopen = titrowopen + '\n'
 
         # Tex gotchas
-        if TARGET == 'tex':
+        if self.target == 'tex':
             if not self.border:
                 rowopen = titrowopen = ''
             else:
@@ -5186,7 +6075,13 @@ class TableMaster:
 
 class BlockMaster:
     "TIP: use blockin/out to add/del holders"
-    def __init__(self):
+    def __init__(self, conv):
+        self.conv = conv
+        self.config = conv.config
+        self.rules = conv.rules
+        self.tags = conv.tags
+        self.regex = conv.regex
+        self.target = conv.target
         self.BLK = []
         self.HLD = []
         self.PRP = []
@@ -5216,7 +6111,7 @@ class BlockMaster:
         self.exclusive = ['comment', 'verb', 'raw', 'tagged']
 
         # May we include bars inside quotes?
-        if rules['barinsidequote']:
+        if self.rules['barinsidequote']:
             self.contains['quote'].append('bar')
 
     def block(self):
@@ -5234,8 +6129,8 @@ class BlockMaster:
 
     def propset(self, key, val):
         self.PRP[-1][key] = val
-        #Debug('BLOCK prop ++: %s->%s' % (key, repr(val)), 1)
-        #Debug('BLOCK props: %s' % (repr(self.PRP)), 1)
+        #Debug('self.conv.block prop ++: %s->%s' % (key, repr(val)), 1)
+        #Debug('self.conv.block props: %s' % (repr(self.PRP)), 1)
 
     def hold(self):
         if not self.HLD:
@@ -5246,20 +6141,23 @@ class BlockMaster:
         if self.block().endswith('list'):
             line = [line]
         self.HLD[-1].append(line)
-        Debug('HOLD add: %s' % repr(line), 4)
-        Debug('FULL HOLD: %s' % self.HLD, 4)
+        if DEBUG:  # formatting the full hold is O(n) per line
+            Debug('HOLD add: %s' % repr(line), 4)
+            Debug('FULL HOLD: %s' % self.HLD, 4)
 
     def holdaddsub(self, line):
         self.HLD[-1][-1].append(line)
-        Debug('HOLD addsub: %s' % repr(line), 4)
-        Debug('FULL HOLD: %s' % self.HLD, 4)
+        if DEBUG:
+            Debug('HOLD addsub: %s' % repr(line), 4)
+            Debug('FULL HOLD: %s' % self.HLD, 4)
 
     def holdextend(self, lines):
         if self.block().endswith('list'):
             lines = [lines]
         self.HLD[-1].extend(lines)
-        Debug('HOLD extend: %s' % repr(lines), 4)
-        Debug('FULL HOLD: %s' % self.HLD, 4)
+        if DEBUG:
+            Debug('HOLD extend: %s' % repr(lines), 4)
+            Debug('FULL HOLD: %s' % self.HLD, 4)
 
     def blockin(self, block):
         ret = []
@@ -5276,14 +6174,14 @@ class BlockMaster:
         self.PRP.append({})
         self.count += 1
         if block == 'table':
-            self.tableparser = TableMaster()
+            self.tableparser = TableMaster(self.conv)
         # Deeper and deeper
         self.depth = len(self.BLK)
-        Debug('block ++ (%s): %s' % (block, self.BLK), 3)
+        if DEBUG:
+            Debug('block ++ (%s): %s' % (block, self.BLK), 3)
         return ret
 
     def blockout(self):
-        global AA_COUNT
 
         if not self.BLK:
             Error('No block to pop')
@@ -5293,7 +6191,7 @@ class BlockMaster:
         self.PRP.pop()
         self.depth = len(self.BLK)
 
-        if CONF['spread'] and blockname != 'table':
+        if self.config['spread'] and blockname != 'table':
             return []
 
         if blockname == 'table':
@@ -5309,62 +6207,57 @@ class BlockMaster:
             # Reset now. Mother block will have it all
             result = []
 
-        Debug('block -- (%s): %s' % (blockname, self.BLK), 3)
-        Debug('RELEASED (%s): %s' % (blockname, parsed), 3)
+        if DEBUG:
+            Debug('block -- (%s): %s' % (blockname, self.BLK), 3)
+            Debug('RELEASED (%s): %s' % (blockname, parsed), 3)
 
         # Save this top level block name (produced output)
         # The next block will use it
         if result:
             self.last = blockname
-            if TARGET == 'aat':
+            if self.target == 'aat':
                 final = []
-                if CONF['slides'] and blockname in ('list', 'numlist', 'deflist'):
-                    li = []
-                    for el in result:
-                       if not isinstance(el, str):
-                           li.append(el.encode('utf-8'))
-                       else:
-                           li.append(el)
-                    final.extend(' ' + line for line in aa_box(li, AA, CONF['width'] - 2, False))
+                if self.config['slides'] and blockname in ('list', 'numlist', 'deflist'):
+                    final.extend(' ' + line for line in aa_box(result, AA, self.config['width'] - 2, False))
                 else:
                     for line in result:
-                        if not line or (blockname == 'table' and not CONF['slides']): 
+                        if not line or (blockname == 'table' and not self.config['slides']): 
                             final.append(line)
                         else:
-                            if CONF['slides'] and blockname == 'table':
-                                final.append(line[:CONF['width']])
-                            elif CONF['slides']:
-                                final.extend(' ' + line for line in textwrap.wrap(line, CONF['width'] - 2))
-                            elif CONF['web'] and '<' in line:
-                                final.extend(aa_webwrap(line, CONF['width']))
+                            if self.config['slides'] and blockname == 'table':
+                                final.append(line[:self.config['width']])
+                            elif self.config['slides']:
+                                final.extend(' ' + line for line in textwrap.wrap(line, self.config['width'] - 2))
+                            elif self.config['web'] and '<' in line:
+                                final.extend(aa_webwrap(line, self.config['width']))
                             else:
-                                final.extend(textwrap.wrap(line, CONF['width']))
+                                final.extend(textwrap.wrap(line, self.config['width']))
                 result = final[:]
 
-            Debug('BLOCK: %s' % result, 6)
+            if DEBUG:
+                Debug('self.conv.block: %s' % result, 6)
 
         # ASCII Art processing
-        global AA_TITLE
-        if TARGET == 'aat' and CONF['slides'] and not CONF['toc-only'] and not CONF.get('art-no-title'):
-            n = (CONF['height'] - 1) - (AA_COUNT % (CONF['height'] - 1) + 1)
-            if n < len(result) and not (TITLE.level == 1 and blockname in ["title", "numtitle"]):
-                result = ([''] * n) + [aa_line(AA['bar1'], CONF['width'])] + aa_slide(AA_TITLE, AA['bar2'], CONF['width']) + [''] + result
-            if (blockname in ["title", "numtitle"] and TITLE.level == 1) or not AA_TITLE:
-                if not AA_TITLE:
-                    if CONF['headers']:
-                        AA_TITLE = CONF['header1'] or ' '
+        if self.target == 'aat' and self.config['slides'] and not self.config['toc-only'] and not self.config.get('art-no-title'):
+            n = (self.config['height'] - 1) - (self.conv.aa_count % (self.config['height'] - 1) + 1)
+            if n < len(result) and not (self.conv.title.level == 1 and blockname in ["title", "numtitle"]):
+                result = ([''] * n) + [aa_line(AA['bar1'], self.config['width'])] + aa_slide(self.conv.aa_title, AA['bar2'], self.config['width']) + [''] + result
+            if (blockname in ["title", "numtitle"] and self.conv.title.level == 1) or not self.conv.aa_title:
+                if not self.conv.aa_title:
+                    if self.config['headers']:
+                        self.conv.aa_title = self.config['header1'] or ' '
                     else:
-                        AA_TITLE = ' '
-                aa_title = aa_slide(AA_TITLE, AA['bar2'], CONF['width']) + ['']
-                if AA_COUNT:
-                    aa_title = ([''] * n) + [aa_line(AA['bar2'], CONF['width'])] + aa_title
+                        self.conv.aa_title = ' '
+                aa_title = aa_slide(self.conv.aa_title, AA['bar2'], self.config['width']) + ['']
+                if self.conv.aa_count:
+                    aa_title = ([''] * n) + [aa_line(AA['bar2'], self.config['width'])] + aa_title
                 result = aa_title + result
-            AA_COUNT += len(result)
+            self.conv.aa_count += len(result)
 
         return result
 
     def _last_escapes(self, line):
-        return doFinalEscape(TARGET, line)
+        return self.conv.do_final_escape(line)
 
     def _get_escaped_hold(self):
         ret = []
@@ -5392,12 +6285,12 @@ class BlockMaster:
 
         # The blank line after the block is always added
         if where == 'after' \
-            and rules['blanksaround' + blockname]:
+            and self.rules['blanksaround' + blockname]:
             return True
 
         # # No blank before if it's the first block of the body
         # elif where == 'before' \
-        #   and BLOCK.count == 1:
+        #   and self.conv.block.count == 1:
         #   return False
 
         # # No blank before if it's the first block of this level (nested)
@@ -5409,15 +6302,15 @@ class BlockMaster:
         # the previous block haven't added a blank line
         # (to avoid consecutive blanks)
         elif where == 'before' \
-            and rules['blanksaround' + blockname] \
-            and not rules.get('blanksaround' + self.last):
+            and self.rules['blanksaround' + blockname] \
+            and not self.rules.get('blanksaround' + self.last):
             return True
 
         # Nested quotes are handled here,
         # because the mother quote isn't closed yet
         elif where == 'before' \
             and blockname == 'quote' \
-            and rules['blanksaround' + blockname] \
+            and self.rules['blanksaround' + blockname] \
             and self.depth > 1:
             return True
 
@@ -5427,33 +6320,33 @@ class BlockMaster:
     def _apply_depth(self, line, level):
         # convert block depth into an indent in twips
         depth = level
-        multiply = rules['blockdepthmultiply']
-        if depth > 0 and rules['depthmultiplyplus']:
-            depth = depth + rules['depthmultiplyplus']
+        multiply = self.rules['blockdepthmultiply']
+        if depth > 0 and self.rules['depthmultiplyplus']:
+            depth = depth + self.rules['depthmultiplyplus']
         if multiply:
             depth = depth * multiply
-        return regex['_blockDepth'].sub(str(depth), line)
+        return self.regex['_blockDepth'].sub(str(depth), line)
 
     def _apply_list_level(self, line, level):
         mylevel = level
-        if rules['listlevelzerobased']:
+        if self.rules['listlevelzerobased']:
             mylevel = mylevel - 1
-        return regex['_listLevel'].sub(str(mylevel), line)
+        return self.regex['_listLevel'].sub(str(mylevel), line)
 
     def comment(self):
         return ''
 
     def raw(self):
         lines = self.hold()
-        return map(lambda x: doEscape(TARGET, x), lines)
+        return map(lambda x: self.conv.do_escape(x), lines)
 
     def tagged(self):
         return self.hold()
 
     def para(self):
         result = []
-        open_ = TAGS['paragraphOpen']
-        close = TAGS['paragraphClose']
+        open_ = self.tags['paragraphOpen']
+        close = self.tags['paragraphClose']
         lines = self._get_escaped_hold()
 
         # Blank line before?
@@ -5462,7 +6355,7 @@ class BlockMaster:
 
         # RTF needs depth level encoded into nested paragraphs
         mydepth = self.depth
-        if rules['zerodepthparagraph']:
+        if self.rules['zerodepthparagraph']:
             mydepth = 0
         open_ = self._apply_depth(open_, mydepth)
 
@@ -5471,7 +6364,7 @@ class BlockMaster:
             result.append(open_)
 
         # Pagemaker likes a paragraph as a single long line
-        if rules['onelinepara']:
+        if self.rules['onelinepara']:
             result.append(' '.join(lines))
         # Others are normal :)
         else:
@@ -5489,7 +6382,7 @@ class BlockMaster:
         # Needed because <center> can't appear inside <p>
         try:
             if len(lines) == 1 and \
-               TARGET in ('html', 'xhtml', 'xhtmls') and \
+               self.target in ('html', 'xhtml', 'xhtmls') and \
                re.match('^\s*<center>.*</center>\s*$', lines[0]):
                 result = [lines[0]]
         except:
@@ -5500,9 +6393,9 @@ class BlockMaster:
     def verb(self):
         "Verbatim lines are not masked, so there's no need to unmask"
         result = []
-        open_ = TAGS['blockVerbOpen']
-        close = TAGS['blockVerbClose']
-        sep = TAGS['blockVerbSep']
+        open_ = self.tags['blockVerbOpen']
+        close = self.tags['blockVerbClose']
+        sep = self.tags['blockVerbSep']
 
         # Blank line before?
         if self._should_add_blank_line('before', 'verb'):
@@ -5515,15 +6408,15 @@ class BlockMaster:
         # Get contents
         for line in self.hold():
             if self.prop('mapped') == 'table':
-                line = MacroMaster().expand(line)
-            if not rules['verbblocknotescaped']:
-                line = doEscape(TARGET, line)
-            if TAGS['blockVerbLine']:
-                line = TAGS['blockVerbLine'] + line
-            if rules['indentverbblock']:
+                line = MacroMaster(self.conv).expand(line)
+            if not self.rules['verbblocknotescaped']:
+                line = self.conv.do_escape(line)
+            if self.tags['blockVerbLine']:
+                line = self.tags['blockVerbLine'] + line
+            if self.rules['indentverbblock']:
                 line = '  ' + line
-            if rules['verbblockfinalescape']:
-                line = doFinalEscape(TARGET, line)
+            if self.rules['verbblockfinalescape']:
+                line = self.conv.do_final_escape(line)
             result.append(line)
             if sep:
                 result.append(sep)
@@ -5552,7 +6445,7 @@ class BlockMaster:
             result.append('')
 
         # Get contents
-        result.extend(TITLE.get())
+        result.extend(self.conv.title.get())
 
         # Blank line after?
         if self._should_add_blank_line('after', name):
@@ -5564,20 +6457,20 @@ class BlockMaster:
         self.tablecount += 1 
         result = []
 
-        if TARGET == 'aat':
-            if CONF['spread']:
-                return aa_table(self.tableparser.rows, AA, CONF['width'], True, True, True, 'Center', True) + ['']
+        if self.target == 'aat':
+            if self.config['spread']:
+                return aa_table(self.tableparser.rows, AA, self.config['width'], True, True, True, 'Center', True) + ['']
             else:
-                return aa_table(self.tableparser.rows, AA, CONF['width'], self.tableparser.border, self.tableparser.title, False, self.tableparser.align, False) + ['']
+                return aa_table(self.tableparser.rows, AA, self.config['width'], self.tableparser.border, self.tableparser.title, False, self.tableparser.align, False) + ['']
 
-        if TARGET == 'rst':
+        if self.target == 'rst':
             chars = AA.copy()
             if not self.tableparser.border:
                 chars['border'], chars['corner'], chars['side'] = '=', ' ', ' '
-            return aa_table(self.tableparser.rows, chars, CONF['width'], self.tableparser.border, self.tableparser.title, False, 'Left', False) + ['']
+            return aa_table(self.tableparser.rows, chars, self.config['width'], self.tableparser.border, self.tableparser.title, False, 'Left', False) + ['']
 
-        if TARGET == 'mgp':
-            aa_t = aa_table(self.tableparser.rows, AA, CONF['width'], True, self.tableparser.title, False, 'Left', False)
+        if self.target == 'mgp':
+            aa_t = aa_table(self.tableparser.rows, AA, self.config['width'], True, self.tableparser.title, False, 'Left', False)
             try:
                 import aafigure
                 t_name = 'table_' + str(self.tablecount) + '.png'
@@ -5586,7 +6479,7 @@ class BlockMaster:
             except:
                 return ['%font "mono"'] + aa_t + ['']
 
-        if TARGET == 'csv':
+        if self.target == 'csv':
             return [','.join([cell.strip() for cell in row['cells']]) for row in self.tableparser.rows] + ['']
 
         # Blank line before?
@@ -5594,8 +6487,8 @@ class BlockMaster:
             result.append('')
 
         # DocBook needs to know the number of columns
-        if TARGET == 'dbk':
-            result.append(re.sub('n_cols', self.tableparser.n_cols, TAGS['tableOpenDbk']))
+        if self.target == 'dbk':
+            result.append(re.sub('n_cols', self.tableparser.n_cols, self.tags['tableOpenDbk']))
 
         # Rewrite all table cells by the unmasked and escaped data
         lines = self._get_escaped_hold()
@@ -5608,22 +6501,22 @@ class BlockMaster:
         if self._should_add_blank_line('after', 'table'):
             result.append('')
 
-        if TARGET == 'ods':
+        if self.target == 'ods':
             result[0] = result[0][:-2] + ' ' + str(self.tablecount) + '">'
 
         return result
 
     def quote(self):
         result = []
-        open_  = TAGS['blockQuoteOpen']            # block based
-        close  = TAGS['blockQuoteClose']
-        qline  = TAGS['blockQuoteLine']            # line based
+        open_  = self.tags['blockQuoteOpen']            # block based
+        close  = self.tags['blockQuoteClose']
+        qline  = self.tags['blockQuoteLine']            # line based
         indent = tagindent = '\t' * self.depth
 
         # Apply rules
-        if rules['tagnotindentable']:
+        if self.rules['tagnotindentable']:
             tagindent = ''
-        if not rules['keepquoteindent']:
+        if not self.rules['keepquoteindent']:
             indent = ''
 
         # Blank line before?
@@ -5642,17 +6535,17 @@ class BlockMaster:
         # Get contents
         for item in self.hold():
             if type(item) == type([]):
-                if close and rules['quotenotnested']:
+                if close and self.rules['quotenotnested']:
                     result.append(tagindent + close)
                     itemisclosed = True
                 result.extend(item)        # subquotes
             else:
                 if open_ and itemisclosed:
                     result.append(tagindent + open_)
-                item = regex['quote'].sub('', item)  # del TABs
+                item = self.regex['quote'].sub('', item)  # del TABs
                 item = self._last_escapes(item)
-                if CONF['target'] == 'aat' and CONF['slides']:
-                    result.extend(aa_box([item], AA, CONF['width'] - 2))
+                if self.config['target'] == 'aat' and self.config['slides']:
+                    result.extend(aa_box([item], AA, self.config['width'] - 2))
                 else:
                     item = qline * self.depth + item
                     result.append(indent + item)  # quote line
@@ -5680,16 +6573,16 @@ class BlockMaster:
 
         # Set bar type
         if bar_chars.startswith('='):
-            bar_tag = TAGS['bar2']
+            bar_tag = self.tags['bar2']
         else:
-            bar_tag = TAGS['bar1']
+            bar_tag = self.tags['bar1']
 
         # To avoid comment tag confusion like <!-- ------ --> (sgml)
-        if TAGS['comment'].count('--'):
+        if self.tags['comment'].count('--'):
             bar_chars = bar_chars.replace('--', '__')
 
         # Get the bar tag (may contain \a)
-        result.append(regex['x'].sub(bar_chars, bar_tag))
+        result.append(self.regex['x'].sub(bar_chars, bar_tag))
 
         # Blank line after?
         if self._should_add_blank_line('after', 'bar'):
@@ -5708,23 +6601,23 @@ class BlockMaster:
         items     = self.hold()
         indent    = self.prop('indent')
         tagindent = indent
-        listline  = TAGS.get(name + 'ItemLine')
+        listline  = self.tags.get(name + 'ItemLine')
         itemcount = 0
 
         if name == 'deflist':
-            itemopen  = TAGS[name + 'Item1Open']
-            itemclose = TAGS[name + 'Item2Close']
-            itemsep   = TAGS[name + 'Item1Close'] +\
-                        TAGS[name + 'Item2Open']
+            itemopen  = self.tags[name + 'Item1Open']
+            itemclose = self.tags[name + 'Item2Close']
+            itemsep   = self.tags[name + 'Item1Close'] +\
+                        self.tags[name + 'Item2Open']
         else:
-            itemopen  = TAGS[name + 'ItemOpen']
-            itemclose = TAGS[name + 'ItemClose']
+            itemopen  = self.tags[name + 'ItemOpen']
+            itemclose = self.tags[name + 'ItemClose']
             itemsep   = ''
 
         # Apply rules
-        if rules['tagnotindentable']:
+        if self.rules['tagnotindentable']:
             tagindent = ''
-        if not rules['keeplistindent']:
+        if not self.rules['keeplistindent']:
             indent = tagindent = ''
 
         # RTF encoding depth
@@ -5733,14 +6626,14 @@ class BlockMaster:
 
         # ItemLine: number of leading chars identifies list depth
         if listline:
-            if rules['listlineafteropen']:
+            if self.rules['listlineafteropen']:
                 itemopen  = itemopen + listline * self.depth
             else:
                 itemopen  = listline * self.depth + itemopen
 
         # Adds trailing space on opening tags
-        if (name == 'list'    and rules['spacedlistitemopen']) or \
-           (name == 'numlist' and rules['spacednumlistitemopen']):
+        if (name == 'list'    and self.rules['spacedlistitemopen']) or \
+           (name == 'numlist' and self.rules['spacednumlistitemopen']):
             itemopen = itemopen + ' '
 
         # Remove two-blanks from list ending mark, to avoid <p>
@@ -5750,7 +6643,7 @@ class BlockMaster:
         if self._should_add_blank_line('before', name):
             result.append('')
 
-        if rules['blanksaroundnestedlist']:
+        if self.rules['blanksaroundnestedlist']:
             result.append('')
 
         # Tag each list item (multiline items), store in listbody
@@ -5761,9 +6654,9 @@ class BlockMaster:
 
             # Add "manual" item count for noautonum targets
             itemcount += 1
-            if name == 'numlist' and not rules['autonumberlist']:
+            if name == 'numlist' and not self.rules['autonumberlist']:
                 n = str(itemcount)
-                itemopen = regex['x'].sub(n, itemopenorig)
+                itemopen = self.regex['x'].sub(n, itemopenorig)
                 del n
 
             # Tag it
@@ -5776,8 +6669,8 @@ class BlockMaster:
                 listbody.append(tagindent + itemopen + term + itemsep)
             else:
                 fullitem = tagindent + itemopen
-                if TARGET in ('rst', 'aat'):
-                    listbody.append(item[0].decode('utf-8').replace(SEPARATOR, fullitem))
+                if self.target in ('rst', 'aat'):
+                    listbody.append(as_unicode(item[0]).replace(SEPARATOR, fullitem))
                 else:
                     listbody.append(item[0].replace(SEPARATOR, fullitem))
                 del item[0]
@@ -5787,32 +6680,32 @@ class BlockMaster:
             # Process next lines for this item (if any)
             for line in item:
                 if type(line) == type([]):  # sublist inside
-                    if rules['listitemnotnested'] and itemclose:
+                    if self.rules['listitemnotnested'] and itemclose:
                         listbody.append(tagindent + itemclose)
                         itemisclosed = True
-                    if TARGET == 'rst' and name == 'deflist':
+                    if self.target == 'rst' and name == 'deflist':
                         del line[0]
                     listbody.extend(line)
                 else:
                     line = self._last_escapes(line)
 
                     # Blank lines turns to <p>
-                    if not line and rules['parainsidelist']:
-                        line = indent + TAGS['paragraphOpen'] + TAGS['paragraphClose']
+                    if not line and self.rules['parainsidelist']:
+                        line = indent + self.tags['paragraphOpen'] + self.tags['paragraphClose']
                         line = line.rstrip()
                         widelist = 1
-                    elif not line and TARGET == 'rtf':
-                        listbody.append(TAGS['paragraphClose'])
-                        line = TAGS['paragraphOpen']
+                    elif not line and self.target == 'rtf':
+                        listbody.append(self.tags['paragraphClose'])
+                        line = self.tags['paragraphOpen']
                         line = self._apply_depth(line, self.depth)
 
                     # Some targets don't like identation here (wiki)
-                    if not rules['keeplistindent'] or (name == 'deflist' and rules['deflisttextstrip']):
+                    if not self.rules['keeplistindent'] or (name == 'deflist' and self.rules['deflisttextstrip']):
                         line = line.lstrip()
 
                     # Maybe we have a line prefix to add? (wiki)
-                    if name == 'deflist' and TAGS['deflistItem2LinePrefix']:
-                        line = TAGS['deflistItem2LinePrefix'] + line
+                    if name == 'deflist' and self.tags['deflistItem2LinePrefix']:
+                        line = self.tags['deflistItem2LinePrefix'] + line
 
                     listbody.append(line)
 
@@ -5820,30 +6713,30 @@ class BlockMaster:
             if itemclose and not itemisclosed:
                 listbody.append(tagindent + itemclose)
 
-        if not widelist and rules['compactlist']:
-            listopen = TAGS.get(name + 'OpenCompact')
-            listclose = TAGS.get(name + 'CloseCompact')
+        if not widelist and self.rules['compactlist']:
+            listopen = self.tags.get(name + 'OpenCompact')
+            listclose = self.tags.get(name + 'CloseCompact')
         else:
-            listopen  = TAGS.get(name + 'Open')
-            listclose = TAGS.get(name + 'Close')
+            listopen  = self.tags.get(name + 'Open')
+            listclose = self.tags.get(name + 'Close')
 
         # Open list (not nestable lists are only opened at mother)
         if listopen and not \
-           (rules['listnotnested'] and BLOCK.depth != 1):
+           (self.rules['listnotnested'] and self.conv.block.depth != 1):
             result.append(tagindent + listopen)
 
         result.extend(listbody)
 
         # Close list (not nestable lists are only closed at mother)
         if listclose and not \
-           (rules['listnotnested'] and self.depth != 1):
+           (self.rules['listnotnested'] and self.depth != 1):
             result.append(tagindent + listclose)
 
         # Blank line after?
         if self._should_add_blank_line('after', name):
             result.append('')
 
-        if rules['blanksaroundnestedlist']:
+        if self.rules['blanksaroundnestedlist']:
             if result[-1]:
                 result.append('')
 
@@ -5854,14 +6747,15 @@ class BlockMaster:
 
 
 class MacroMaster:
-    def __init__(self, config={}):
+    def __init__(self, conv):
         self.name     = ''
-        self.config   = config or CONF
+        self.config   = conv.config
+        self.target   = conv.target
         self.infile   = self.config['sourcefile']
         self.outfile  = self.config['outfile']
         self.currentfile = self.config['currentsourcefile']
         self.currdate = time.localtime(time.time())
-        self.rgx      = regex.get('macros') or getRegexes()['macros']
+        self.rgx      = conv.regex['macros']
         self.fileinfo = {'infile': None, 'outfile': None}
         self.dft_fmt  = MACROS
 
@@ -5968,7 +6862,7 @@ class MacroMaster:
             elif name == 'appversion':
                 txt = my_version
             elif name == 'target':
-                txt = TARGET
+                txt = self.target
             elif name == 'encoding':
                 txt = self.config['encoding']
             elif name == 'cmdline':
@@ -6113,40 +7007,231 @@ def post_voodoo(lines, config):
     return subject.split('\n')
 
 
-def finish_him(outlist, config):
-    "Writing output to screen or file"
+def iter_finish(lines, config, stats=None):
+    "Yields the final output lines: unmasked, split and PostProc'ed"
+    post_filter = None
+    if config['postproc']:
+        post_filter = FilterMaster(config['postproc'], 'PostProc',
+            _('Invalid PostProc filter regex'),
+            _('Invalid PostProc filter replacement'))
+        if stats:
+            stats.watch(post_filter, 'apply', 'postproc')
+    nested = None
+    if config.get('nested-rules'):
+        nested = NestedMaster(config['target'])
+        if stats:
+            stats.watch(nested, 'postproc', 'postproc')
+    for line in lines:
+        for line in unmaskEscapeChar(line).split('\n'):
+            # Apply PostProc filters, then the Nested rules
+            if post_filter:
+                line = post_filter.apply(line)
+            if nested:
+                line = nested.postproc(line)
+            yield line
+    if post_filter:
+        post_filter.report()
+
+
+def spool_lines(lines):
+    "Saves the lines to a temporary file, returns an iterator to read them"
+    import tempfile
+    spool = tempfile.TemporaryFile()
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= STREAM_BUFFER:
+            marshal.dump(batch, spool)
+            batch = []
+    marshal.dump(batch, spool)
+    spool.seek(0)
+    return _iter_spool(spool)
+
+
+def _iter_spool(spool):
+    try:
+        while True:
+            try:
+                batch = marshal.load(spool)
+            except EOFError:
+                break
+            for line in batch:
+                yield line
+    finally:
+        spool.close()
+
+
+def can_stream(config):
+    "Returns True if the document can be streamed by Converter.iter_document()"
+    # These need the full body to compose the document
+    if config['target'] in ('aat', 'rst', 'mgp'):
+        return False
+    for key in ('toc-only', 'dump-source', 'postvoodoo', 'css-inside', 'split'):
+        if config.get(key):
+            return False
+    return True
+
+
+def getEmbedded(config):
+    """
+    Returns the (mark, paths) of the images embedded by this conversion
+
+    It's None but for RTF with --embed-images. The Converter sets it on
+    config, with a new random mark, and adds the image paths as it tags
+    them. Only the marks with their index on paths are expanded.
+    """
+    if config.get('target') != 'rtf' or not config.get('embed-images'):
+        return None
+    return config.get('embedded')
+
+
+def getEmbedMark(embedded, filename):
+    "Returns the mark to be expanded to the image data at writing time"
+    mark, paths = embedded
+    paths.append(filename)
+    return '%s%dvvv' % (mark, len(paths) - 1)
+
+
+def iter_embedded(lines, embedded, cache=None):
+    """Yields the lines with the embedded images marks expanded
+
+    The image data is streamed from the file, so a line with images is
+    yielded in parts. The cache dict keeps the small images encoded,
+    by (path, mtime). If embedded (see getEmbedded) is None, the lines
+    are yielded as they are.
+    """
+    if not embedded:
+        for line in lines:
+            yield line
+        return
+    mark, paths = embedded
+    regex = re.compile(re.escape(mark) + '([0-9]+)vvv')
+    if cache is None:
+        cache = {}
+    for line in lines:
+        if mark not in line:
+            yield line
+            continue
+        parts = regex.split(line)
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if part:
+                    yield part
+            elif int(part) < len(paths):
+                for chunk in iter_image_data(paths[int(part)], cache):
+                    yield chunk
+            else:
+                yield '%s%svvv' % (mark, part)
+
+
+def iter_image_data(filename, cache):
+    "Yields the image file data encoded in hex, in chunks"
+    try:
+        info = os.stat(filename)
+        key = (filename, info.st_mtime)
+        data = cache.get(key)
+        if data is None:
+            filein = open(filename, 'rb')
+    except (IOError, OSError):
+        Error('Unable to embed image: ' + filename)
+    if data is not None:
+        yield data
+        return
+    keep = info.st_size <= EMBED_CACHE_SIZE
+    data = []
+    try:
+        while True:
+            chunk = filein.read(EMBED_BUFFER)
+            if not chunk:
+                break
+            chunk = chunk.encode('hex')
+            if keep:
+                data.append(chunk)
+            yield chunk
+    finally:
+        filein.close()
+    if keep:
+        cache[key] = ''.join(data)
+
+
+def print_lines(lines, encoding='utf-8', embedded=None, target=''):
+    "Prints the output lines, expanding the embedded images"
+    cache = {}
+    for line in iter_encoded(lines, encoding, target):
+        if embedded and embedded[0] in line:
+            for part in iter_embedded([line], embedded, cache):
+                sys.stdout.write(part)
+            print
+        else:
+            print line
+
+
+def join_embedded(lines, embedded):
+    "Returns the output lines with the embedded images expanded in memory"
+    if not embedded:
+        return lines
+    cache = {}
+    return [''.join(iter_embedded([line], embedded, cache))
+            for line in lines]
+
+
+def stream_him(lines, config):
+    "Writing output lines to screen or file as they come, see finish_him()"
     outfile = config['outfile']
-    outlist = unmaskEscapeChar(outlist)
-    outlist = expandLineBreaks(outlist)
+    lines = iter_finish(lines, config)
+    encoding = get_output_encoding(config)
+    embedded = getEmbedded(config)
+    if outfile == STDOUT:
+        print_lines(lines, encoding, embedded, config['target'])
+    else:
+        # The lines are converted as they're written, so they go to a
+        # temporary file first: on errors the old outfile is kept
+        tmp = '%s.%d.tmp' % (outfile, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+        except:
+            Error(_("Cannot open file for writing:") + ' ' + outfile)
+        try:
+            try:
+                lines = iter_encoded((line + LB for line in lines), encoding,
+                                     config['target'])
+                f.writelines(iter_embedded(lines, embedded))
+            finally:
+                f.close()
+            if os.path.exists(outfile):  # no replacing rename on Windows
+                os.remove(outfile)
+            os.rename(tmp, outfile)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if not QUIET:
+            print _('%s wrote %s') % (my_name, outfile)
 
-    # Apply PostProc filters
-    if config['postproc']:
-        filters = compile_filters(config['postproc'],
-            _('Invalid PostProc filter regex'))
-        postoutlist = []
-        errmsg = _('Invalid PostProc filter replacement')
-        for line in outlist:
-            for rgx, repl in filters:
-                try:
-                    line = rgx.sub(repl, line)
-                except:
-                    Error("%s: '%s'" % (errmsg, repl))
-            postoutlist.append(line)
-        outlist = postoutlist[:]
+
+def finish_him(outlist, config, stats=None):
+    "Writing output to screen or file"
+    outfile = config['outfile']
+    outlist = list(iter_finish(outlist, config, stats))
 
     if config['postvoodoo']:
-        outlist = post_voodoo(outlist, config)
+        if stats:
+            outlist = stats.call('postvoodoo', post_voodoo, outlist, config)
+        else:
+            outlist = post_voodoo(outlist, config)
 
+    embedded = getEmbedded(config)
     if outfile == MODULEOUT:
-        return outlist
+        return join_embedded(outlist, embedded)
     elif outfile == STDOUT:
         if GUI:
-            return outlist, config
+            return join_embedded(outlist, embedded), config
         else:
-            for line in outlist:
-                print line
+            print_lines(outlist, get_output_encoding(config), embedded,
+                        config['target'])
     else:
-        Savefile(outfile, addLineBreaks(outlist))
+        Savefile(outfile, iter_embedded(addLineBreaks(outlist), embedded),
+                 config['target'], get_output_encoding(config))
         if not GUI and not QUIET:
             print _('%s wrote %s') % (my_name, outfile)
 
@@ -6160,419 +7245,28 @@ def finish_him(outlist, config):
         os.system(sgml2html)
 
 
-def toc_inside_body(body, toc, config):
-    ret = []
-    if AUTOTOC:
-        return body                     # nothing to expand
-    toc_mark = MaskMaster().tocmask
-    # Expand toc mark with TOC contents
-    flag, n = False, 0
-    for i,line in enumerate(body):
-        if line.count(toc_mark):            # toc mark found
-            if config['toc']:
-                if config['target'] == 'aat' and config['slides']:
-                    j = i % (config['height'] - 1)
-                    title = body[i - j + 2 + n]
-                    ret.extend([''] * (config['height'] - j - 2 + n))
-                    ret.extend([aa_line(AA['bar1'], config['width'])] + toc + aa_slide(title, AA['bar2'], config['width']) + [''])
-                    flag = True
-                else:
-                    ret.extend(toc)     # include if --toc
-            else:
-                pass                # or remove %%toc line
-        else:
-            if flag and config['target'] == 'aat' and config['slides'] and body[i] == body[i + 4] == aa_line(AA['bar2'], config['width']):
-                end = [ret[-1]]
-                del ret[-1]
-                ret.extend([''] * (j - 6 - n) + end)
-                flag, n = False, n + 1
-                ret.append(line)            # common line
-            else:
-                ret.append(line)            # common line
-    return ret
-
-
-def toc_tagger(toc, config):
-    "Returns the tagged TOC, as a single tag or a tagged list"
-    ret = []
-    # Convert the TOC list (t2t-marked) to the target's list format
-    if config['toc-only'] or (config['toc'] and not TAGS['TOC']):
-        fakeconf = config.copy()
-        fakeconf['headers']    = 0
-        fakeconf['toc-only']   = 0
-        fakeconf['mask-email'] = 0
-        fakeconf['preproc']    = []
-        fakeconf['postproc']   = []
-        fakeconf['postvoodoo'] = []
-        fakeconf['css-sugar']  = 0
-        fakeconf['fix-path']   = 0
-        fakeconf['art-no-title']  = 1  # needed for --toc and --slides together, avoids slide title before TOC
-        ret, foo = convert(toc, fakeconf)
-        set_global_config(config)   # restore config
-    # Our TOC list is not needed, the target already knows how to do a TOC
-    elif config['toc'] and TAGS['TOC']:
-        ret = [TAGS['TOC']]
-    return ret
-
+#this converts proper \ue37f escapes to RTF \u-7297 escapes
+def convertUnicodeRTF(match, group=1):
+    num = int(match.group(group), 16)
+    if num > 32767:
+        num = num | -65536
+    return ESCCHAR + 'u' + str(num) + '?'
 
-def toc_formatter(toc, config):
-    "Formats TOC for automatic placement between headers and body"
 
-    if config['toc-only']:
-        return toc              # no formatting needed
-    if not config['toc']:
-        return []               # TOC disabled
-    ret = toc
+# RTF is ascii only: the cp1252 bytes above ascii range (but 255) turn
+# to \'hh escapes, the chars out of cp1252 were backslashreplace'd to
+# \xhh or \uhhhh, and are escaped in the same pass
+RTF_ANSI = dict([(chr(code), ESCCHAR + "'" + hex(code)[2:])
+                 for code in range(128, 255)])
+RTF_ESCAPE = re.compile(r'[\x80-\xfe]|\\x([0-9a-f]{2})|\\u([0-9a-f]{4})')
 
-    # Art: An automatic "Table of Contents" header is added to the TOC slide
-    if config['target'] == 'aat' and config['slides']:
-        n = (config['height'] - 1) - (len(toc) + 6) % (config['height'] - 1)
-        toc = aa_slide(config['toc-title'] or _("Table of Contents"), AA['bar2'], config['width']) + toc + ([''] * n)
-        toc.append(aa_line(AA['bar2'], config['width']))
-        return toc
-    if config['target'] == 'aat' and not config['slides']:
-        ret = aa_box([config['toc-title'] or _("Table of Contents")], AA, config['width']) + toc
-
-    # TOC open/close tags (if any)
-    if TAGS['tocOpen']:
-        ret.insert(0, TAGS['tocOpen'])
-    if TAGS['tocClose']:
-        ret.append(TAGS['tocClose'])
-
-    # Autotoc specific formatting
-    if AUTOTOC:
-        if rules['autotocwithbars']:           # TOC between bars
-            para = TAGS['paragraphOpen'] + TAGS['paragraphClose']
-            bar  = regex['x'].sub('-' * DFT_TEXT_WIDTH, TAGS['bar1'])
-            tocbar = [para, bar, para]
-            if config['target'] == 'aat' and config['headers']:
-                # exception: header already printed a bar
-                ret = [para] + ret + tocbar
-            else:
-                ret = tocbar + ret + tocbar
-        if rules['blankendautotoc']:           # blank line after TOC
-            ret.append('')
-        if rules['autotocnewpagebefore']:      # page break before TOC
-            ret.insert(0, TAGS['pageBreak'])
-        if rules['autotocnewpageafter']:       # page break after TOC
-            ret.append(TAGS['pageBreak'])
-    return ret
 
-
-# XXX change function name. Now it's called at the end of the execution, dumping the full template.
-def doHeader(headers, config):
-    if not config['headers']:
-        return config['fullBody']
-    if not headers:
-        headers = ['', '', '']
-    target = config['target']
-    if target not in HEADER_TEMPLATE:
-        Error("doHeader: Unknown target '%s'" % target)
-
-    # Use default templates
-    if config['template'] == '' :
-        if target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-sugar'):
-            template = HEADER_TEMPLATE[target + 'css'].split('\n')
-        else:
-            template = HEADER_TEMPLATE[target].split('\n')
-
-        template.append('%(BODY)s')
-
-        if TAGS['EOD']:
-            template.append(TAGS['EOD'].replace('%', '%%'))  # escape % chars
-
-    # Read user's template file
-    else:
-        if PathMaster().is_url(config['template']):
-            template = Readfile(config['template'], remove_linebreaks=1)
-        else:
-            templatefile = ''
-            names = [config['template'] + '.' + target, config['template']]
-            for filename in names:
-                if os.path.isfile(filename):
-                    templatefile = filename
-                    break
-            if not templatefile:
-                Error(_("Cannot find template file:") + ' ' + config['template'])
-            template = Readfile(templatefile, remove_linebreaks=1)
-
-    head_data = {'STYLE': [], 'ENCODING': ''}
-
-    # Fix CSS files path
-    config['stylepath_out'] = fix_css_out_path(config)
-
-    # Populate head_data with config info
-    for key in head_data.keys():
-        val = config.get(key.lower())
-        if key == 'STYLE' and 'html' in target:
-            val = config.get('stylepath_out') or []
-        # Remove .sty extension from each style filename (freaking tex)
-        # XXX Can't handle --style foo.sty, bar.sty
-        if target == 'tex' and key == 'STYLE':
-            val = map(lambda x: re.sub('(?i)\.sty$', '', x), val)
-        if key == 'ENCODING':
-            val = get_encoding_string(val, target)
-        head_data[key] = val
-
-    # Parse header contents
-    for i in 0, 1, 2:
-        # Expand macros
-        contents = MacroMaster(config=config).expand(headers[i])
-        # Escapes - on tex, just do it if any \tag{} present
-        if target != 'tex' or \
-          (target == 'tex' and re.search(r'\\\w+{', contents)):
-            contents = doEscape(target, contents)
-        if target == 'lout':
-            contents = doFinalEscape(target, contents)
-
-        head_data['HEADER%d' % (i + 1)] = contents
-
-    # When using --css-inside, the template's <STYLE> line must be removed.
-    # Template line removal for empty header keys is made some lines above.
-    # That's why we will clean STYLE now.
-    if target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-inside') and config.get('style'):
-        head_data['STYLE'] = []
-
-    Debug("Header Data: %s" % head_data, 1)
-
-    # ASCII Art and rst don't use a header template, aa_header() formats the header
-    if target == 'aat' and not config['spread']:
-        n_h = len([v for v in head_data if v.startswith("HEADER") and head_data[v]])
-        template = []
-        if n_h:
-            if config['slides']:
-                x = config['height'] - 3 - (n_h * 3)
-                n = x / (n_h + 1)
-                end = x % (n_h + 1)
-                template = aa_header(head_data, AA, config['width'], n, end)
-            else:
-                template = [''] + aa_header(head_data, AA, config['width'], 2, 0)
-        if config['slides']:
-            total = len(config['fullBody']) / (config['height'] - 1) 
-            l = aa_len_cjk(head_data['HEADER2'].decode('utf-8')) + aa_len_cjk(head_data['HEADER3'].decode('utf-8')) + 2
-            bar2 = aa_line(AA['bar2'], config['width'])
-            for i, line in enumerate(config['fullBody']):
-                if i % (config['height'] -1 ) == 1 and config['fullBody'][i - 1] == config['fullBody'][i + 3] == bar2:
-                    config['fullBody'][i] = (str(i / (config['height'] - 1) + 1) + '/' + str(total)).rjust(config['width'] - 1)
-                if i % (config['height'] -1 ) == 3 and config['fullBody'][i - 3] == config['fullBody'][i + 1] == bar2:
-                    if l < config['width']:
-                        config['fullBody'][i] = ' ' + head_data['HEADER2'] + ' ' * (config['width'] - l) + head_data['HEADER3'] + ' '
-        # Header done, let's get out
-        if config['web']:
-            head_web = ['<!doctype html><html><meta charset=UTF-8><title>' + config['header1'] + '</title><pre>']
-            foot_web = ['</pre></html>']
-            return head_web + template + config['fullBody'] + foot_web
-        else:
-            return template + config['fullBody']
-
-    if target =='rst':
-        template =[]
-        if head_data['HEADER1']:
-            template.extend(aa_under(head_data['HEADER1'], RST['title'], 10000, True))
-        if head_data['HEADER2']:
-            template.append(':Author: ' + head_data['HEADER2'])
-        if head_data['HEADER3']:
-            template.append(':Date: ' + head_data['HEADER3'])
-        return template + config['fullBody']
-
-    # Scan for empty dictionary keys
-    # If found, scan template lines for that key reference
-    # If found, remove the reference
-    # If there isn't any other key reference on the same line, remove it
-    #TODO loop by template line > key
-    for key in head_data.keys():
-        if head_data.get(key):
-            continue
-        for line in template:
-            if line.count('%%(%s)s' % key):
-                sline = line.replace('%%(%s)s' % key, '')
-                if not re.search(r'%\([A-Z0-9]+\)s', sline) and not rules['keepblankheaderline']:
-                    template.remove(line)
-
-    # Style is a multiple tag.
-    # - If none or just one, use default template
-    # - If two or more, insert extra lines in a loop (and remove original)
-    styles = head_data['STYLE']
-    if len(styles) == 1:
-        head_data['STYLE'] = styles[0]
-    elif len(styles) > 1:
-        style_mark = '%(STYLE)s'
-        for i in xrange(len(template)):
-            if template[i].count(style_mark):
-                while styles:
-                    template.insert(i + 1, template[i].replace(style_mark, styles.pop()))
-                del template[i]
-                break
-
-    # Expand macros on *all* lines of the template
-    template = map(MacroMaster(config=config).expand, template)
-    # Add Body contents to template data
-    if config['target'] == 'mgp':
-        li = []
-        for el in config['fullBody']:
-            if not isinstance(el, str):
-                li.append(el.encode('utf-8'))
-            else:
-                li.append(el)
-        head_data['BODY'] = '\n'.join(li)
-    else:
-        head_data['BODY'] = '\n'.join(config['fullBody'])
-    # Populate template with data (dict expansion)
-    template = '\n'.join(template) % head_data
-
-    # Adding CSS contents into template (for --css-inside)
-    # This code sux. Dirty++
-    if target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-inside') and \
-       config.get('stylepath'):
-        set_global_config(config)  # usually on convert(), needed here
-        for i in xrange(len(config['stylepath'])):
-            cssfile = config['stylepath'][i]
-            try:
-                contents = Readfile(cssfile, remove_linebreaks=1)
-                css = "\n%s\n%s\n%s\n%s\n" % (
-                    doCommentLine("Included %s" % cssfile),
-                    TAGS['cssOpen'],
-                    '\n'.join(contents),
-                    TAGS['cssClose'])
-                # Style now is content, needs escaping (tex)
-                #css = maskEscapeChar(css)
-            except:
-                Error(_("CSS include failed for %s") % cssfile)
-            # Insert this CSS file contents on the template
-            template = re.sub('(?i)(</HEAD>)', css + r'\1', template)
-            # template = re.sub(r'(?i)(\\begin{document})',
-            #       css + '\n' + r'\1', template)  # tex
-
-        # The last blank line to keep everything separated
-        template = re.sub('(?i)(</HEAD>)', '\n' + r'\1', template)
-
-    return template.split('\n')
-
-
-def doCommentLine(txt):
-    # The -- string ends a (h|sg|xht)ml comment :(
-    txt = maskEscapeChar(txt)
-    if TAGS['comment'].count('--') and txt.count('--'):
-        txt = re.sub('-(?=-)', r'-\\', txt)
-
-    if TAGS['comment']:
-        return regex['x'].sub(txt, TAGS['comment'])
-    return ''
-
-
-def doFooter(config):
-    ret = []
-
-    # No footer. The --no-headers option hides header AND footer
-    if not config['headers']:
-        return []
-
-    # Only add blank line before footer if last block doesn't added by itself
-    if not rules.get('blanksaround' + BLOCK.last):
-        ret.append('')
-
-    # Add txt2tags info at footer, if target supports comments
-    if TAGS['comment']:
-
-        # Not using TARGET_NAMES because it's i18n'ed.
-        # It's best to always present this info in english.
-        target = config['target']
-        if config['target'] == 'tex':
-            target = 'LaTeX2e'
-
-        t2t_version = '%s code generated by %s %s (%s)' % (target, my_name, my_version, my_url)
-        cmdline = 'cmdline: %s %s' % (my_name, ' '.join(config['realcmdline']))
-
-        ret.append(doCommentLine(t2t_version))
-        ret.append(doCommentLine(cmdline))
-
-    # Maybe we have a specific tag to close the document?
-    #if TAGS['EOD']:
-    #   ret.append(TAGS['EOD'])
-
-    return ret
-
-
-#this converts proper \ue37f escapes to RTF \u-7297 escapes
-def convertUnicodeRTF(match):
-    num = int(match.group(1), 16)
-    if num > 32767:
-        num = num | -65536
-    return ESCCHAR + 'u' + str(num) + '?'
-
-
-def doEscape(target, txt):
-    "Target-specific special escapes. Apply *before* insert any tag."
-    tmpmask = 'vvvvThisEscapingSuxvvvv'
-
-    if rules['escapexmlchars']:
-        txt = re.sub('&', '&amp;', txt)
-        txt = re.sub('<', '&lt;', txt)
-        txt = re.sub('>', '&gt;', txt)
-
-    if target == 'sgml':
-            txt = re.sub('\xff', '&yuml;', txt)  # "+y
-    elif target == 'pm6':
-        txt = re.sub('<', '<\#60>', txt)
-    elif target == 'mgp':
-        txt = re.sub('^%', ' %', txt)  # add leading blank to avoid parse
-    elif target == 'man':
-        txt = re.sub("^([.'])", '\\&\\1', txt)              # command ID
-        txt = txt.replace(ESCCHAR, ESCCHAR + 'e')           # \e
-    elif target == 'lout':
-        # TIP: / moved to FinalEscape to avoid //italic//
-        # TIP: these are also converted by lout:  ...  ---  --
-        txt = txt.replace(ESCCHAR, tmpmask)                 # \
-        txt = txt.replace('"', '"%s""' % ESCCHAR)           # "\""
-        txt = re.sub('([|&{}@#^~])', '"\\1"', txt)          # "@"
-        txt = txt.replace(tmpmask, '"%s"' % (ESCCHAR * 2))  # "\\"
-    elif target == 'tex':
-        # Mark literal \ to be changed to $\backslash$ later
-        txt = txt.replace(ESCCHAR, tmpmask)
-        txt = re.sub('([#$&%{}])', ESCCHAR + r'\1'  , txt)  # \%
-        txt = re.sub('([~^])'    , ESCCHAR + r'\1{}', txt)  # \~{}
-        txt = re.sub('([<|>])'   ,           r'$\1$', txt)  # $>$
-        txt = txt.replace(tmpmask, maskEscapeChar(r'$\backslash$'))
-        # TIP the _ is escaped at the end
-    elif target == 'rtf':
-        txt = txt.replace(ESCCHAR, ESCCHAR + ESCCHAR)
-        txt = re.sub('([{}])', ESCCHAR + r'\1', txt)
-        # RTF is ascii only
-        # If an encoding is declared, try to convert to RTF unicode
-        enc = get_encoding_string(CONF['encoding'], 'rtf')
-        if enc:
-            try:
-                txt = txt.decode(enc)
-            except:
-                Error('Problem decoding line "' % txt + '"')
-            txt = txt.encode('cp1252', 'backslashreplace')
-            # escape ANSI codes above ascii range
-            for code in range(128, 255):
-                txt = re.sub('%c' % code, ESCCHAR + "'" + hex(code)[2:], txt)
-            # some code were preescaped by txt.encode
-            txt = re.sub(r'\\x([0-9a-f]{2})', r"\\\'\1", txt)
-            #finally, convert escaped unicode chars to RTF format
-            txt = re.sub(r'\\u([0-9a-f]{4})', convertUnicodeRTF, txt)
-    return txt
-
-
-# TODO man: where - really needs to be escaped?
-def doFinalEscape(target, txt):
-    "Last escapes of each line"
-    if   target == 'pm6' :
-        txt = txt.replace(ESCCHAR + '<', r'<\#92><')
-    elif target == 'man' :
-        txt = txt.replace('-', r'\-')
-    elif target == 'sgml':
-        txt = txt.replace('[', '&lsqb;')
-    elif target == 'lout':
-        txt = txt.replace('/', '"/"')
-    elif target == 'tex' :
-        txt = txt.replace('_', r'\_')
-        txt = txt.replace('vvvvTexUndervvvv', '_')  # shame!
-    elif target == 'rtf':
-        txt = txt.replace('\t', ESCCHAR + 'tab')
-    return txt
+def convertRTFEscape(match):
+    if match.lastindex == 1:     # \xhh
+        return r"\\'" + match.group(1)
+    elif match.lastindex == 2:   # \uhhhh
+        return convertUnicodeRTF(match, 2)
+    return RTF_ANSI[match.group()]
 
 
 def EscapeCharHandler(action, data):
@@ -6630,38 +7324,214 @@ def compile_filters(filters, errmsg='Filter'):
     return filters
 
 
-def enclose_me(tagname, txt):
-    return TAGS.get(tagname + 'Open') + txt + TAGS.get(tagname + 'Close')
+# The compiled filters, by their (patt, repl) list
+FILTER_CACHE = {}
 
 
-def fix_relative_path(path):
+def get_filter_trigger(pattern, flags=0):
+    """Returns the longest literal text that any pattern match contains
+
+    Lines without this text can't be matched, so the filter is skipped
+    for them. Only ASCII literals are used, so the text can be searched
+    in both str and unicode lines. Returns '' if there's no such text.
     """
-    Fix image/link path to be relative to the source file path (issues 62, 63)
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except:
+        return ''
+    found = []
 
-    Leave the path untouched when:
-    - not using --fix-path
-    - path is an URL (or email)
-    - path is an #anchor
-    - path is absolute
-    - infile is STDIN
-    - outfile is STDOUT
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op == sre_parse.LITERAL and av < 128:
+                run.append(chr(av))
+                continue
+            found.append(''.join(run))
+            run = []
+            if op == sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0]:
+                walk(av[2])    # at least one repetition
+        found.append(''.join(run))
+    walk(parsed)
+    return max(found, key=len)
+
+
+class FilterMaster:
+    """
+    PreProc and PostProc filters engine
+
+    The filters are compiled just once, and the compiled filters are
+    cached for the next configs with the same filters list. Each filter
+    knows the literal text all its matches have (like ^^ or ,,), and is
+    only applied to the lines that contain it, so a bad replacement is
+    an error only once it's applied. With --debug, the calls, skips and
+    time spent by each filter are reported at the end.
+    """
+    def __init__(self, filters, name, errmsg_regex, errmsg_repl):
+        self.name = name
+        self.errmsg = errmsg_repl
+        self.filters = self._compile(filters, errmsg_regex)
+        self.timing = DEBUG
+        self.calls = [0] * len(self.filters)
+        self.skips = [0] * len(self.filters)
+        self.time = [0.0] * len(self.filters)
+
+    def _compile(self, filters, errmsg_regex):
+        key = []
+        for patt, repl in filters:
+            if hasattr(patt, 'pattern'):  # already compiled
+                key.append((patt.pattern, patt.flags, repl))
+            else:
+                key.append((patt, 0, repl))
+        key = tuple(key)
+        compiled = FILTER_CACHE.get(key)
+        if compiled is None:
+            compiled = []
+            for patt, flags, repl in key:
+                try:
+                    rgx = re.compile(patt, flags)
+                except:
+                    Error("%s: '%s'" % (errmsg_regex, patt))
+                trigger = get_filter_trigger(patt, rgx.flags)
+                nocase = rgx.flags & re.IGNORECASE
+                if nocase:
+                    trigger = trigger.lower()
+                    if rgx.flags & re.LOCALE:
+                        trigger = ''
+                compiled.append((rgx, repl, trigger, nocase))
+            compiled = FILTER_CACHE.setdefault(key, compiled)
+        return compiled
+
+    def apply(self, line):
+        "Applies all the filters to the line, returns it"
+        if self.timing:
+            return self._apply_timed(line)
+        lower = None
+        for rgx, repl, trigger, nocase in self.filters:
+            if trigger:
+                if not nocase:
+                    if trigger not in line:
+                        continue
+                else:
+                    if lower is None:
+                        lower = line.lower()
+                    if trigger not in lower:
+                        continue
+            try:
+                line = rgx.sub(repl, line)
+            except:
+                Error("%s: '%s'" % (self.errmsg, repl))
+            lower = None
+        return line
+
+    def _apply_timed(self, line):
+        for i, (rgx, repl, trigger, nocase) in enumerate(self.filters):
+            self.calls[i] += 1
+            start = time.time()
+            if trigger and trigger not in (nocase and line.lower() or line):
+                self.skips[i] += 1
+            else:
+                try:
+                    line = rgx.sub(repl, line)
+                except:
+                    Error("%s: '%s'" % (self.errmsg, repl))
+            self.time[i] += time.time() - start
+        return line
+
+    def report(self):
+        "Shows the filters stats on debug"
+        if not self.timing:
+            return
+        for i, (rgx, repl, trigger, nocase) in enumerate(self.filters):
+            Debug("%s filter %r: %d lines, %d skipped, %.4fs" % (
+                self.name, rgx.pattern, self.calls[i], self.skips[i],
+                self.time[i]), 6)
+
+
+# The Nested rules of each target kind, see NestedMaster
+NESTED_KINDS = {'html': 'html', 'xhtml': 'html', 'xhtmls': 'html',
+                'html5': 'html', 'tex': 'tex', 'txt': 'txt'}
+
+# On the source lines: (text, replacement), in order
+NESTED_PREPROC = {
+    'html': [('%xhtmls% ', ''), ('%html% ', ''),     # target comments
+             ('@@', "''<br />''")],                  # line break
+    'tex':  [('<<<', "'''"), ('>>>', "'''"),         # math block
+             ('%tex% ', ''), ('%latex% ', ''), ('%pdf% ', ''),
+             ('@@', "''\\newline{}''")],
+    'txt':  [('%txt% ', ''), ('%text% ', ''),
+             ('@@', '\n')],
+}
+
+# On the output lines: (text all the matches have, regex, replacement)
+NESTED_POSTPROC = {
+    'html': [
+        ('^^', re.compile(r'\^\^(.*?)\^\^'), r'<sup>\1</sup>'),    # sup
+        (',,', re.compile(r',,(.*?),,'), r'<sub>\1</sub>'),        # sub
+        ('<img ', re.compile(r'<img (.*?) src="(\d+)-'),          # size
+         r'<img \1 width="\2" src="'),
+        ('<img ', re.compile(r'<img (.*?) src="'),                # path
+         r'<img \1 src="media/images/'),
+    ],
+    'tex': [
+        (r'\^{}\^{}', re.compile(r'\\\^{}\\\^{}(.*?)\\\^{}\\\^{}'),
+         r'\\superscript{\1}'),
+        (',,', re.compile(r',,(.*?),,'), r'\\subscript{\1}'),
+        ('includegraphics{', re.compile(r'includegraphics\{(\d+)-'),
+         r'includegraphics[width=\1px]{'),
+        ('includegraphics', re.compile(r'includegraphics(.*?)\{'),
+         r'noindent\includegraphics\1{media/images/'),
+    ],
+    'txt': [
+        ('^^', re.compile(r'\^\^(.*?)\^\^'), r'\1'),
+        (',,', re.compile(r',,(.*?),,'), r'\1'),
+    ],
+}
+
+# HTML visual font tags (any case) and their semantic tags. The letters
+# are listed instead of using (?i), so the regex is searched by its < prefix
+NESTED_FONT_REGEX = re.compile(r'<(/?)([bBiIuUsS])>')
+NESTED_FONT_TAGS = {'b': 'strong', 'i': 'em', 'u': 'ins', 's': 'del'}
+
+
+def _nested_font_tag(match):
+    tag = NESTED_FONT_TAGS[match.group(2).lower()]
+    return '<' + match.group(1) + tag + '>'
 
-    Note: Keep this rules in sync with fix_css_out_path()
+
+class NestedMaster:
     """
-    if not CONF['fix-path'] \
-        or regex['link'].match(path) \
-        or path[0] == '#' \
-        or os.path.isabs(path) \
-        or CONF['sourcefile'] in [STDIN, MODULEIN] \
-        or CONF['outfile'] in [STDOUT, MODULEOUT]:
-        return path
+    The Nested rules of its targets, for config['nested-rules']
 
-    # Make sure the input path is relative to the correct source file.
-    # The path may be different from original source file when using %!include
-    inputpath = PathMaster().join(os.path.dirname(CONF['currentsourcefile']), path)
+    Nested adds to the html, tex and txt targets the target comments
+    (%tex% ...), @@ line breaks, the ^^sup^^ and ,,sub,, marks, the image
+    sizes (200-image.png) and media/images/ paths, and semantic HTML font
+    tags for the visual ones. They're applied after the user PreProc and
+    PostProc filters, each one only to the lines with its mark.
+    """
+    def __init__(self, target):
+        kind = NESTED_KINDS.get(target)
+        self.html = kind == 'html'
+        self.pre = NESTED_PREPROC.get(kind, [])
+        self.post = NESTED_POSTPROC.get(kind, [])
+
+    def preproc(self, line):
+        "Applies the rules to a source line, returns it"
+        for text, repl in self.pre:
+            if text in line:
+                line = line.replace(text, repl)
+        return line
 
-    # Now adjust the inputpath to be reachable from the output folder
-    return PathMaster().relpath(inputpath, os.path.dirname(CONF['outfile']))
+    def postproc(self, line):
+        "Applies the rules to an output line, returns it"
+        if self.html and NESTED_FONT_REGEX.search(line):
+            line = NESTED_FONT_REGEX.sub(_nested_font_tag, line)
+        for text, rgx, repl in self.post:
+            if text in line:
+                line = rgx.sub(repl, line)
+        return line
 
 
 def fix_css_out_path(config):
@@ -6710,159 +7580,6 @@ def fix_css_out_path(config):
     return stylepath_out
 
 
-def beautify_me(name, line):
-    "where name is: bold, italic, underline or strike"
-
-    # Exception: Doesn't parse an horizontal bar as strike
-    if name == 'strike' and regex['bar'].search(line):
-        return line
-
-    name  = 'font%s' % name.capitalize()
-    open_ = TAGS['%sOpen' % name]
-    close = TAGS['%sClose' % name]
-    txt = r'%s\1%s' % (open_, close)
-    line = regex[name].sub(txt, line)
-    return line
-
-
-def get_tagged_link(label, url):
-    ret = ''
-    target = CONF['target']
-    image_re = regex['img']
-
-    # Set link type
-    if regex['email'].match(url):
-        linktype = 'email'
-    else:
-        linktype = 'url'
-
-    # Escape specials from TEXT parts
-    label = doEscape(target, label)
-
-    # Escape specials from link URL
-    if not rules['linkable'] or rules['escapeurl']:
-        url = doEscape(target, url)
-
-    # Adding protocol to guessed link
-    guessurl = ''
-    if linktype == 'url' and \
-       re.match('(?i)' + regex['_urlskel']['guess'], url):
-        if url[0] in 'Ww':
-            guessurl = 'http://' + url
-        else:
-            guessurl = 'ftp://' + url
-
-        # Not link aware targets -> protocol is useless
-        if not rules['linkable']:
-            guessurl = ''
-
-    # Simple link (not guessed)
-    if not label and not guessurl:
-        if CONF['mask-email'] and linktype == 'email':
-            # Do the email mask feature (no TAGs, just text)
-            url = url.replace('@', ' (a) ')
-            url = url.replace('.', ' ')
-            url = "<%s>" % url
-            if rules['linkable']:
-                url = doEscape(target, url)
-            ret = url
-        else:
-            # Just add link data to tag
-            tag = TAGS[linktype]
-            ret = regex['x'].sub(url, tag)
-
-    # Named link or guessed simple link
-    else:
-        # Adjusts for guessed link
-        if not label:
-            label = url         # no protocol
-        if guessurl:
-            url = guessurl      # with protocol
-
-        # Image inside link!
-        if image_re.match(label):
-            if rules['imglinkable']:  # get image tag
-                label = parse_images(label)
-            else:                     # img@link !supported
-                img_path = image_re.match(label).group(1)
-                label = "(%s)" % fix_relative_path(img_path)
-
-        if TARGET == 'aat' and not CONF['slides'] and not CONF['web'] and not CONF['spread'] and not CONF['toc-only']:
-            for macro in MASK.macrobank:
-                macro = MASK.macroman.expand(macro)
-                url = url.replace(MASK.macromask, macro, 1)
-            if url not in AA_MARKS:
-                AA_MARKS.append(url)
-            url = str(AA_MARKS.index(url) + 1)
-
-        # Putting data on the right appearance order
-        if rules['labelbeforelink'] or not rules['linkable']:
-            urlorder = [label, url]   # label before link
-        else:
-            urlorder = [url, label]   # link before label
-
-        ret = TAGS["%sMark" % linktype]
-
-        # Exception: tag for anchor link is different from the link tag
-        if url.startswith('#') and TAGS['urlMarkAnchor']:
-            ret = TAGS['urlMarkAnchor']
-
-        # Add link data to tag (replace \a's)
-        for data in urlorder:
-            ret = regex['x'].sub(data, ret, 1)
-
-        if TARGET == 'rst' and '.. image::' in label:
-            ret = label[:-2] + TAGS['urlImg'] + url + label[-2:]
-
-    return ret
-
-
-def parse_deflist_term(line):
-    "Extract and parse definition list term contents"
-    img_re = regex['img']
-    term   = regex['deflist'].search(line).group(3)
-
-    # Mask image inside term as (image.jpg), where not supported
-    if not rules['imgasdefterm'] and img_re.search(term):
-        while img_re.search(term):
-            imgfile = img_re.search(term).group(1)
-            term = img_re.sub('(%s)' % imgfile, term, 1)
-
-    #TODO tex: escape ] on term. \], \rbrack{} and \verb!]! don't work :(
-    return term
-
-
-def get_image_align(line):
-    "Return the image (first found) align for the given line"
-
-    # First clear marks that can mess align detection
-    line = re.sub(SEPARATOR + '$', '', line)  # remove deflist sep
-    line = re.sub('^' + SEPARATOR, '', line)  # remove list sep
-    line = re.sub('^[\t]+'       , '', line)  # remove quote mark
-
-    # Get image position on the line
-    m = regex['img'].search(line)
-    ini = m.start()
-    head = 0
-    end = m.end()
-    tail = len(line)
-
-    # The align detection algorithm
-    if   ini == head and end != tail:
-        align = 'left'      # ^img + text$
-    elif ini != head and end == tail:
-        align = 'right'     # ^text + img$
-    else:
-        align = 'center'    # default align
-
-    # Some special cases
-    if BLOCK.isblock('table'):
-        align = 'center'    # ignore when table
-#   if TARGET == 'mgp' and align == 'center': align = 'center'
-
-    return align
-
-
 # Reference: http://www.iana.org/assignments/character-sets
 # http://www.drclue.net/F1.cgi/HTML/META/META.html
 def get_encoding_string(enc, target):
@@ -6980,7 +7697,6 @@ def get_infiles_config(infiles):
 
 
 def convert_this_files(configs):
-    global CONF
     for myconf, doc in configs:                 # multifile support
         target_head = []
         target_toc  = []
@@ -7001,8 +7717,18 @@ def convert_this_files(configs):
 
         # Parse the full marked body into tagged target
         first_body_line = (len(source_head) or 1) + len(source_conf) + 1
+        conv = Converter(myconf)
+
+        # Stream the output, the full document is never in memory
+        if not GUI and myconf['outfile'] != MODULEOUT and can_stream(myconf):
+            Message(_("Composing and saving the target document"), 1)
+            outlist = conv.iter_document(source_body, source_head,
+                                         firstlinenr=first_body_line)
+            stream_him(outlist, myconf)
+            continue
+
         Message(_("Composing target Body"), 1)
-        target_body, marked_toc = convert(source_body, myconf, firstlinenr=first_body_line)
+        target_body, marked_toc = conv.convert(source_body, firstlinenr=first_body_line)
 
         # If dump-source, we're done
         if myconf['dump-source']:
@@ -7012,7 +7738,7 @@ def convert_this_files(configs):
 
         # Close the last slide
         if myconf['slides'] and not myconf['toc-only'] and myconf['target'] == 'aat':
-            n = (myconf['height'] - 1) - (AA_COUNT % (myconf['height'] - 1) + 1)
+            n = (myconf['height'] - 1) - (conv.aa_count % (myconf['height'] - 1) + 1)
             target_body = target_body + ([''] * n) + [aa_line(AA['bar2'], myconf['width'])]
             if myconf['qa']:
                 n_before = (myconf['height'] - 24) / 2
@@ -7024,19 +7750,19 @@ def convert_this_files(configs):
                     target_body = target_body + head + [''] * (myconf['height'] - 7) + [aa_line(AA['bar2'], myconf['width'])]
 
         if myconf['target'] and not myconf['slides'] and not myconf['web'] and not myconf['spread'] and not myconf['toc-only']:
-            for i, url in enumerate(AA_MARKS):
+            for i, url in enumerate(conv.aa_marks):
                 target_body.extend(textwrap.wrap('[' + str(i + 1) + '] ' + url, myconf['width']))
 
         # Compose the target file Footer
         Message(_("Composing target Footer"), 1)
-        target_foot = doFooter(myconf)
+        target_foot = conv.do_footer()
 
         # Make TOC (if needed)
         Message(_("Composing target TOC"), 1)
-        tagged_toc  = toc_tagger(marked_toc, myconf)
-        target_toc  = toc_formatter(tagged_toc, myconf)
-        target_body = toc_inside_body(target_body, target_toc, myconf)
-        if not AUTOTOC and not myconf['toc-only']:
+        tagged_toc  = conv.toc_tagger(marked_toc)
+        target_toc  = conv.toc_formatter(tagged_toc)
+        target_body = conv.toc_inside_body(target_body, target_toc)
+        if not conv.autotoc and not myconf['toc-only']:
             target_toc = []
         # Finally, we have our document
         myconf['fullBody'] = target_toc + target_body + target_foot
@@ -7045,7 +7771,7 @@ def convert_this_files(configs):
         #TODO escape line before?
         #TODO see exceptions by tex and mgp
         Message(_("Composing target Headers"), 1)
-        outlist = doHeader(source_head, myconf)
+        outlist = conv.do_header(source_head)
 
         if myconf['target'] == 'aat' and myconf['web'] and not myconf['headers']:
             outlist = ['<pre>'] + outlist + ['</pre>']
@@ -7062,56 +7788,163 @@ def convert_this_files(configs):
             finish_him(outlist, myconf)
 
 
-def getImageInfo(filename):
-    "Get image type, dimensions, and pixel size."
+def convert_infile(infile):
+    """
+    Reads and converts a single input file, for the --jobs processes
+
+    Returns the screen output and the error message (if any), so the
+    main process can show them in the input files order.
+    """
+    import tempfile
+    stdout = sys.stdout
+    sys.stdout = tempfile.TemporaryFile()
+    errmsg = ''
+    try:
+        try:
+            convert_this_files([process_source_file(infile)])
+        except error, msg:
+            errmsg = str(msg)
+        except:
+            errmsg = getUnknownErrorMessage()
+        sys.stdout.seek(0)
+        return sys.stdout.read(), errmsg
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def init_jobs_process(cmdline_raw, rc_raw, flags):
+    "Sets the command line globals on the --jobs processes"
+    global CMDLINE_RAW, RC_RAW, DEBUG, VERBOSE, QUIET
+    CMDLINE_RAW, RC_RAW = cmdline_raw, rc_raw
+    DEBUG, VERBOSE, QUIET = flags
+
+
+def convert_infiles_parallel(infiles, jobs):
+    """
+    Converts the input files in a pool of jobs processes
+
+    The files are independent, so each process reads and converts a
+    file on its own. The screen output and the errors are shown in
+    the input files order, and all the files are converted even if
+    some of them fail.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, init_jobs_process,
+                                (CMDLINE_RAW, RC_RAW, (DEBUG, VERBOSE, QUIET)))
+    failed = 0
+    try:
+        for output, errmsg in pool.imap(convert_infile, infiles):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if errmsg:
+                failed += 1
+                sys.stderr.write("%s\n" % errmsg)
+                sys.stderr.flush()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if failed:
+        Error(_("%d of %d input files failed") % (failed, len(infiles)))
+
+
+def init_prerender_process(config):
+    "Sets the Converter of the Converter.prerender() processes"
+    global PRERENDER_CONVERTER, PRERENDER_FILTER, PRERENDER_NESTED
+    PRERENDER_CONVERTER = Converter(config)
+    PRERENDER_FILTER = PRERENDER_NESTED = None
+    if config['preproc']:
+        PRERENDER_FILTER = FilterMaster(config['preproc'], 'PreProc',
+            _('Invalid PreProc filter regex'),
+            _('Invalid PreProc filter replacement'))
+    if config.get('nested-rules'):
+        PRERENDER_NESTED = NestedMaster(config['target'])
+
+
+def prerender_lines(bodylines):
+    """
+    Returns the {line: tagged line} of the plain text body lines
+
+    The lines are read as Converter.iter_convert() does, the errors are
+    left for it to show, with the right line number.
+    """
+    conv, pre_filter = PRERENDER_CONVERTER, PRERENDER_FILTER
+    nested = PRERENDER_NESTED
+    tagged = {}
+    for line in bodylines:
+        line = line.rstrip('\n\r')
+        try:
+            if pre_filter:
+                line = pre_filter.apply(line)
+            if nested:
+                line = nested.preproc(line)
+            line = maskEscapeChar(line)
+            if line not in tagged:
+                tagged[line] = conv.tag_plain_line(line)
+        except error:
+            tagged[line] = None
+    for line, tagged_line in tagged.items():
+        if tagged_line is None:
+            del tagged[line]
+    return tagged
+
+
+def probeImage(filename):
+    """
+    Returns the image (type, width, height, bit_depth, colour_type, dpix, dpiy)
+
+    Just the image headers are read, a few KB at most, the pixel data is
+    never touched. PNG, JPEG, GIF and BMP are known, the type is None
+    for other files. Only PNG has the bit_depth and colour_type, the
+    others have 'bit_depth' and 'colour_type' strings instead.
+    Use cached_read(filename, probeImage) to read each image just once.
+    """
+    f = open(filename, 'rb')
     try:
-        f = open(filename, 'rb')
-        head = f.read(2)
+        head = f.read(54)
         # Default DPI (if none specified in image metadata) of 72
         dpix = 72
         dpiy = 72
-        if head == '\x89\x50':  # PNG format image
-            imgtype = 'png'
-            magic, length, chunkid, width, height, bit_depth, colour_type = struct.unpack('!6sI4sIIBBxxxxxxx', f.read(31))
-            if (magic == '\x4e\x47\x0d\x0a\x1a\x0a') and \
-                    (length > 0) and \
-                    (chunkid == 'IHDR'):
-                        chunk = f.read(8)
-                        # Now to find the DPI / Pixel dimensions
-                        while chunk:
-                            length, chunkid = struct.unpack('!I4s', chunk)
-                            if chunkid == 'pHYs':
-                                dpix, dpiy, units = struct.unpack('!IIbxxxx', f.read(13))
-                                if units == 1:
-                                    # PNG images have pixel dimensions in pixels per meter,
-                                    # convert to pixels per inch
-                                    dpix = dpix * 0.0257
-                                    dpiy = dpiy * 0.0257
-                                else:
-                                    # No pixel dimensions, set back to default
-                                    dpix = 72
-                                    dpiy = 72
-                            elif chunkid == 'IDAT':
-                                data = f.read(length)
-                                f.seek(4, 1)
-                            else:
-                                f.seek(length + 4, 1)
-                            chunk = f.read(8)
-                        f.close()
-                        return imgtype, width, height, bit_depth, colour_type, dpix, dpiy, data
-            else:
-                f.close()
-                Error('Cannot embed PNG image ' + filename + '. Badly formatted.')
+        if head[:2] == '\x89\x50':  # PNG format image
+            magic, length, chunkid, width, height, bit_depth, colour_type = struct.unpack('!6sI4sIIBB', head[2:26])
+            if (magic != '\x4e\x47\x0d\x0a\x1a\x0a') or \
+                    (length <= 0) or \
+                    (chunkid != 'IHDR'):
+                raise ValueError('Badly formatted PNG')
+            # Now to find the DPI / Pixel dimensions, that must come
+            # before the image data
+            f.seek(33)
+            chunk = f.read(8)
+            while len(chunk) == 8:
+                length, chunkid = struct.unpack('!I4s', chunk)
+                if chunkid == 'pHYs':
+                    dpix, dpiy, units = struct.unpack('!IIbxxxx', f.read(13))
+                    if units == 1:
+                        # PNG images have pixel dimensions in pixels per meter,
+                        # convert to pixels per inch
+                        dpix = dpix * 0.0257
+                        dpiy = dpiy * 0.0257
+                    else:
+                        # No pixel dimensions, set back to default
+                        dpix = 72
+                        dpiy = 72
+                elif chunkid == 'IDAT':
+                    break
+                else:
+                    f.seek(length + 4, 1)
+                chunk = f.read(8)
+            return 'png', width, height, bit_depth, colour_type, dpix, dpiy
 
-        elif head == '\xff\xd8':  # JPG format image
-            imgtype = 'jpeg'
+        elif head[:2] == '\xff\xd8':  # JPG format image
             # Jpeg format is insane. The image size chunk could be anywhere,
-            # so we need to search the whole file.
+            # so we need to walk the chunks until we find it.
+            f.seek(2)
             b = f.read(1)
             while (b != ''):
                 # Each chunk in a jpeg file is delimited by at least one
                 # \xff character, and possibly more for padding. Seek past 'em
-                while (b != '\xff'):
+                while (b != '\xff') and (b != ''):
                     b = f.read(1)
                 while (b == '\xff'):
                     b = f.read(1)
@@ -7142,158 +7975,107 @@ def getImageInfo(filename):
                 elif (b >= '\xc0') and (b <= '\xc3'):
                     # Image info chunk, which should include size in pixels
                     height, width = struct.unpack('!xxxHH', f.read(7))
-                    f.close()
-                    return imgtype, width, height, 'bit_depth', 'colour_type', dpix, dpiy, 'data'
-
-                else:
+                    return 'jpeg', width, height, 'bit_depth', 'colour_type', dpix, dpiy
+                elif b:
                     # Wrong chunk type. Get length of chunk and skip to the next one
                     size = struct.unpack('!H', f.read(2))
                     f.seek(size[0] - 2, 1)
                     b = f.read(1)
-            f.close()
             # No size information found
-            Error('Cannot embed JPG image ' + filename + '. Badly formatted.')
-        else:  # Not a supported image format
-            f.close()
-            Error('Cannot embed image ' + filename + '. Unsupported format.')
-    except:
-        Error('Cannot embed image ' + filename + '. Unable to open file.')
+            raise ValueError('Badly formatted JPEG')
 
-RTFIMGID = 1000  # Needed so each embedded image can have a unique ID number
-
-
-def embedImage(filename):
-    mytype, width, height, bit_depth, colour_type, dpix, dpiy, data = getImageInfo(filename)
-
-    if TARGET == 'rtf':
-        global RTFIMGID
-        RTFIMGID += 1
-        # Defalt DPI of images.
-        if dpix == 0 and dpiy == 0:
-            dpix = 72
-            dpiy = 72
-        try:
-            filein = open(filename, 'rb')
-            # RTF tags for an embedded bitmap image, with size in pixels and intended display size in twips.
-            # Size and dpi converted to float for division, as by default Python 2 will return an integer,
-            # probably truncated to 0 in most cases. This behavior is changed in Python3.
-            line = r'\\%sblip\\picw%d\\pich%d\\picwgoal%d\\picscalex100\\pichgoal%d\\picscaley100\\bliptag%d{\\*\\blipuid%016x}' \
-                    % (mytype, width, height, int(float(width) / float(dpix) * 1440.0), int(float(height) / float(dpiy) * 1440.0), RTFIMGID, RTFIMGID)
-            line = line + filein.read().encode('hex')
-            filein.close()
-            return line
-        except:
-            Error('Unable to embed image: ' + filename)
-
-    elif TARGET == 'aat':
-        if mytype not in ['png']:
-            Error("Cannot embed image " + filename + ". Unsupported " + mytype + " format with Ascii Art targets. You should use PNG.")
-        if colour_type == 3:
-            Error("Cannot embed image " + filename + ". Unsupported indexed-colour image type with Ascii Art targets. You should use greyscale or RGB.")
-        if bit_depth not in [8]:
-            Error("Cannot embed image " + filename + ". Unsupported bit depth with Ascii Art targets. You should use 8-bit pixels.")
-        import zlib
-        decomp = zlib.decompress(data)
-        n_byte = n_byte_alpha = (colour_type % 4 + 1)
-        if colour_type in [4, 6]:
-            n_byte_alpha = n_byte + 1
-        image = []
-        end_line = n_byte_alpha * width + 1
-        while decomp:
-            line = decomp[1:end_line]
-            line_img = []
-            while line:
-                if n_byte == 1:
-                    L, = struct.unpack('!B', line[:n_byte])
-                else:
-                    R, G, B = struct.unpack('!BBB', line[:n_byte])
-                    # ITU-R 601-2 luma transform
-                    L = int(0.299 * R + 0.587 * G + 0.114 * B)
-                line_img.append(L)
-                line = line[n_byte_alpha:]
-            image.append(line_img)
-            decomp = decomp[end_line:]
-        return aa_image(image)
+        elif head[:6] in ('GIF87a', 'GIF89a'):  # GIF format image
+            width, height = struct.unpack('<HH', head[6:10])
+            return 'gif', width, height, 'bit_depth', 'colour_type', dpix, dpiy
 
+        elif head[:2] == 'BM':  # BMP format image
+            header_size, = struct.unpack('<I', head[14:18])
+            if header_size == 12:  # OS/2 bitmap, no resolution
+                width, height = struct.unpack('<HH', head[18:22])
+            else:
+                width, height = struct.unpack('<ii', head[18:26])
+                ppmx, ppmy = struct.unpack('<ii', head[38:46])
+                # Pixels per meter, convert to pixels per inch
+                if ppmx > 0 and ppmy > 0:
+                    dpix = ppmx * 0.0254
+                    dpiy = ppmy * 0.0254
+            return 'bmp', width, abs(height), 'bit_depth', 'colour_type', dpix, dpiy
+
+        # Not a known image format
+        return None, 0, 0, 'bit_depth', 'colour_type', dpix, dpiy
+    finally:
+        f.close()
+
+
+def getImageData(filename):
+    "Returns the compressed pixel data of a PNG image, all its IDAT chunks"
+    data = []
+    f = open(filename, 'rb')
+    try:
+        f.seek(8)
+        chunk = f.read(8)
+        while len(chunk) == 8:
+            length, chunkid = struct.unpack('!I4s', chunk)
+            if chunkid == 'IDAT':
+                data.append(f.read(length))
+                f.seek(4, 1)
+            elif chunkid == 'IEND':
+                break
+            else:
+                f.seek(length + 4, 1)
+            chunk = f.read(8)
+    finally:
+        f.close()
+    return ''.join(data)
 
-def parse_images(line):
-    "Tag all images found"
-    global CONF
-    while regex['img'].search(line):
-        txt = regex['img'].search(line).group(1)
-        tag = TAGS['img']
 
-        txt = fix_relative_path(txt)
+def getImageInfo(filename, data=True):
+    """
+    Get image type, dimensions, and pixel size.
 
-        # If target supports image alignment, here we go
-        if rules['imgalignable']:
+    Only PNG and JPEG images can be embedded. The headers are cached
+    (see probeImage), the PNG pixel data is read if data is True.
+    """
+    try:
+        info = cached_read(filename, probeImage)
+        if info[0] not in ('png', 'jpeg'):
+            raise ValueError('Unsupported format')
+        pixels = 'data'
+        if info[0] == 'png' and data:
+            pixels = getImageData(filename)
+            if not pixels:
+                raise ValueError('No PNG image data')
+        return info + (pixels,)
+    except:
+        Error('Cannot embed image ' + filename + '. Unable to open file.')
 
-            align = get_image_align(line)         # right
-            align_name = align.capitalize()       # Right
 
-            # The align is a full tag, or part of the image tag (~A~)
-            if TAGS['imgAlign' + align_name]:
-                tag = TAGS['imgAlign' + align_name]
-            else:
-                align_tag = TAGS['_imgAlign' + align_name]
-                tag = regex['_imgAlign'].sub(align_tag, tag, 1)
-
-            # Dirty fix to allow centered solo images
-            if align == 'center' and TARGET in ('html', 'xhtml'):
-                rest = regex['img'].sub('', line, 1)
-                if re.match('^\s+$', rest):
-                    tag = "<center>%s</center>" % tag
-            if align == 'center' and TARGET == 'xhtmls':
-                rest = regex['img'].sub('', line, 1)
-                if re.match('^\s+$', rest):
-                    ## original (not validating):
-                    # tag = '<div style="text-align: center;">%s</div>' % tag
-                    ## dirty fix:
-                    # tag = '</p><div style="text-align: center;">%s</div><p>' % tag
-                    ## will validate, though img won't be centered:
-                    tag = '%s' % tag
-
-        # Rtf needs some tweaking
-        if TARGET == 'rtf' and not CONF.get('embed-images'):
-            # insert './' for relative paths if needed
-            if not re.match(r':/|:\\', txt):
-                tag = regex['x'].sub('./\a', tag, 1)
-            # insert image filename an extra time for readers that don't grok linked images
-            tag = regex['x'].sub(txt, tag, 1)
-
-        if TARGET == 'tex':
-            tag = re.sub(r'\\b', r'\\\\b', tag)
-            txt = txt.replace('_', 'vvvvTexUndervvvv')
-
-        if CONF.get('embed-images'):
-            # Embedded images find files from the same location as linked images,
-            # for consistant behaviour.
-            basedir = os.path.dirname(CONF.get('outfile'))
-            fullpath = PathMaster().join(basedir, txt)
-            txt = embedImage(fullpath)
-            if TARGET == 'aat':
-                return txt
-
-        # Ugly hack to avoid infinite loop when target's image tag contains []
-        tag = tag.replace('[', 'vvvvEscapeSquareBracketvvvv')
-
-        line = regex['img'].sub(tag, line, 1)
-        line = regex['x'].sub(txt, line, 1)
-
-        if TARGET == 'rst':
-            line = line.split('ENDIMG')[0] + line.split('ENDIMG')[1].strip()
-
-    return line.replace('vvvvEscapeSquareBracketvvvv', '[')
+# Contents of the files read on every conversion, see cached_read()
+INCLUDE_CACHE = {}
 
 
-def add_inline_tags(line):
-    # Beautifiers
-    for beauti in ('bold', 'italic', 'underline', 'strike'):
-        if regex['font%s' % beauti.capitalize()].search(line):
-            line = beautify_me(beauti, line)
+def cached_read(file_path, reader, *args):
+    """
+    Returns reader(file_path, *args), cached until the file changes
 
-    line = parse_images(line)
-    return line
+    Used for the files that are read again on every conversion, like
+    %!include, %!includeconf, templates and images. The cache is keyed
+    by the file path and checked against the file modification time
+    and size. STDIN and URLs are never cached.
+    """
+    if file_path == STDIN:
+        return reader(file_path, *args)
+    try:
+        st = os.stat(file_path)
+    except OSError:             # URL or missing file
+        return reader(file_path, *args)
+    key = (reader, os.path.abspath(file_path)) + args
+    stamp = (st.st_mtime, st.st_size)
+    data = INCLUDE_CACHE.get(key)
+    if data is None or data[0] != stamp:
+        data = (stamp, reader(file_path, *args))
+        INCLUDE_CACHE[key] = data
+    return data[1][:]
 
 
 def get_include_contents(file_, path=''):
@@ -7308,592 +8090,1878 @@ def get_include_contents(file_, path=''):
             file_ = file_[2:-2]  # remove marks
     # Handle remote dir execution
     filepath = PathMaster().join(path, file_)
-    # Read included file contents
-    lines = Readfile(filepath, remove_linebreaks=1)
     # Default txt2tags marked text, just BODY matters
     if id_ == 't2t':
-        lines = get_file_body(filepath)
+        lines = cached_read(filepath, get_file_body)
         lines.insert(0, '%%!currentfile: %s' % (filepath))
+    # Read included file contents
+    else:
+        lines = cached_read(filepath, Readfile, 1)  # remove linebreaks
         # This appears when included hit EOF with verbatim area open
         #lines.append('%%INCLUDED(%s) ends here: %s' % (id_, file_))
     return id_, lines
 
 
-def set_global_config(config):
-    global CONF, TAGS, regex, rules, TARGET
-    CONF   = config
-    rules  = getRules(CONF)
-    TAGS   = getTags(CONF)
-    regex  = getRegexes()
-    TARGET = config['target']  # save for buggy functions that need global
+class StatsMaster:
+    """
+    Opt-in wall time and call counts of the conversion stages
 
+        stats = StatsMaster()
+        body, toc = Converter(config, stats=stats).convert(lines)
+        data = stats.get()
 
-def convert(bodylines, config, firstlinenr=1):
-    global BLOCK, TITLE, MASK
+    The data is {'stages': {stage: {'calls': n, 'time': seconds}},
+    'counters': {name: n}}. The stages are preproc, block_loop, mask,
+    escape, inline_tags, toc and header for the Converter, postproc and
+    postvoodoo for finish_him(), and any other the caller adds. The times
+    are inclusive: block_loop includes masking, escaping and inline tags.
+    The counters are the lines and bytes in and out.
 
-    set_global_config(config)
+    The watched methods are wrapped only when a StatsMaster is given, so
+    there's no cost at all when it's off.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
 
-    target = config['target']
-    BLOCK = BlockMaster()
-    MASK  =  MaskMaster()
-    TITLE = TitleMaster()
+    def add(self, stage, elapsed, calls=1):
+        "Adds elapsed seconds in calls calls to the stage"
+        data = self.stages.setdefault(stage, [0, 0.0])
+        data[0] += calls
+        data[1] += elapsed
 
-    ret = []
-    dump_source = []
-    f_lastwasblank = 0
+    def count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def call(self, stage, func, *args):
+        "Returns func(*args), timed as the stage"
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.add(stage, time.time() - start)
 
-    # Compiling all PreProc regexes
-    pre_filter = compile_filters(
-        CONF['preproc'], _('Invalid PreProc filter regex'))
+    def watch(self, obj, method, stage):
+        "Times all the next calls to obj.method as the stage"
+        func = getattr(obj, method)
 
-    # Let's mark it up!
-    linenr = firstlinenr - 1
-    lineref = 0
-    while lineref < len(bodylines):
-        # Defaults
-        MASK.reset()
-        results_box = ''
+        def timed(*args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                self.add(stage, time.time() - start)
+        setattr(obj, method, timed)
 
-        untouchedline = bodylines[lineref]
-        dump_source.append(untouchedline)
+    def get(self):
+        "Returns the stages and counters data"
+        stages = {}
+        for stage, (calls, elapsed) in self.stages.items():
+            stages[stage] = {'calls': calls, 'time': elapsed}
+        return {'stages': stages, 'counters': self.counters.copy()}
 
-        line = re.sub('[\n\r]+$', '', untouchedline)   # del line break
 
-        # Apply PreProc filters
-        if pre_filter:
-            errmsg = _('Invalid PreProc filter replacement')
-            for rgx, repl in pre_filter:
+class MemoMaster:
+    """
+    Memoized tagged output of body chunks, for incremental conversions
+
+    The body is split in chunks at blank lines. When a chunk starts with
+    no open blocks, its tagged output is saved, keyed by its source
+    lines, the config and the converter state at that point (title
+    counters, ASCII Art counters, ...). The next conversion reuses it if
+    the same chunk is found again in the same context, so only edited
+    chunks (or chunks whose context changed) are converted again.
+
+        memo = MemoMaster()
+        body, toc = Converter(config).convert(lines, memo=memo)
+
+    Chunks with macros or special lines (%%date, %!include, ...) are
+    always converted, as their output doesn't depend only on the source.
+    The state of each conversion is on its MemoSession (see start()), so
+    a memo can be shared by conversions running at the same time. The
+    hits and misses are the totals of all the conversions.
+    """
+    def __init__(self, maxsize=20000):
+        self.maxsize = maxsize
+        self.bank = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, conv):
+        "Returns the MemoSession of a new conversion, None if it can't be memoized"
+        config = conv.config
+        if config['dump-source'] or config['embed-images'] or \
+           conv.target == 'mgp':  # mgp tables are rendered to image files
+            return None
+        conf = [(k, v) for k, v in config.items()
+                if k not in ('fullBody', 'currentsourcefile')]
+        conf.sort()
+        config_key = (repr(conf), getTargetCacheKey(config),
+                      tuple(sorted(RST.items())))
+        return MemoSession(self, config, config_key)
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            data = self.bank.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+        return data
+
+    def save(self, key, data, used):
+        self.lock.acquire()
+        try:
+            if len(self.bank) >= self.maxsize:
+                # Forget the chunks not used by the saving conversion
+                for k in self.bank.keys():
+                    if k not in used:
+                        del self.bank[k]
+                if len(self.bank) >= self.maxsize:
+                    self.bank.clear()
+            self.bank[key] = data
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.bank.clear()
+        finally:
+            self.lock.release()
+
+
+class MemoSession:
+    """
+    The MemoMaster state of a single conversion, see MemoMaster.start()
+
+    The chunks keys have the config of this conversion and the source
+    file being read when the chunk starts, as the included files and
+    the paths (--fix-path) are resolved from it.
+    """
+    def __init__(self, memo, config, config_key):
+        self.memo = memo
+        self.config = config
+        self.config_key = config_key
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def next_chunk(self, lines, start):
+        "Returns the index of the first line after the chunk at start"
+        i = start
+        total = len(lines)
+        # Contents lines, then the blank lines that close them
+        while i < total and lines[i].strip():
+            i += 1
+        while i < total and not lines[i].strip():
+            i += 1
+        return i
+
+    def is_memoizable(self, lines):
+        for line in lines:
+            if line.startswith('%!') or '%%' in line:
+                return False
+        return True
+
+    def get_key(self, lines, state):
+        types = tuple([type(line) for line in lines])
+        return (tuple(lines), types, state, self.config['currentsourcefile'],
+                self.config_key)
+
+    def get(self, key):
+        data = self.memo.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(key)
+        return data
+
+    def save_chunk(self, chunk, conv, ret, lastwasblank):
+        "Saves the output of a converted chunk, if it closed all blocks"
+        if conv.block.depth:
+            return
+        key, ret_start, toc_start = chunk
+        self.used.add(key)
+        self.memo.save(key, (ret[ret_start:], conv.title.toc[toc_start:],
+                             conv.get_state(), lastwasblank), self.used)
+
+
+class Converter:
+    """
+    Converter class - the conversion of a single document
+
+    All the state used while converting a document lives here: the
+    config, the target rules, tags and regexes, the block, title and
+    mask masters, the %%toc position and the ASCII Art counters.
+    Nothing is kept on module globals, so several documents can be
+    converted at the same time, even from different threads.
+
+        conv = Converter(config)
+        body, toc = conv.convert(bodylines)
+        toc = conv.toc_formatter(conv.toc_tagger(toc))
+        body = conv.toc_inside_body(body, toc)
+
+    The module functions convert(), doHeader(), toc_tagger() and
+    friends are kept as thin wrappers, see get_converter().
+    """
+    def __init__(self, config, stats=None):
+        self.config = config
+        self.target = config['target']
+        self.rules, self.tags, self.regex = getTargetSetup(config)
+        self.escaper = getEscaper(self.target, self.rules)
+        self.parse_cache = PARSE_CACHE  # the parsed lines, see parseLine()
+        self.block  = BlockMaster(self)
+        self.mask   = MaskMaster(self)
+        self.title  = TitleMaster(self)
+        self.autotoc  = 1    # turned off by %%toc
+        self.aa_count = 0
+        self.aa_title = ''
+        self.aa_marks = []
+        self.rtfimgid = 1000  # so each embedded image can have a unique ID
+        if self.target == 'rtf' and config['embed-images']:
+            # The mark and paths of the images, see getEmbedded()
+            mark = '%s%s-' % (EMBED_MARK, os.urandom(8).encode('hex'))
+            config['embedded'] = self.embedded = (mark, [])
+        self.marked_toc = []
+        self.prerendered = {}  # the plain text lines already tagged
+        self.stats = stats
+        if stats:
+            stats.watch(self, 'do_escape', 'escape')
+            stats.watch(self, 'add_inline_tags', 'inline_tags')
+            for method in ('toc_tagger', 'toc_formatter', 'toc_inside_body'):
+                stats.watch(self, method, 'toc')
+            stats.watch(self, 'do_header', 'header')
+
+    def get_state(self):
+        "Returns the state that is carried from a body chunk to the next"
+        block, title = self.block, self.title
+        return (block.count, block.last, block.tablecount,
+                tuple(title.count), title.level, title.last_level,
+                title.kind, title.txt, title.label, title.tag,
+                tuple(title.tag_hold), title.count_id, title.anchor_count,
+                self.autotoc, self.aa_count, self.aa_title,
+                tuple(self.aa_marks), self.rtfimgid)
+
+    def set_state(self, state):
+        "Restores a state saved by get_state()"
+        block, title = self.block, self.title
+        (block.count, block.last, block.tablecount,
+         count, title.level, title.last_level,
+         title.kind, title.txt, title.label, title.tag,
+         tag_hold, title.count_id, title.anchor_count,
+         self.autotoc, self.aa_count, self.aa_title,
+         aa_marks, self.rtfimgid) = state
+        title.count = list(count)
+        title.tag_hold = list(tag_hold)
+        self.aa_marks = list(aa_marks)
+
+    def toc_inside_body(self, body, toc):
+        config = self.config
+        ret = []
+        if self.autotoc:
+            return body                     # nothing to expand
+        toc_mark = self.mask.tocmask
+        # Expand toc mark with TOC contents
+        flag, n = False, 0
+        for i,line in enumerate(body):
+            if line.count(toc_mark):            # toc mark found
+                if config['toc']:
+                    if config['target'] == 'aat' and config['slides']:
+                        j = i % (config['height'] - 1)
+                        title = body[i - j + 2 + n]
+                        ret.extend([''] * (config['height'] - j - 2 + n))
+                        ret.extend([aa_line(AA['bar1'], config['width'])] + toc + aa_slide(title, AA['bar2'], config['width']) + [''])
+                        flag = True
+                    else:
+                        ret.extend(toc)     # include if --toc
+                else:
+                    pass                # or remove %%toc line
+            else:
+                if flag and config['target'] == 'aat' and config['slides'] and body[i] == body[i + 4] == aa_line(AA['bar2'], config['width']):
+                    end = [ret[-1]]
+                    del ret[-1]
+                    ret.extend([''] * (j - 6 - n) + end)
+                    flag, n = False, n + 1
+                    ret.append(line)            # common line
+                else:
+                    ret.append(line)            # common line
+        return ret
+
+    def toc_tagger(self, toc):
+        "Returns the tagged TOC, as a single tag or a tagged list"
+        config = self.config
+        ret = []
+        # Convert the TOC list (t2t-marked) to the target's list format
+        if config['toc-only'] or (config['toc'] and not self.tags['TOC']):
+            fakeconf = config.copy()
+            fakeconf['headers']    = 0
+            fakeconf['toc-only']   = 0
+            fakeconf['mask-email'] = 0
+            fakeconf['preproc']    = []
+            fakeconf['postproc']   = []
+            fakeconf['postvoodoo'] = []
+            fakeconf['nested-rules'] = 0
+            fakeconf['css-sugar']  = 0
+            fakeconf['fix-path']   = 0
+            fakeconf['cache']      = 0
+            fakeconf['art-no-title']  = 1  # needed for --toc and --slides together, avoids slide title before TOC
+            ret, foo = Converter(fakeconf).convert(toc)
+        # Our TOC list is not needed, the target already knows how to do a TOC
+        elif config['toc'] and self.tags['TOC']:
+            ret = [self.tags['TOC']]
+        return ret
+
+    def toc_formatter(self, toc):
+        "Formats TOC for automatic placement between headers and body"
+        config = self.config
+
+        if config['toc-only']:
+            return toc              # no formatting needed
+        if not config['toc']:
+            return []               # TOC disabled
+        ret = toc
+
+        # Art: An automatic "Table of Contents" header is added to the TOC slide
+        if config['target'] == 'aat' and config['slides']:
+            n = (config['height'] - 1) - (len(toc) + 6) % (config['height'] - 1)
+            toc = aa_slide(config['toc-title'] or _("Table of Contents"), AA['bar2'], config['width']) + toc + ([''] * n)
+            toc.append(aa_line(AA['bar2'], config['width']))
+            return toc
+        if config['target'] == 'aat' and not config['slides']:
+            ret = aa_box([config['toc-title'] or _("Table of Contents")], AA, config['width']) + toc
+
+        # TOC open/close tags (if any)
+        if self.tags['tocOpen']:
+            ret.insert(0, self.tags['tocOpen'])
+        if self.tags['tocClose']:
+            ret.append(self.tags['tocClose'])
+
+        # Autotoc specific formatting
+        if self.autotoc:
+            if self.rules['autotocwithbars']:           # TOC between bars
+                para = self.tags['paragraphOpen'] + self.tags['paragraphClose']
+                bar  = self.regex['x'].sub('-' * DFT_TEXT_WIDTH, self.tags['bar1'])
+                tocbar = [para, bar, para]
+                if config['target'] == 'aat' and config['headers']:
+                    # exception: header already printed a bar
+                    ret = [para] + ret + tocbar
+                else:
+                    ret = tocbar + ret + tocbar
+            if self.rules['blankendautotoc']:           # blank line after TOC
+                ret.append('')
+            if self.rules['autotocnewpagebefore']:      # page break before TOC
+                ret.insert(0, self.tags['pageBreak'])
+            if self.rules['autotocnewpageafter']:       # page break after TOC
+                ret.append(self.tags['pageBreak'])
+        return ret
+
+    # XXX change function name. Now it's called at the end of the execution, dumping the full template.
+    def do_header(self, headers):
+        config = self.config
+        if not config['headers']:
+            return config['fullBody']
+        if not headers:
+            headers = ['', '', '']
+        target = config['target']
+        if target not in HEADER_TEMPLATE:
+            Error("doHeader: Unknown target '%s'" % target)
+
+        # Use default templates
+        if config['template'] == '' :
+            template = getHeaderTemplate(config, self.tags)
+
+        # Read user's template file
+        else:
+            if PathMaster().is_url(config['template']):
+                template = Readfile(config['template'], remove_linebreaks=1)
+            else:
+                templatefile = ''
+                names = [config['template'] + '.' + target, config['template']]
+                for filename in names:
+                    if os.path.isfile(filename):
+                        templatefile = filename
+                        break
+                if not templatefile:
+                    Error(_("Cannot find template file:") + ' ' + config['template'])
+                template = cached_read(templatefile, Readfile, 1)
+
+        head_data = {'STYLE': [], 'ENCODING': ''}
+
+        # Fix CSS files path
+        config['stylepath_out'] = fix_css_out_path(config)
+
+        # Populate head_data with config info
+        for key in head_data.keys():
+            val = config.get(key.lower())
+            if key == 'STYLE' and 'html' in target:
+                val = config.get('stylepath_out') or []
+            # Remove .sty extension from each style filename (freaking tex)
+            # XXX Can't handle --style foo.sty, bar.sty
+            if target == 'tex' and key == 'STYLE':
+                val = map(lambda x: re.sub('(?i)\.sty$', '', x), val)
+            if key == 'ENCODING':
+                val = get_encoding_string(val, target)
+            head_data[key] = val
+
+        # Parse header contents
+        for i in 0, 1, 2:
+            # Expand macros
+            contents = MacroMaster(self).expand(headers[i])
+            # Escapes - on tex, just do it if any \tag{} present
+            if target != 'tex' or \
+              (target == 'tex' and re.search(r'\\\w+{', contents)):
+                contents = self.do_escape(contents)
+            if target == 'lout':
+                contents = self.do_final_escape(contents)
+
+            head_data['HEADER%d' % (i + 1)] = contents
+
+        # When using --css-inside, the template's <STYLE> line must be removed.
+        # Template line removal for empty header keys is made some lines above.
+        # That's why we will clean STYLE now.
+        if target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-inside') and config.get('style'):
+            head_data['STYLE'] = []
+
+        Debug("Header Data: %s" % head_data, 1)
+
+        # ASCII Art and rst don't use a header template, aa_header() formats the header
+        if target == 'aat' and not config['spread']:
+            n_h = len([v for v in head_data if v.startswith("HEADER") and head_data[v]])
+            template = []
+            if n_h:
+                if config['slides']:
+                    x = config['height'] - 3 - (n_h * 3)
+                    n = x / (n_h + 1)
+                    end = x % (n_h + 1)
+                    template = aa_header(head_data, AA, config['width'], n, end)
+                else:
+                    template = [''] + aa_header(head_data, AA, config['width'], 2, 0)
+            if config['slides']:
+                total = len(config['fullBody']) / (config['height'] - 1) 
+                l = aa_len_cjk(as_unicode(head_data['HEADER2'])) + aa_len_cjk(as_unicode(head_data['HEADER3'])) + 2
+                bar2 = aa_line(AA['bar2'], config['width'])
+                for i, line in enumerate(config['fullBody']):
+                    if i % (config['height'] -1 ) == 1 and config['fullBody'][i - 1] == config['fullBody'][i + 3] == bar2:
+                        config['fullBody'][i] = (str(i / (config['height'] - 1) + 1) + '/' + str(total)).rjust(config['width'] - 1)
+                    if i % (config['height'] -1 ) == 3 and config['fullBody'][i - 3] == config['fullBody'][i + 1] == bar2:
+                        if l < config['width']:
+                            config['fullBody'][i] = ' ' + head_data['HEADER2'] + ' ' * (config['width'] - l) + head_data['HEADER3'] + ' '
+            # Header done, let's get out
+            if config['web']:
+                head_web = ['<!doctype html><html><meta charset=UTF-8><title>' + config['header1'] + '</title><pre>']
+                foot_web = ['</pre></html>']
+                return head_web + template + config['fullBody'] + foot_web
+            else:
+                return template + config['fullBody']
+
+        if target =='rst':
+            template =[]
+            if head_data['HEADER1']:
+                template.extend(aa_under(head_data['HEADER1'], RST['title'], 10000, True))
+            if head_data['HEADER2']:
+                template.append(':Author: ' + head_data['HEADER2'])
+            if head_data['HEADER3']:
+                template.append(':Date: ' + head_data['HEADER3'])
+            return template + config['fullBody']
+
+        # Scan for empty dictionary keys
+        # If found, scan template lines for that key reference
+        # If found, remove the reference
+        # If there isn't any other key reference on the same line, remove it
+        #TODO loop by template line > key
+        for key in head_data.keys():
+            if head_data.get(key):
+                continue
+            for line in template:
+                if line.count('%%(%s)s' % key):
+                    sline = line.replace('%%(%s)s' % key, '')
+                    if not re.search(r'%\([A-Z0-9]+\)s', sline) and not self.rules['keepblankheaderline']:
+                        template.remove(line)
+
+        # Style is a multiple tag.
+        # - If none or just one, use default template
+        # - If two or more, insert extra lines in a loop (and remove original)
+        styles = head_data['STYLE']
+        if len(styles) == 1:
+            head_data['STYLE'] = styles[0]
+        elif len(styles) > 1:
+            style_mark = '%(STYLE)s'
+            for i in xrange(len(template)):
+                if template[i].count(style_mark):
+                    while styles:
+                        template.insert(i + 1, template[i].replace(style_mark, styles.pop()))
+                    del template[i]
+                    break
+
+        # Expand macros on *all* lines of the template
+        template = map(MacroMaster(self).expand, template)
+        # Add Body contents to template data
+        if config['target'] == 'mgp':
+            # The tables are unicode, the body follows the headers type
+            li = []
+            for el in config['fullBody']:
+                if isinstance(headers[0], unicode):
+                    li.append(as_unicode(el))
+                elif not isinstance(el, str):
+                    li.append(el.encode('utf-8'))
+                else:
+                    li.append(el)
+            head_data['BODY'] = '\n'.join(li)
+        else:
+            head_data['BODY'] = '\n'.join(config['fullBody'])
+        # Populate template with data (dict expansion)
+        template = '\n'.join(template) % head_data
+
+        # Adding CSS contents into template (for --css-inside)
+        # This code sux. Dirty++
+        if target in ('html', 'xhtml', 'xhtmls', 'html5') and config.get('css-inside') and \
+           config.get('stylepath'):
+            for i in xrange(len(config['stylepath'])):
+                cssfile = config['stylepath'][i]
                 try:
-                    line = rgx.sub(repl, line)
+                    contents = Readfile(cssfile, remove_linebreaks=1)
+                    css = "\n%s\n%s\n%s\n%s\n" % (
+                        self.do_comment_line("Included %s" % cssfile),
+                        self.tags['cssOpen'],
+                        '\n'.join(contents),
+                        self.tags['cssClose'])
+                    # Style now is content, needs escaping (tex)
+                    #css = maskEscapeChar(css)
                 except:
-                    Error("%s: '%s'" % (errmsg, repl))
+                    Error(_("CSS include failed for %s") % cssfile)
+                # Insert this CSS file contents on the template
+                template = re.sub('(?i)(</HEAD>)', css + r'\1', template)
+                # template = re.sub(r'(?i)(\\begin{document})',
+                #       css + '\n' + r'\1', template)  # tex
+
+            # The last blank line to keep everything separated
+            template = re.sub('(?i)(</HEAD>)', '\n' + r'\1', template)
 
-        line = maskEscapeChar(line)                  # protect \ char
-        linenr  += 1
-        lineref += 1
+        return template.split('\n')
 
-        Debug(repr(line), 2, linenr)  # heavy debug: show each line
+    def do_comment_line(self, txt):
+        # The -- string ends a (h|sg|xht)ml comment :(
+        txt = maskEscapeChar(txt)
+        if self.tags['comment'].count('--') and txt.count('--'):
+            txt = re.sub('-(?=-)', r'-\\', txt)
 
-        #------------------[ Comment Block ]------------------------
+        if self.tags['comment']:
+            return self.regex['x'].sub(txt, self.tags['comment'])
+        return ''
 
-        # We're already on a comment block
-        if BLOCK.block() == 'comment':
+    def do_footer(self):
+        config = self.config
+        ret = []
 
-            # Closing comment
-            if regex['blockCommentClose'].search(line):
-                ret.extend(BLOCK.blockout() or [])
-                continue
+        # No footer. The --no-headers option hides header AND footer
+        if not config['headers']:
+            return []
 
-            # Normal comment-inside line. Ignore it.
-            continue
+        # Only add blank line before footer if last block doesn't added by itself
+        if not self.rules.get('blanksaround' + self.block.last):
+            ret.append('')
 
-        # Detecting comment block init
-        if regex['blockCommentOpen'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('comment'))
-            continue
+        # Add txt2tags info at footer, if target supports comments
+        if self.tags['comment']:
 
-        #-------------------------[ Tagged Text ]----------------------
+            # Not using TARGET_NAMES because it's i18n'ed.
+            # It's best to always present this info in english.
+            target = config['target']
+            if config['target'] == 'tex':
+                target = 'LaTeX2e'
 
-        # We're already on a tagged block
-        if BLOCK.block() == 'tagged':
+            t2t_version = '%s code generated by %s %s (%s)' % (target, my_name, my_version, my_url)
+            cmdline = 'cmdline: %s %s' % (my_name, ' '.join(config['realcmdline']))
 
-            # Closing tagged
-            if regex['blockTaggedClose'].search(line):
-                ret.extend(BLOCK.blockout())
-                continue
+            ret.append(self.do_comment_line(t2t_version))
+            ret.append(self.do_comment_line(cmdline))
 
-            # Normal tagged-inside line
-            BLOCK.holdadd(line)
-            continue
+        # Maybe we have a specific tag to close the document?
+        #if self.tags['EOD']:
+        #   ret.append(self.tags['EOD'])
 
-        # Detecting tagged block init
-        if regex['blockTaggedOpen'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('tagged'))
-            continue
+        return ret
 
-        # One line tagged text
-        if regex['1lineTagged'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('tagged'))
-            line = regex['1lineTagged'].sub('', line)
-            BLOCK.holdadd(line)
-            ret.extend(BLOCK.blockout())
-            continue
+    def get_header_parts(self, headers):
+        "Returns the (head, foot) template lines around the body"
+        config = self.config
+        bodymask = 'vvvBODYvvv'
+        config['fullBody'] = [bodymask]
+        lines = self.do_header(headers)
+        config['fullBody'] = []
+        for i in xrange(len(lines)):
+            if bodymask in lines[i]:
+                # The body starts and ends inside the template lines
+                prefix, suffix = lines[i].split(bodymask, 1)
+                return lines[:i] + [prefix], [suffix] + lines[i + 1:]
+        return lines, None          # user template with no %(BODY)s
+
+    def iter_document(self, bodylines, headers, firstlinenr=1, memo=None,
+                      footer=True):
+        """Yields the full target document lines while converting
+
+        The streaming version of convert(), toc_*() and do_header(): the
+        lines are the same do_header() would return, but the tagged body
+        is never kept in memory. The header template is filled with a
+        placeholder where the body goes, and the body lines are placed
+        there as they're tagged. If a TOC is wanted, the tagged body is
+        spooled to a temporary file until the TOC is ready.
+
+        Not all the targets and options are supported, see can_stream().
+        """
+        config = self.config
+        toc_mark = self.mask.tocmask
+        body = self.iter_convert(bodylines, firstlinenr, memo)
+        toc = []
+
+        if config['toc']:
+            body = spool_lines(body)
+            tagged_toc = self.toc_tagger(self.marked_toc)
+            toc = self.toc_formatter(tagged_toc)
+            if not self.autotoc:
+                body = self._iter_toc_inside_body(body, toc)
+                toc = []
+        else:
+            # The %%toc lines are just removed
+            body = (line for line in body if toc_mark not in line)
+
+        fullbody = itertools.chain(toc, body)
+        if footer:
+            fullbody = itertools.chain(fullbody, self._iter_footer())
+
+        if not config['headers']:
+            for line in fullbody:
+                yield line
+            return
+
+        head, foot = self.get_header_parts(headers)
+        if foot is None:
+            for line in head:
+                yield line
+            return
+
+        # First and last body lines are glued to the template lines
+        prefix = head.pop()
+        suffix = foot.pop(0)
+        for line in head:
+            yield line
+        last = None
+        for line in fullbody:
+            if last is None:
+                line = prefix + line
+            else:
+                yield last
+            last = line
+        if last is None:
+            last = prefix
+        yield last + suffix
+        for line in foot:
+            yield line
+
+    def _iter_toc_inside_body(self, body, toc):
+        toc_mark = self.mask.tocmask
+        for line in body:
+            if toc_mark in line:
+                for tocline in toc:
+                    yield tocline
+            else:
+                yield line
+
+    def _iter_footer(self):
+        # Called when the body is done, so the last block is known
+        for line in self.do_footer():
+            yield line
+
+    def do_escape(self, txt):
+        "Target-specific special escapes. Apply *before* insert any tag."
+        txt = self.escaper.escape(txt)
+        if self.target == 'rtf':
+            txt = self.escape_rtf_ascii(txt)
+        return txt
+
+    def escape_rtf_ascii(self, txt):
+        "RTF is ascii only, escapes the codes above it"
+        # If an encoding is declared, try to convert to RTF unicode
+        # The unicode lines are already decoded
+        enc = get_encoding_string(self.config['encoding'], 'rtf')
+        if enc and not isinstance(txt, unicode):
+            try:
+                txt = txt.decode(enc)
+            except:
+                Error('Problem decoding line "%s"' % txt)
+        if isinstance(txt, unicode):
+            txt = txt.encode('cp1252', 'backslashreplace')
+            # escape ANSI codes above ascii range and the codes
+            # preescaped by txt.encode, all at once
+            txt = RTF_ESCAPE.sub(convertRTFEscape, txt)
+        return txt
+
+    def do_final_escape(self, txt):
+        "Last escapes of each line"
+        return self.escaper.final_escape(txt)
+
+    def enclose_me(self, tagname, txt):
+        return self.tags.get(tagname + 'Open') + txt + self.tags.get(tagname + 'Close')
+
+    def fix_relative_path(self, path):
+        """
+        Fix image/link path to be relative to the source file path (issues 62, 63)
+
+        Leave the path untouched when:
+        - not using --fix-path
+        - path is an URL (or email)
+        - path is an #anchor
+        - path is absolute
+        - infile is STDIN
+        - outfile is STDOUT
+
+        Note: Keep this rules in sync with fix_css_out_path()
+        """
+        if not self.config['fix-path'] \
+            or self.regex['link'].match(path) \
+            or path[0] == '#' \
+            or os.path.isabs(path) \
+            or self.config['sourcefile'] in [STDIN, MODULEIN] \
+            or self.config['outfile'] in [STDOUT, MODULEOUT]:
+            return path
+
+        # Make sure the input path is relative to the correct source file.
+        # The path may be different from original source file when using %!include
+        inputpath = PathMaster().join(os.path.dirname(self.config['currentsourcefile']), path)
+
+        # Now adjust the inputpath to be reachable from the output folder
+        return PathMaster().relpath(inputpath, os.path.dirname(self.config['outfile']))
+
+    def beautify_me(self, name, line):
+        "where name is: bold, italic, underline or strike"
+
+        # Exception: Doesn't parse an horizontal bar as strike
+        if name == 'strike' and self.regex['bar'].search(line):
+            return line
+
+        name  = 'font%s' % name.capitalize()
+        open_ = self.tags['%sOpen' % name]
+        close = self.tags['%sClose' % name]
+        txt = r'%s\1%s' % (open_, close)
+        line = self.regex[name].sub(txt, line)
+        return line
+
+    def get_tagged_link(self, label, url):
+        ret = ''
+        image_re = self.regex['img']
+
+        # Set link type
+        if self.regex['email'].match(url):
+            linktype = 'email'
+        else:
+            linktype = 'url'
+
+        # Escape specials from TEXT parts
+        label = self.do_escape(label)
 
-        #-------------------------[ Raw Text ]----------------------
+        # Escape specials from link URL
+        if not self.rules['linkable'] or self.rules['escapeurl']:
+            url = self.do_escape(url)
 
-        # We're already on a raw block
-        if BLOCK.block() == 'raw':
+        # Adding protocol to guessed link
+        guessurl = ''
+        if linktype == 'url' and \
+           re.match('(?i)' + self.regex['_urlskel']['guess'], url):
+            if url[0] in 'Ww':
+                guessurl = 'http://' + url
+            else:
+                guessurl = 'ftp://' + url
+
+            # Not link aware targets -> protocol is useless
+            if not self.rules['linkable']:
+                guessurl = ''
+
+        # Simple link (not guessed)
+        if not label and not guessurl:
+            if self.config['mask-email'] and linktype == 'email':
+                # Do the email mask feature (no TAGs, just text)
+                url = url.replace('@', ' (a) ')
+                url = url.replace('.', ' ')
+                url = "<%s>" % url
+                if self.rules['linkable']:
+                    url = self.do_escape(url)
+                ret = url
+            else:
+                # Just add link data to tag
+                tag = self.tags[linktype]
+                ret = self.regex['x'].sub(url, tag)
+
+        # Named link or guessed simple link
+        else:
+            # Adjusts for guessed link
+            if not label:
+                label = url         # no protocol
+            if guessurl:
+                url = guessurl      # with protocol
+
+            # Image inside link!
+            if image_re.match(label):
+                if self.rules['imglinkable']:  # get image tag
+                    label = self.parse_images(label)
+                else:                     # img@link !supported
+                    img_path = image_re.match(label).group(1)
+                    label = "(%s)" % self.fix_relative_path(img_path)
+
+            if self.target == 'aat' and not self.config['slides'] and not self.config['web'] and not self.config['spread'] and not self.config['toc-only']:
+                for macro in self.mask.macrobank:
+                    macro = self.mask.macroman.expand(macro)
+                    url = url.replace(self.mask.macromask, macro, 1)
+                if url not in self.aa_marks:
+                    self.aa_marks.append(url)
+                url = str(self.aa_marks.index(url) + 1)
+
+            # Putting data on the right appearance order
+            if self.rules['labelbeforelink'] or not self.rules['linkable']:
+                urlorder = [label, url]   # label before link
+            else:
+                urlorder = [url, label]   # link before label
+
+            ret = self.tags["%sMark" % linktype]
+
+            # Exception: tag for anchor link is different from the link tag
+            if url.startswith('#') and self.tags['urlMarkAnchor']:
+                ret = self.tags['urlMarkAnchor']
+
+            # Add link data to tag (replace \a's)
+            for data in urlorder:
+                ret = self.regex['x'].sub(data, ret, 1)
+
+            if self.target == 'rst' and '.. image::' in label:
+                ret = label[:-2] + self.tags['urlImg'] + url + label[-2:]
+
+        return ret
+
+    def parse_deflist_term(self, line):
+        "Extract and parse definition list term contents"
+        img_re = self.regex['img']
+        term   = self.regex['deflist'].search(line).group(3)
+
+        # Mask image inside term as (image.jpg), where not supported
+        if not self.rules['imgasdefterm'] and img_re.search(term):
+            while img_re.search(term):
+                imgfile = img_re.search(term).group(1)
+                term = img_re.sub('(%s)' % imgfile, term, 1)
+
+        #TODO tex: escape ] on term. \], \rbrack{} and \verb!]! don't work :(
+        return term
+
+    def get_image_align(self, line):
+        "Return the image (first found) align for the given line"
+
+        # First clear marks that can mess align detection
+        line = re.sub(SEPARATOR + '$', '', line)  # remove deflist sep
+        line = re.sub('^' + SEPARATOR, '', line)  # remove list sep
+        line = re.sub('^[\t]+'       , '', line)  # remove quote mark
+
+        # Get image position on the line
+        m = self.regex['img'].search(line)
+        ini = m.start()
+        head = 0
+        end = m.end()
+        tail = len(line)
+
+        # The align detection algorithm
+        if   ini == head and end != tail:
+            align = 'left'      # ^img + text$
+        elif ini != head and end == tail:
+            align = 'right'     # ^text + img$
+        else:
+            align = 'center'    # default align
+
+        # Some special cases
+        if self.block.isblock('table'):
+            align = 'center'    # ignore when table
+#       if self.target == 'mgp' and align == 'center': align = 'center'
+
+        return align
+
+    def embed_image(self, filename):
+        # RTF just needs the image headers, the data is streamed later
+        mytype, width, height, bit_depth, colour_type, dpix, dpiy, data = \
+            getImageInfo(filename, data=(self.target != 'rtf'))
+
+        if self.target == 'rtf':
+            self.rtfimgid += 1
+            # Defalt DPI of images.
+            if dpix == 0 and dpiy == 0:
+                dpix = 72
+                dpiy = 72
+            try:
+                open(filename, 'rb').close()
+                # RTF tags for an embedded bitmap image, with size in pixels and intended display size in twips.
+                # Size and dpi converted to float for division, as by default Python 2 will return an integer,
+                # probably truncated to 0 in most cases. This behavior is changed in Python3.
+                line = r'\\%sblip\\picw%d\\pich%d\\picwgoal%d\\picscalex100\\pichgoal%d\\picscaley100\\bliptag%d{\\*\\blipuid%016x}' \
+                        % (mytype, width, height, int(float(width) / float(dpix) * 1440.0), int(float(height) / float(dpiy) * 1440.0), self.rtfimgid, self.rtfimgid)
+                # The image data is streamed in at writing time, see iter_embedded()
+                return line + getEmbedMark(self.embedded, filename)
+            except:
+                Error('Unable to embed image: ' + filename)
+
+        elif self.target == 'aat':
+            if mytype not in ['png']:
+                Error("Cannot embed image " + filename + ". Unsupported " + mytype + " format with Ascii Art targets. You should use PNG.")
+            if colour_type == 3:
+                Error("Cannot embed image " + filename + ". Unsupported indexed-colour image type with Ascii Art targets. You should use greyscale or RGB.")
+            if bit_depth not in [8]:
+                Error("Cannot embed image " + filename + ". Unsupported bit depth with Ascii Art targets. You should use 8-bit pixels.")
+            import zlib
+            decomp = zlib.decompress(data)
+            return aa_image(aa_png_pixels(decomp, width, colour_type))
+
+    def parse_images(self, line):
+        "Tag all images found"
+        while True:
+            m = self.regex['img'].search(line)
+            if not m:
+                break
+            txt = m.group(1)
+            tag = self.tags['img']
+
+            txt = self.fix_relative_path(txt)
+
+            # If target supports image alignment, here we go
+            if self.rules['imgalignable']:
+
+                align = self.get_image_align(line)         # right
+                align_name = align.capitalize()       # Right
+
+                # The align is a full tag, or part of the image tag (~A~)
+                if self.tags['imgAlign' + align_name]:
+                    tag = self.tags['imgAlign' + align_name]
+                else:
+                    align_tag = self.tags['_imgAlign' + align_name]
+                    tag = self.regex['_imgAlign'].sub(align_tag, tag, 1)
+
+                # Dirty fix to allow centered solo images
+                if align == 'center' and self.target in ('html', 'xhtml'):
+                    rest = self.regex['img'].sub('', line, 1)
+                    if re.match('^\s+$', rest):
+                        tag = "<center>%s</center>" % tag
+                if align == 'center' and self.target == 'xhtmls':
+                    rest = self.regex['img'].sub('', line, 1)
+                    if re.match('^\s+$', rest):
+                        ## original (not validating):
+                        # tag = '<div style="text-align: center;">%s</div>' % tag
+                        ## dirty fix:
+                        # tag = '</p><div style="text-align: center;">%s</div><p>' % tag
+                        ## will validate, though img won't be centered:
+                        tag = '%s' % tag
+
+            # Rtf needs some tweaking
+            if self.target == 'rtf' and not self.config.get('embed-images'):
+                # insert './' for relative paths if needed
+                if not re.match(r':/|:\\', txt):
+                    tag = self.regex['x'].sub('./\a', tag, 1)
+                # insert image filename an extra time for readers that don't grok linked images
+                tag = self.regex['x'].sub(txt, tag, 1)
+
+            if self.target == 'tex':
+                tag = re.sub(r'\\b', r'\\\\b', tag)
+                txt = txt.replace('_', 'vvvvTexUndervvvv')
+
+            if self.config.get('embed-images'):
+                # Embedded images find files from the same location as linked images,
+                # for consistant behaviour.
+                basedir = os.path.dirname(self.config.get('outfile'))
+                fullpath = PathMaster().join(basedir, txt)
+                txt = self.embed_image(fullpath)
+                if self.target == 'aat':
+                    return txt
+
+            # Ugly hack to avoid infinite loop when target's image tag contains []
+            tag = tag.replace('[', 'vvvvEscapeSquareBracketvvvv')
+
+            line = self.regex['img'].sub(tag, line, 1)
+            line = self.regex['x'].sub(txt, line, 1)
+
+            if self.target == 'rst':
+                line = line.split('ENDIMG')[0] + line.split('ENDIMG')[1].strip()
+
+        return line.replace('vvvvEscapeSquareBracketvvvv', '[')
+
+    def add_inline_tags(self, line):
+        # Beautifiers (the marks are tested first, it's cheaper than a search)
+        for beauti, mark in BEAUTIFIERS:
+            if mark in line and \
+               self.regex['font%s' % beauti.capitalize()].search(line):
+                line = self.beautify_me(beauti, line)
+
+        if '[' in line:
+            line = self.parse_images(line)
+        return line
+
+    def tag_plain_line(self, line):
+        """Returns the tagged line, or None if it's not plain text
+
+        Plain text lines have no line kinds (masked or not), no macros
+        and no %%toc, so they are tagged the same anywhere on the body,
+        see prerender().
+        """
+        regex, cache, mask = self.regex, self.parse_cache, self.mask
+        if parseLine(line, regex, cache):
+            return None
+        mask.reset()
+        masked = mask.mask(line)
+        if mask.macrobank or mask.tocmask in masked or \
+           parseLine(masked, regex, cache):
+            return None
+        line = self.do_escape(masked)
+        line = self.add_inline_tags(line)
+        return mask.undo(line)
+
+    def prerender(self, bodylines, jobs):
+        """Tags the plain text body lines in a pool of jobs processes
+
+        The escapes, beautifiers, images and links of a plain text line
+        don't depend on the lines around it, so for big bodies they're
+        done in parallel, in batches of lines, before the conversion.
+        The block parse is still done in order, taking the tagged lines
+        from self.prerendered. The small bodies, and the targets that
+        number the links or images as they appear, are left serial.
+        """
+        self.prerendered = {}
+        if jobs < 2 or len(bodylines) < PRERENDER_MIN_LINES or \
+           self.target == 'aat' or \
+           (self.target == 'rtf' and self.config.get('embed-images')):
+            return
+        import multiprocessing
+        batches = [bodylines[i:i + PRERENDER_BATCH]
+                   for i in range(0, len(bodylines), PRERENDER_BATCH)]
+        pool = multiprocessing.Pool(jobs, init_prerender_process,
+                                    (self.config,))
+        try:
+            for tagged in pool.imap(prerender_lines, batches):
+                self.prerendered.update(tagged)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def convert(self, bodylines, firstlinenr=1, memo=None):
+        """Converts the marked body lines, returns (tagged body, marked toc)
+
+        If a MemoMaster is given as memo, the unchanged body chunks reuse
+        their tagged output from the previous conversions.
+        """
+        ret = list(self.iter_convert(bodylines, firstlinenr, memo))
+        return ret, self.marked_toc
+
+    def iter_convert(self, bodylines, firstlinenr=1, memo=None):
+        """Yields the tagged body lines while converting them
+
+        The same as convert(), but the tagged lines are handed over as
+        they're ready, so the full tagged body is never kept in memory.
+        The marked toc is available at self.marked_toc when it's done.
+        """
+        config = self.config
+        rules  = self.rules
+        regex  = self.regex
+        tags   = self.tags
+        target = self.target
+        stats  = self.stats
+        block = self.block = BlockMaster(self)
+        mask  = self.mask  = MaskMaster(self)
+        title = self.title = TitleMaster(self)
+        if stats:
+            start = time.time()
+            stats.watch(mask, 'mask', 'mask')
+            stats.watch(mask, 'undo', 'mask')
+
+        ret = []
+        dump_source = []
+        f_lastwasblank = 0
 
-            # Closing raw
-            if regex['blockRawClose'].search(line):
-                ret.extend(BLOCK.blockout())
+        # Maybe a major tag to enclose body? (like DIV for CSS)
+        if tags['bodyOpen']:
+            ret.append(tags['bodyOpen'])
+
+        # Streaming, unless all the output is discarded at the end
+        streaming = not (config['toc-only'] or config['dump-source'])
+
+        # Compiling all PreProc regexes
+        pre_filter = None
+        if config['preproc']:
+            pre_filter = FilterMaster(config['preproc'], 'PreProc',
+                _('Invalid PreProc filter regex'),
+                _('Invalid PreProc filter replacement'))
+            if stats:
+                stats.watch(pre_filter, 'apply', 'preproc')
+        nested = None
+        if config.get('nested-rules'):
+            nested = NestedMaster(self.target)
+            if stats:
+                stats.watch(nested, 'preproc', 'preproc')
+
+        # The parsed lines of this body saved on disk (--cache)
+        cache_file = None
+        if config.get('cache'):
+            cache_file = ParseCacheMaster(getParseCacheFile(bodylines))
+            self.parse_cache = cache_file
+        parse_cache = self.parse_cache
+
+        # The plain text lines tagged by prerender(), for this source file
+        prerendered = self.prerendered
+        sourcefile = config['currentsourcefile']
+
+        # Incremental mode
+        if memo:
+            memo = memo.start(self)
+        chunk = None
+        chunk_end = 0
+
+        # The [lines, position] being read, included files on top
+        sources = [[bodylines, 0]]
+
+        # Let's mark it up!
+        linenr = firstlinenr - 1
+        lineref = 0
+        while True:
+
+            # Incremental mode: save the last chunk
+            if chunk and lineref >= chunk_end:
+                if lineref == chunk_end:
+                    memo.save_chunk(chunk, self, ret, f_lastwasblank)
+                chunk = None
+
+            # End of the included file, back to the file that included it
+            if lineref >= len(bodylines):
+                sources.pop()
+                if not sources:
+                    break
+                bodylines, lineref = sources[-1]
+                chunk_end = 0
                 continue
 
-            # Normal raw-inside line
-            BLOCK.holdadd(line)
-            continue
+            # Streaming: hand over the lines tagged so far
+            if streaming and not chunk and len(ret) >= STREAM_BUFFER:
+                if stats:   # the time out of the loop is not counted
+                    stats.add('block_loop', time.time() - start, 0)
+                for tagged in ret:
+                    yield tagged
+                ret = []
+                if stats:
+                    start = time.time()
+
+            # Incremental mode: maybe reuse the next chunk
+            if memo and lineref >= chunk_end:
+                chunk_end = memo.next_chunk(bodylines, lineref)
+                chunk_lines = bodylines[lineref:chunk_end]
+                if not block.depth and memo.is_memoizable(chunk_lines):
+                    key = memo.get_key(chunk_lines,
+                                       (self.get_state(), f_lastwasblank))
+                    data = memo.get(key)
+                    if data:
+                        if stats:
+                            stats.count('bytes', sum(map(len, chunk_lines)))
+                        ret.extend(data[0])
+                        title.toc.extend(data[1])
+                        self.set_state(data[2])
+                        f_lastwasblank = data[3]
+                        linenr += chunk_end - lineref
+                        lineref = chunk_end
+                        continue
+                    chunk = (key, len(ret), len(title.toc))
+
+            # Defaults
+            mask.reset()
+            results_box = ''
+
+            untouchedline = bodylines[lineref]
+            if stats:
+                stats.count('bytes', len(untouchedline))
+            if config['dump-source']:
+                dump_source.append(untouchedline)
+
+            line = untouchedline.rstrip('\n\r')        # del line break
+
+            # Apply PreProc filters, then the Nested rules
+            if pre_filter:
+                line = pre_filter.apply(line)
+            if nested:
+                line = nested.preproc(line)
+
+            line = maskEscapeChar(line)                  # protect \ char
+            linenr  += 1
+            lineref += 1
+
+            if DEBUG:
+                Debug(repr(line), 2, linenr)  # heavy debug: show each line
+
+            # The lines inside comment, tagged, raw and verb blocks only
+            # have their closing mark searched, the others are parsed
+            if block.block() in block.exclusive:
+                kinds = NO_KINDS
+            else:
+                kinds = parseLine(line, regex, parse_cache)
 
-        # Detecting raw block init
-        if regex['blockRawOpen'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('raw'))
-            continue
+            #------------------[ Comment Block ]------------------------
 
-        # One line raw text
-        if regex['1lineRaw'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('raw'))
-            line = regex['1lineRaw'].sub('', line)
-            BLOCK.holdadd(line)
-            ret.extend(BLOCK.blockout())
-            continue
+            # We're already on a comment block
+            if block.block() == 'comment':
+
+                # Closing comment
+                if regex['blockCommentClose'].search(line):
+                    ret.extend(block.blockout() or [])
+                    continue
+
+                # Normal comment-inside line. Ignore it.
+                continue
 
-        #------------------------[ Verbatim  ]----------------------
+            # Detecting comment block init
+            if 'blockCommentOpen' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('comment'))
+                continue
 
-        #TIP We'll never support beautifiers inside verbatim
+            #-------------------------[ Tagged Text ]----------------------
 
-        # Closing table mapped to verb
-        if BLOCK.block() == 'verb' \
-           and BLOCK.prop('mapped') == 'table' \
-           and not regex['table'].search(line):
-            ret.extend(BLOCK.blockout())
+            # We're already on a tagged block
+            if block.block() == 'tagged':
 
-        # We're already on a verb block
-        if BLOCK.block() == 'verb':
+                # Closing tagged
+                if regex['blockTaggedClose'].search(line):
+                    ret.extend(block.blockout())
+                    continue
 
-            # Closing verb
-            if regex['blockVerbClose'].search(line):
-                ret.extend(BLOCK.blockout())
+                # Normal tagged-inside line
+                block.holdadd(line)
                 continue
 
-            # Normal verb-inside line
-            BLOCK.holdadd(line)
-            continue
+            # Detecting tagged block init
+            if 'blockTaggedOpen' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('tagged'))
+                continue
 
-        # Detecting verb block init
-        if regex['blockVerbOpen'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('verb'))
-            f_lastwasblank = 0
-            continue
+            # One line tagged text
+            if '1lineTagged' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('tagged'))
+                line = regex['1lineTagged'].sub('', line)
+                block.holdadd(line)
+                ret.extend(block.blockout())
+                continue
 
-        # One line verb-formatted text
-        if regex['1lineVerb'].search(line) \
-           and BLOCK.block() not in BLOCK.exclusive:
-            ret.extend(BLOCK.blockin('verb'))
-            line = regex['1lineVerb'].sub('', line)
-            BLOCK.holdadd(line)
-            ret.extend(BLOCK.blockout())
-            f_lastwasblank = 0
-            continue
+            #-------------------------[ Raw Text ]----------------------
+
+            # We're already on a raw block
+            if block.block() == 'raw':
+
+                # Closing raw
+                if regex['blockRawClose'].search(line):
+                    ret.extend(block.blockout())
+                    continue
 
-        # Tables are mapped to verb when target is not table-aware
-        if not rules['tableable'] and regex['table'].search(line):
-            if not BLOCK.isblock('verb'):
-                ret.extend(BLOCK.blockin('verb'))
-                BLOCK.propset('mapped', 'table')
-                BLOCK.holdadd(line)
+                # Normal raw-inside line
+                block.holdadd(line)
                 continue
 
-        #---------------------[ blank lines ]-----------------------
+            # Detecting raw block init
+            if 'blockRawOpen' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('raw'))
+                continue
+
+            # One line raw text
+            if '1lineRaw' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('raw'))
+                line = regex['1lineRaw'].sub('', line)
+                block.holdadd(line)
+                ret.extend(block.blockout())
+                continue
 
-        if regex['blankline'].search(line):
+            #------------------------[ Verbatim  ]----------------------
 
-            # Close open paragraph
-            if BLOCK.isblock('para'):
-                ret.extend(BLOCK.blockout())
-                f_lastwasblank = 1
+            #TIP We'll never support beautifiers inside verbatim
+
+            # Closing table mapped to verb
+            if block.block() == 'verb' \
+               and block.prop('mapped') == 'table' \
+               and not regex['table'].search(line):
+                ret.extend(block.blockout())
+                kinds = parseLine(line, regex, parse_cache)
+
+            # We're already on a verb block
+            if block.block() == 'verb':
+
+                # Closing verb
+                if regex['blockVerbClose'].search(line):
+                    ret.extend(block.blockout())
+                    continue
+
+                # Normal verb-inside line
+                block.holdadd(line)
                 continue
 
-            # Close all open tables
-            if BLOCK.isblock('table'):
-                ret.extend(BLOCK.blockout())
-                f_lastwasblank = 1
+            # Detecting verb block init
+            if 'blockVerbOpen' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('verb'))
+                f_lastwasblank = 0
+                continue
+
+            # One line verb-formatted text
+            if '1lineVerb' in kinds \
+               and block.block() not in block.exclusive:
+                ret.extend(block.blockin('verb'))
+                line = regex['1lineVerb'].sub('', line)
+                block.holdadd(line)
+                ret.extend(block.blockout())
+                f_lastwasblank = 0
                 continue
 
-            # Close all open quotes
-            while BLOCK.isblock('quote'):
-                ret.extend(BLOCK.blockout())
+            # Tables are mapped to verb when target is not table-aware
+            if not rules['tableable'] and 'table' in kinds:
+                if not block.isblock('verb'):
+                    ret.extend(block.blockin('verb'))
+                    block.propset('mapped', 'table')
+                    block.holdadd(line)
+                    continue
 
-            # Closing all open lists
-            if f_lastwasblank:          # 2nd consecutive blank
-                if BLOCK.block().endswith('list'):
-                    BLOCK.holdaddsub('')   # helps parser
-                while BLOCK.depth:  # closes list (if any)
-                    ret.extend(BLOCK.blockout())
-                continue            # ignore consecutive blanks
+            #---------------------[ blank lines ]-----------------------
 
-            # Paragraph (if any) is wanted inside lists also
-            if BLOCK.block().endswith('list'):
-                BLOCK.holdaddsub('')
+            if 'blankline' in kinds:
 
-            f_lastwasblank = 1
-            continue
+                # Close open paragraph
+                if block.isblock('para'):
+                    ret.extend(block.blockout())
+                    f_lastwasblank = 1
+                    continue
 
-        #---------------------[ special ]---------------------------
+                # Close all open tables
+                if block.isblock('table'):
+                    ret.extend(block.blockout())
+                    f_lastwasblank = 1
+                    continue
 
-        if regex['special'].search(line):
+                # Close all open quotes
+                while block.isblock('quote'):
+                    ret.extend(block.blockout())
 
-            targ, key, val = ConfigLines().parse_line(line, None, target)
+                # Closing all open lists
+                if f_lastwasblank:          # 2nd consecutive blank
+                    if block.block().endswith('list'):
+                        block.holdaddsub('')   # helps parser
+                    while block.depth:  # closes list (if any)
+                        ret.extend(block.blockout())
+                    continue            # ignore consecutive blanks
 
-            if key:
-                Debug("Found config '%s', value '%s'" % (key, val), 1, linenr)
-            else:
-                Debug('Bogus Special Line', 1, linenr)
+                # Paragraph (if any) is wanted inside lists also
+                if block.block().endswith('list'):
+                    block.holdaddsub('')
 
-            # %!include command
-            if key == 'include':
+                f_lastwasblank = 1
+                continue
 
-                # The current path is always relative to the file where %!include appeared
-                incfile = val
-                incpath = os.path.dirname(CONF['currentsourcefile'])
-                fullpath = PathMaster().join(incpath, incfile)
+            #---------------------[ special ]---------------------------
 
-                # Infinite loop detection
-                if os.path.abspath(fullpath) == os.path.abspath(CONF['currentsourcefile']):
-                    Error("%s: %s" % (_('A file cannot include itself (loop!)'), fullpath))
+            if 'special' in kinds:
 
-                inctype, inclines = get_include_contents(incfile, incpath)
+                targ, key, val = ConfigLines().parse_line(line, None, target)
 
-                # Verb, raw and tagged are easy
-                if inctype != 't2t':
-                    ret.extend(BLOCK.blockin(inctype))
-                    BLOCK.holdextend(inclines)
-                    ret.extend(BLOCK.blockout())
-                else:
-                    # Insert include lines into body
-                    #TODO include maxdepth limit
-                    bodylines = bodylines[:lineref] + inclines + ['%%!currentfile: %s' % (CONF['currentsourcefile'])] + bodylines[lineref:]
-                    # Remove %!include call
-                    if CONF['dump-source']:
-                        dump_source.pop()
-
-            # %!currentfile command
-            elif key == 'currentfile':
-                targ, key, val = ConfigLines().parse_line(line, 'currentfile', target)
                 if key:
                     Debug("Found config '%s', value '%s'" % (key, val), 1, linenr)
-                    CONF['currentsourcefile'] = val
-                # This line is done, go to next
-                continue
+                else:
+                    Debug('Bogus Special Line', 1, linenr)
 
-            # %!csv command
-            elif key in ['csv', 'csvheader']:
+                # %!include command
+                if key == 'include':
 
-                table = []
-                try:
-                    filename, delimiter = val.split()
-                except:
-                    filename, delimiter = val, ','
-                if delimiter == 'space':
-                    delimiter = ' '
-                elif delimiter == 'tab':
-                    delimiter = '\t'
-                reader = csv.reader(Readfile(filename), delimiter=delimiter)
-
-                # Convert each CSV line to a txt2tags' table line
-                # foo,bar,baz -> | foo | bar | baz |
-                try:
-                    for row in reader:
-                        table.append('| %s |' % ' | '.join(row))
-                    if key == 'csvheader':
-                        table[0] = '|' + table[0]
-                except csv.Error, e:
-                    Error('CSV: file %s: %s' % (filename, e))
-
-                # Parse and convert the new table
-                # Note: cell contents is raw, no t2t marks are parsed
-                if rules['tableable']:
-                    ret.extend(BLOCK.blockin('table'))
-                    if table:
-                        BLOCK.tableparser.__init__(table[0])
-                        for row in table:
-                            tablerow = TableMaster().parse_row(row)
-                            BLOCK.tableparser.add_row(tablerow)
-
-                            # Very ugly, but necessary for escapes
-                            line = SEPARATOR.join(tablerow['cells'])
-                            BLOCK.holdadd(doEscape(target, line))
-                        ret.extend(BLOCK.blockout())
-
-                # Tables are mapped to verb when target is not table-aware
-                else:
-                    ret.extend(BLOCK.blockin('verb'))
-                    BLOCK.propset('mapped', 'table')
-                    for row in table:
-                        BLOCK.holdadd(row)
-                    ret.extend(BLOCK.blockout())
+                    # The current path is always relative to the file where %!include appeared
+                    incfile = val
+                    incpath = os.path.dirname(config['currentsourcefile'])
+                    fullpath = PathMaster().join(incpath, incfile)
+
+                    # Infinite loop detection
+                    if os.path.abspath(fullpath) == os.path.abspath(config['currentsourcefile']):
+                        Error("%s: %s" % (_('A file cannot include itself (loop!)'), fullpath))
+
+                    inctype, inclines = get_include_contents(incfile, incpath)
+
+                    # Verb, raw and tagged are easy
+                    if inctype != 't2t':
+                        ret.extend(block.blockin(inctype))
+                        block.holdextend(inclines)
+                        ret.extend(block.blockout())
+                    else:
+                        # Read the include lines, then go on with this file
+                        #TODO include maxdepth limit
+                        sources[-1][1] = lineref
+                        bodylines = inclines + ['%%!currentfile: %s' % (config['currentsourcefile'])]
+                        lineref = 0
+                        sources.append([bodylines, lineref])
+                        chunk_end = 0
+                        # Remove %!include call
+                        if config['dump-source']:
+                            dump_source.pop()
+
+                # %!currentfile command
+                elif key == 'currentfile':
+                    targ, key, val = ConfigLines().parse_line(line, 'currentfile', target)
+                    if key:
+                        Debug("Found config '%s', value '%s'" % (key, val), 1, linenr)
+                        config['currentsourcefile'] = val
+                    # This line is done, go to next
+                    continue
+
+                # %!csv command
+                elif key in ['csv', 'csvheader']:
+
+                    import csv
+                    try:
+                        filename, delimiter = val.split()
+                    except:
+                        filename, delimiter = val, ','
+                    if delimiter == 'space':
+                        delimiter = ' '
+                    elif delimiter == 'tab':
+                        delimiter = '\t'
+                    csvfile = Openfile(filename)
+                    reader = csv.reader(csvfile, delimiter=delimiter)
+
+                    # Parse and convert the new table, the rows go straight
+                    # from the reader to the table parser
+                    # Note: cell contents is raw, no t2t marks are parsed
+                    if rules['tableable']:
+                        ret.extend(block.blockin('table'))
+                    # Tables are mapped to verb when target is not table-aware
+                    else:
+                        ret.extend(block.blockin('verb'))
+                        block.propset('mapped', 'table')
 
-                # This line is done, go to next
+                    headrow = int(key == 'csvheader')
+                    rows = 0
+                    try:
+                        try:
+                            for row in reader:
+                                if rules['tableable']:
+                                    tablerow = block.tableparser.parse_cells(row, headrow)
+                                    if not rows:
+                                        block.tableparser.set_prop(tablerow)
+                                    block.tableparser.add_row(tablerow)
+
+                                    # Very ugly, but necessary for escapes
+                                    line = SEPARATOR.join(tablerow['cells'])
+                                    block.holdadd(self.do_escape(line))
+                                else:
+                                    # foo,bar,baz -> | foo | bar | baz |
+                                    line = '| %s |' % ' | '.join(row)
+                                    if headrow:
+                                        line = '|' + line
+                                    block.holdadd(line)
+                                headrow = 0
+                                rows += 1
+                        except csv.Error, e:
+                            Error('CSV: file %s: %s' % (filename, e))
+                    finally:
+                        if isinstance(csvfile, file):
+                            csvfile.close()
+                    Message(_("File read (%d lines): %s") % (reader.line_num, filename), 2)
+
+                    if rows or not rules['tableable']:
+                        ret.extend(block.blockout())
+
+                    # This line is done, go to next
+                    continue
+
+            #---------------------[ dump-source ]-----------------------
+
+            # We don't need to go any further
+            if config['dump-source']:
                 continue
 
-        #---------------------[ dump-source ]-----------------------
+            #---------------------[ Comments ]--------------------------
 
-        # We don't need to go any further
-        if CONF['dump-source']:
-            continue
+            # Just skip them (if not macro)
+            if 'comment' in kinds and not \
+               regex['macros'].match(line) and not \
+               regex['toc'].match(line):
+                continue
 
-        #---------------------[ Comments ]--------------------------
+            #---------------------[ Triggers ]--------------------------
 
-        # Just skip them (if not macro)
-        if regex['comment'].search(line) and not \
-           regex['macros'].match(line) and not \
-           regex['toc'].match(line):
-            continue
+            # Valid line, reset blank status
+            f_lastwasblank = 0
 
-        #---------------------[ Triggers ]--------------------------
+            # Any NOT quote line closes all open quotes
+            if block.isblock('quote') and 'quote' not in kinds:
+                while block.isblock('quote'):
+                    ret.extend(block.blockout())
 
-        # Valid line, reset blank status
-        f_lastwasblank = 0
+            # Any NOT table line closes an open table
+            if block.isblock('table') and 'table' not in kinds:
+                ret.extend(block.blockout())
 
-        # Any NOT quote line closes all open quotes
-        if BLOCK.isblock('quote') and not regex['quote'].search(line):
-            while BLOCK.isblock('quote'):
-                ret.extend(BLOCK.blockout())
+            #---------------------[ Horizontal Bar ]--------------------
 
-        # Any NOT table line closes an open table
-        if BLOCK.isblock('table') and not regex['table'].search(line):
-            ret.extend(BLOCK.blockout())
+            if 'bar' in kinds:
 
-        #---------------------[ Horizontal Bar ]--------------------
+                # Bars inside quotes are handled on the Quote processing
+                # Otherwise we parse the bars right here
+                #
+                if not (block.isblock('quote') or 'quote' in kinds) \
+                    or (block.isblock('quote') and not rules['barinsidequote']):
 
-        if regex['bar'].search(line):
+                    # Close all the opened blocks
+                    ret.extend(block.blockin('bar'))
 
-            # Bars inside quotes are handled on the Quote processing
-            # Otherwise we parse the bars right here
-            #
-            if not (BLOCK.isblock('quote') or regex['quote'].search(line)) \
-                or (BLOCK.isblock('quote') and not rules['barinsidequote']):
+                    # Extract the bar chars (- or =)
+                    m = regex['bar'].search(line)
+                    bar_chars = m.group(2)
 
-                # Close all the opened blocks
-                ret.extend(BLOCK.blockin('bar'))
+                    # Process and dump the tagged bar
+                    block.holdadd(bar_chars)
+                    ret.extend(block.blockout())
+                    if DEBUG:
+                        Debug("BAR: %s" % line, 6)
+
+                    # We're done, nothing more to process
+                    continue
+
+            #---------------------[ Title ]-----------------------------
+
+            if ('title' in kinds or 'numtitle' in kinds) \
+                and not block.block().endswith('list'):
 
-                # Extract the bar chars (- or =)
-                m = regex['bar'].search(line)
-                bar_chars = m.group(2)
+                if 'title' in kinds:
+                    name = 'title'
+                else:
+                    name = 'numtitle'
+
+                # Close all the opened blocks
+                ret.extend(block.blockin(name))
 
-                # Process and dump the tagged bar
-                BLOCK.holdadd(bar_chars)
-                ret.extend(BLOCK.blockout())
-                Debug("BAR: %s" % line, 6)
+                # Process title
+                title.add(line)
+                ret.extend(block.blockout())
 
                 # We're done, nothing more to process
                 continue
 
-        #---------------------[ Title ]-----------------------------
+            #---------------------[ %%toc ]-----------------------
+
+            # %%toc line closes paragraph
+            if block.block() == 'para' and 'toc' in kinds:
+                ret.extend(block.blockout())
 
-        if (regex['title'].search(line) or regex['numtitle'].search(line)) \
-            and not BLOCK.block().endswith('list'):
+            #---------------------[ apply masks ]-----------------------
 
-            if regex['title'].search(line):
-                name = 'title'
+            # Plain text line already tagged (same line, same source file)
+            tagged_line = None
+            if prerendered and line in prerendered and \
+               config['currentsourcefile'] == sourcefile:
+                tagged_line = prerendered[line]
             else:
-                name = 'numtitle'
+                masked = mask.mask(line)
+                if masked != line:
+                    line = masked
+                    kinds = parseLine(line, regex, parse_cache)
 
-            # Close all the opened blocks
-            ret.extend(BLOCK.blockin(name))
+            #XXX from here, only block-inside lines will pass
 
-            # Process title
-            TITLE.add(line)
-            ret.extend(BLOCK.blockout())
+            #---------------------[ Quote ]-----------------------------
 
-            # We're done, nothing more to process
-            continue
+            if 'quote' in kinds:
 
-        #---------------------[ %%toc ]-----------------------
+                # Store number of leading TABS
+                quotedepth = len(regex['quote'].search(line).group(0))
 
-        # %%toc line closes paragraph
-        if BLOCK.block() == 'para' and regex['toc'].search(line):
-            ret.extend(BLOCK.blockout())
+                # Don't cross depth limit
+                maxdepth = rules['quotemaxdepth']
+                if maxdepth and quotedepth > maxdepth:
+                    quotedepth = maxdepth
 
-        #---------------------[ apply masks ]-----------------------
+                # New quote
+                if not block.isblock('quote'):
+                    ret.extend(block.blockin('quote'))
 
-        line = MASK.mask(line)
+                # New subquotes
+                while block.depth < quotedepth:
+                    block.blockin('quote')
 
-        #XXX from here, only block-inside lines will pass
+                # Closing quotes
+                while quotedepth < block.depth:
+                    ret.extend(block.blockout())
 
-        #---------------------[ Quote ]-----------------------------
+                # Bar inside quote
+                if 'bar' in kinds and rules['barinsidequote']:
+                    tempBlock = BlockMaster(self)
+                    tagged_bar = []
+                    tagged_bar.extend(tempBlock.blockin('bar'))
+                    tempBlock.holdadd(line)
+                    tagged_bar.extend(tempBlock.blockout())
+                    block.holdextend(tagged_bar)
+                    continue
 
-        if regex['quote'].search(line):
+            #---------------------[ Lists ]-----------------------------
+
+            # An empty item also closes the current list
+            if block.block().endswith('list'):
+                m = regex['listclose'].match(line)
+                if m:
+                    listindent = m.group(1)
+                    listtype = m.group(2)
+                    currlisttype = block.prop('type')
+                    currlistindent = block.prop('indent')
+                    if listindent == currlistindent and \
+                       listtype == currlisttype:
+                        ret.extend(block.blockout())
+                        continue
+
+            if 'list' in kinds or 'numlist' in kinds or 'deflist' in kinds:
+
+                listindent = block.prop('indent')
+                m = regex['listitem'].match(line)
+                listitemindent = m.group(1)
+                listtype = m.group(2)
+                listname = LISTNAMES[listtype]
+                results_box = block.holdadd
+
+                # Del list ID (and separate term from definition)
+                if listname == 'deflist':
+                    term = self.parse_deflist_term(line)
+                    line = regex['deflist'].sub(
+                        SEPARATOR + term + SEPARATOR, line)
+                else:
+                    line = regex[listname].sub(SEPARATOR, line)
+
+                # Don't cross depth limit
+                maxdepth = rules['listmaxdepth']
+                if maxdepth and block.depth == maxdepth:
+                    if len(listitemindent) > len(listindent):
+                        listitemindent = listindent
+
+                # List bumping (same indent, diff mark)
+                # Close the currently open list to clear the mess
+                if block.block().endswith('list') \
+                   and listname != block.block() \
+                   and len(listitemindent) == len(listindent):
+                    ret.extend(block.blockout())
+                    listindent = block.prop('indent')
+
+                # Open mother list or sublist
+                if not block.block().endswith('list') or \
+                   len(listitemindent) > len(listindent):
+                    ret.extend(block.blockin(listname))
+                    block.propset('indent', listitemindent)
+                    block.propset('type', listtype)
+
+                # Closing sublists
+                while len(listitemindent) < len(block.prop('indent')):
+                    ret.extend(block.blockout())
+
+                # O-oh, sublist before list ("\n\n  - foo\n- foo")
+                # Fix: close sublist (as mother), open another list
+                if not block.block().endswith('list'):
+                    ret.extend(block.blockin(listname))
+                    block.propset('indent', listitemindent)
+                    block.propset('type', listtype)
+
+            #---------------------[ Table ]-----------------------------
+
+            #TODO escape undesired format inside table
+            #TODO add pm6 target
+            if regex['table'].search(line):
+
+                if not block.isblock('table'):   # first table line!
+                    ret.extend(block.blockin('table'))
+                    block.tableparser.__init__(self, line)
+
+                tablerow = TableMaster(self).parse_row(line)
+                block.tableparser.add_row(tablerow)     # save config
+
+                # Maintain line to unmask and inlines
+                # XXX Bug: | **bo | ld** | turns **bo\x01ld** and gets converted :(
+                # TODO isolate unmask+inlines parsing to use here
+                line = SEPARATOR.join(tablerow['cells'])
+
+            #---------------------[ Paragraph ]-------------------------
+
+            if not block.block() and \
+               not line.count(mask.tocmask):  # new para!
+                ret.extend(block.blockin('para'))
+
+            ############################################################
+            ############################################################
+            ############################################################
+
+            #---------------------[ Final Parses ]----------------------
+
+            if tagged_line is not None:
+                line = tagged_line
+            else:
+                # The target-specific special char escapes for body lines
+                line = self.do_escape(line)
 
-            # Store number of leading TABS
-            quotedepth = len(regex['quote'].search(line).group(0))
+                line = self.add_inline_tags(line)
+                line = mask.undo(line)
 
-            # Don't cross depth limit
-            maxdepth = rules['quotemaxdepth']
-            if maxdepth and quotedepth > maxdepth:
-                quotedepth = maxdepth
+            #---------------------[ Hold or Return? ]-------------------
 
-            # New quote
-            if not BLOCK.isblock('quote'):
-                ret.extend(BLOCK.blockin('quote'))
+            ### Now we must choose where to put the parsed line
+            #
+            if not results_box:
+                # List item extra lines
+                if block.block().endswith('list'):
+                    results_box = block.holdaddsub
+                # Other blocks
+                elif block.block():
+                    results_box = block.holdadd
+                # No blocks
+                else:
+                    line = self.do_final_escape(line)
+                    results_box = ret.append
 
-            # New subquotes
-            while BLOCK.depth < quotedepth:
-                BLOCK.blockin('quote')
+            results_box(line)
 
-            # Closing quotes
-            while quotedepth < BLOCK.depth:
-                ret.extend(BLOCK.blockout())
+        # EOF: close any open para/verb/lists/table/quotes
+        Debug('EOF', 7)
+        while block.block():
+            ret.extend(block.blockout())
 
-            # Bar inside quote
-            if regex['bar'].search(line) and rules['barinsidequote']:
-                tempBlock = BlockMaster()
-                tagged_bar = []
-                tagged_bar.extend(tempBlock.blockin('bar'))
-                tempBlock.holdadd(line)
-                tagged_bar.extend(tempBlock.blockout())
-                BLOCK.holdextend(tagged_bar)
-                continue
+        # Maybe close some opened title area?
+        if rules['titleblocks']:
+            ret.extend(title.close_all())
 
-        #---------------------[ Lists ]-----------------------------
+        if tags['bodyClose']:
+            ret.append(tags['bodyClose'])
 
-        # An empty item also closes the current list
-        if BLOCK.block().endswith('list'):
-            m = regex['listclose'].match(line)
-            if m:
-                listindent = m.group(1)
-                listtype = m.group(2)
-                currlisttype = BLOCK.prop('type')
-                currlistindent = BLOCK.prop('indent')
-                if listindent == currlistindent and \
-                   listtype == currlisttype:
-                    ret.extend(BLOCK.blockout())
-                    continue
+        if config['toc-only']:
+            ret = []
+        self.marked_toc = title.dump_marked_toc(config['toc-level'])
 
-        if   regex['list'].search(line) or \
-          regex['numlist'].search(line) or \
-          regex['deflist'].search(line):
-
-            listindent = BLOCK.prop('indent')
-            listids = ''.join(LISTNAMES.keys())
-            m = re.match('^( *)([%s]) ' % listids, line)
-            listitemindent = m.group(1)
-            listtype = m.group(2)
-            listname = LISTNAMES[listtype]
-            results_box = BLOCK.holdadd
-
-            # Del list ID (and separate term from definition)
-            if listname == 'deflist':
-                term = parse_deflist_term(line)
-                line = regex['deflist'].sub(
-                    SEPARATOR + term + SEPARATOR, line)
-            else:
-                line = regex[listname].sub(SEPARATOR, line)
-
-            # Don't cross depth limit
-            maxdepth = rules['listmaxdepth']
-            if maxdepth and BLOCK.depth == maxdepth:
-                if len(listitemindent) > len(listindent):
-                    listitemindent = listindent
-
-            # List bumping (same indent, diff mark)
-            # Close the currently open list to clear the mess
-            if BLOCK.block().endswith('list') \
-               and listname != BLOCK.block() \
-               and len(listitemindent) == len(listindent):
-                ret.extend(BLOCK.blockout())
-                listindent = BLOCK.prop('indent')
-
-            # Open mother list or sublist
-            if not BLOCK.block().endswith('list') or \
-               len(listitemindent) > len(listindent):
-                ret.extend(BLOCK.blockin(listname))
-                BLOCK.propset('indent', listitemindent)
-                BLOCK.propset('type', listtype)
-
-            # Closing sublists
-            while len(listitemindent) < len(BLOCK.prop('indent')):
-                ret.extend(BLOCK.blockout())
-
-            # O-oh, sublist before list ("\n\n  - foo\n- foo")
-            # Fix: close sublist (as mother), open another list
-            if not BLOCK.block().endswith('list'):
-                ret.extend(BLOCK.blockin(listname))
-                BLOCK.propset('indent', listitemindent)
-                BLOCK.propset('type', listtype)
-
-        #---------------------[ Table ]-----------------------------
-
-        #TODO escape undesired format inside table
-        #TODO add pm6 target
-        if regex['table'].search(line):
-
-            if not BLOCK.isblock('table'):   # first table line!
-                ret.extend(BLOCK.blockin('table'))
-                BLOCK.tableparser.__init__(line)
-
-            tablerow = TableMaster().parse_row(line)
-            BLOCK.tableparser.add_row(tablerow)     # save config
-
-            # Maintain line to unmask and inlines
-            # XXX Bug: | **bo | ld** | turns **bo\x01ld** and gets converted :(
-            # TODO isolate unmask+inlines parsing to use here
-            line = SEPARATOR.join(tablerow['cells'])
-
-        #---------------------[ Paragraph ]-------------------------
-
-        if not BLOCK.block() and \
-           not line.count(MASK.tocmask):  # new para!
-            ret.extend(BLOCK.blockin('para'))
-
-        ############################################################
-        ############################################################
-        ############################################################
-
-        #---------------------[ Final Parses ]----------------------
-
-        # The target-specific special char escapes for body lines
-        line = doEscape(target, line)
-
-        line = add_inline_tags(line)
-        line = MASK.undo(line)
-
-        #---------------------[ Hold or Return? ]-------------------
-
-        ### Now we must choose where to put the parsed line
-        #
-        if not results_box:
-            # List item extra lines
-            if BLOCK.block().endswith('list'):
-                results_box = BLOCK.holdaddsub
-            # Other blocks
-            elif BLOCK.block():
-                results_box = BLOCK.holdadd
-            # No blocks
-            else:
-                line = doFinalEscape(target, line)
-                results_box = ret.append
+        # If dump-source, all parsing is ignored
+        if config['dump-source']:
+            ret = dump_source
+
+        if pre_filter:
+            pre_filter.report()
 
-        results_box(line)
+        if cache_file is not None:
+            cache_file.save()
 
-    # EOF: close any open para/verb/lists/table/quotes
-    Debug('EOF', 7)
-    while BLOCK.block():
-        ret.extend(BLOCK.blockout())
+        if stats:
+            stats.count('lines', linenr - firstlinenr + 1)
+            stats.add('block_loop', time.time() - start)
 
-    # Maybe close some opened title area?
-    if rules['titleblocks']:
-        ret.extend(TITLE.close_all())
+        for tagged in ret:
+            yield tagged
 
-    # Maybe a major tag to enclose body? (like DIV for CSS)
-    if TAGS['bodyOpen']:
-        ret.insert(0, TAGS['bodyOpen'])
-    if TAGS['bodyClose']:
-        ret.append(TAGS['bodyClose'])
 
-    if CONF['toc-only']:
-        ret = []
-    marked_toc = TITLE.dump_marked_toc(CONF['toc-level'])
+# The active Converter of each thread, used by the module functions below
+_active = threading.local()
+
+
+def get_converter(config=None):
+    "Returns the active Converter, creating a new one if config changed"
+    conv = getattr(_active, 'converter', None)
+    if config is not None and (conv is None or conv.config is not config):
+        conv = set_global_config(config)
+    if conv is None:
+        Error('No active converter, use set_global_config() first')
+    return conv
+
+
+def set_global_config(config, stats=None):
+    "Creates a Converter for config and makes it the active one"
+    _active.converter = Converter(config, stats)
+    return _active.converter
+
+
+def convert(bodylines, config, firstlinenr=1, stats=None):
+    "Converts the body lines, the result is unicode if the lines are unicode"
+    return set_global_config(config, stats).convert(bodylines, firstlinenr)
+
+
+def toc_inside_body(body, toc, config):
+    return get_converter(config).toc_inside_body(body, toc)
+
+
+def toc_tagger(toc, config):
+    return get_converter(config).toc_tagger(toc)
+
+
+def toc_formatter(toc, config):
+    return get_converter(config).toc_formatter(toc)
+
+
+def doHeader(headers, config):
+    return get_converter(config).do_header(headers)
+
+
+def doFooter(config):
+    return get_converter(config).do_footer()
+
+
+def doCommentLine(txt):
+    return get_converter().do_comment_line(txt)
+
+
+def doEscape(target, txt):
+    conv = get_converter()
+    if target == conv.target:
+        return conv.do_escape(txt)
+    # Another target, with the active rules
+    txt = getEscaper(target, conv.rules).escape(txt)
+    if target == 'rtf':
+        txt = conv.escape_rtf_ascii(txt)
+    return txt
+
+
+def doFinalEscape(target, txt):
+    conv = get_converter()
+    if target == conv.target:
+        return conv.do_final_escape(txt)
+    return getEscaper(target, conv.rules).final_escape(txt)
+
+
+def enclose_me(tagname, txt):
+    return get_converter().enclose_me(tagname, txt)
+
+
+def fix_relative_path(path):
+    return get_converter().fix_relative_path(path)
+
+
+def beautify_me(name, line):
+    return get_converter().beautify_me(name, line)
+
+
+def get_tagged_link(label, url):
+    return get_converter().get_tagged_link(label, url)
+
+
+def parse_deflist_term(line):
+    return get_converter().parse_deflist_term(line)
+
+
+def get_image_align(line):
+    return get_converter().get_image_align(line)
+
 
-    # If dump-source, all parsing is ignored
-    if CONF['dump-source']:
-        ret = dump_source[:]
+def embedImage(filename):
+    return get_converter().embed_image(filename)
+
+
+def parse_images(line):
+    return get_converter().parse_images(line)
 
-    return ret, marked_toc
+
+def add_inline_tags(line):
+    return get_converter().add_inline_tags(line)
 
 
 ##############################################################################
@@ -8315,7 +10383,15 @@ def exec_command_line(user_cmdline=[]):
         Debug("rc file raw config: %s" % RC_RAW, 1)
 
     # Get all infiles config (if any)
-    infiles_config = get_infiles_config(infiles)
+    # With --jobs, each process gets the config of its own file
+    try:
+        jobs = int(cmdline_parsed.get('jobs') or 0)
+    except ValueError:
+        Error(_('--%s value must be a number') % 'jobs')
+    parallel = jobs > 1 and len(infiles) > 1 and not GUI and \
+        STDIN not in infiles
+    if not parallel:
+        infiles_config = get_infiles_config(infiles)
 
     # Is GUI available?
     # Try to load and start GUI interface for --gui
@@ -8376,7 +10452,10 @@ def exec_command_line(user_cmdline=[]):
             _('Please inform an input file (.t2t) at the end of the command.') + '\n' +
             _('Example:') + ' %s -t html %s' % (my_name, _('file.t2t')))
 
-        convert_this_files(infiles_config)
+        if parallel:
+            convert_infiles_parallel(infiles, jobs)
+        else:
+            convert_this_files(infiles_config)
 
     Message(_("Txt2tags finished successfully"), 1)
 